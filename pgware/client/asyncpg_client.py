@@ -1,4 +1,7 @@
+import asyncio
+import inspect
 import json
+import weakref
 
 import asyncpg
 # from psycopg2.extras import Json as pgJson
@@ -8,18 +11,26 @@ from pgware import (
     DD,
     Context as C,
     ProgrammingError,
+    PublicError,
     QueryError,
     logger,
     provider,
     ps2pg,
 )
+from pgware.utils import LRUCache, columnar, ps2pg_query
 
 """
 PGWare ascyncpg client definition file
 """
 # ## API for integration with PGWare
 __backend__ = 'asyncpg'
-__supports__ = C.CURSOR | C.SINGLE | C.QUERY_ARGS_POSTGRESQL | C.OUTPUT_DICT | C.PREPARED | C.QUERY_ARGS_PSYCOPG2 | C.JSON | C.POOLED | C.OUTPUT_LIST | C.OUTPUT_NATIVE
+__supports__ = C.CURSOR | C.SINGLE | C.QUERY_ARGS_POSTGRESQL | C.OUTPUT_DICT | C.PREPARED | C.QUERY_ARGS_PSYCOPG2 | C.JSON | C.POOLED | C.OUTPUT_LIST | C.OUTPUT_NATIVE | C.OUTPUT_COLUMNAR
+
+
+# Prepared statements kept per connection (see special 'statement_cache_size')
+STATEMENT_CACHE_SIZE = 100
+# asyncpg queries the catalogue for builtin codec types before 0.31 (see TypeCachingConnection)
+INTROSPECTS_BUILTIN_TYPES = tuple(int(part) for part in asyncpg.__version__.split('.')[:2]) < (0, 31)
 
 
 # Map format: {ADAPTER_KEY: [PGWARE_KEY, DEFAULT_VALUE] | ...}
@@ -66,20 +77,21 @@ class Extensions():
 
     @staticmethod
     async def json(connection):
+        # Binary codecs, text ones can't be used by binary COPYs (copy_in)
         await connection.set_type_codec(
-            'json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog'
+            'json', encoder=lambda x: json.dumps(x).encode(), decoder=json.loads, schema='pg_catalog', format='binary'
         )
         await connection.set_type_codec(
-            'jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog'
+            'jsonb', encoder=lambda x: b'\x01' + json.dumps(x).encode(), decoder=lambda x: json.loads(x[1:]), schema='pg_catalog', format='binary'
         )
 
     @staticmethod
     async def json_out(connection):
         await connection.set_type_codec(
-            'json', encoder=lambda x: x, decoder=json.loads, schema='pg_catalog'
+            'json', encoder=str.encode, decoder=json.loads, schema='pg_catalog', format='binary'
         )
         await connection.set_type_codec(
-            'jsonb', encoder=lambda x: x, decoder=json.loads, schema='pg_catalog'
+            'jsonb', encoder=lambda x: b'\x01' + x.encode(), decoder=lambda x: json.loads(x[1:]), schema='pg_catalog', format='binary'
         )
 
     @staticmethod
@@ -113,6 +125,42 @@ class Extensions():
         # )
 
 
+class TypeCachingConnection(asyncpg.Connection):  # pylint: disable=abstract-method
+    """
+    asyncpg connection whose extensions' codec types are introspected once
+    per builder (see connection_class): asyncpg versions before 0.31 query
+    the catalogue for every set_type_codec, on every new connection, even
+    for builtin types. Later ones don't, and get plain connections
+    """
+    _type_records = {}  # (schema, typename) => type record
+
+    async def _introspect_type(self, typename, schema):
+        if schema != 'pg_catalog':
+            # User types may be dropped and created again under a new oid
+            return await super()._introspect_type(typename, schema)
+        key = (schema, typename)
+        record = self._type_records.get(key)
+        if record is None:
+            record = self._type_records[key] = await super()._introspect_type(typename, schema)
+        return record
+
+
+def connection_class(state):
+    """
+    The builder's connection class, sharing its type records
+    """
+    if not INTROSPECTS_BUILTIN_TYPES:
+        return asyncpg.Connection
+    shared = state.parent if state.parent is not None else state
+    if 'connection_class' not in shared.store:
+        shared.store['connection_class'] = type('TypeCachingConnection', (TypeCachingConnection,), {'_type_records': {}})
+    return shared.store['connection_class']
+
+
+# Single connection => LRUCache of its prepared statements (see _statement_cache)
+STATEMENT_CACHES = weakref.WeakKeyDictionary()
+
+
 async def default_error_handler(ex, state):
     """
     Handle adapter-specific exceptions and tell pgware
@@ -126,6 +174,18 @@ async def default_error_handler(ex, state):
     if state.transaction:
         await state.transaction.rollback()
         logger.warning('Asyncpg transaction rolled back')
+        # A retry has to start a new one
+        state.transaction = None
+        if 'cursor' in state.done:
+            state.done.remove('cursor')
+    if isinstance(ex, asyncpg.InvalidCachedStatementError) and 'prepared_query' in state.store:
+        # Schema changed under a cached statement: prepare it again on retry
+        cache = _statement_cache(state)
+        if cache is not None:
+            cache.pop(state.store['prepared_query'])
+        state.query = state.store['prepared_query']
+    if isinstance(ex, PublicError):
+        return ex
     if (isinstance(ex, (
             asyncpg.PostgresSyntaxError,
             asyncpg.exceptions.SyntaxOrAccessError))):
@@ -151,6 +211,7 @@ async def close_context(state):
     if state.transaction:
         await state.transaction.commit()
     if state.pool:
+        state.store.pop('statement_cache', None)
         await state.pool.release(state.connection)
 
 
@@ -163,6 +224,22 @@ async def close_connection(state):
         await state.connection.close()
 
 
+async def prepare_statements(state, queries):
+    """
+    Prepare queries on the context's connection ahead of their use by
+    prepare() (other queries are cached by asyncpg once they ran). Pooled
+    connections' statements only last for an acquisition: they are left
+    to their first use
+    """
+    if state.pool is not None:
+        logger.debug('asyncpg pooled connections: statements prepared on first use')
+        return
+    for query in queries:
+        if state.context & state.context.QUERY_ARGS_PSYCOPG2 and '$' not in query:
+            query = ps2pg_query(query)
+        await _cached_prepare(state, query)
+
+
 @provider(reuse=True)
 def single_connect():
     async def job(state):
@@ -170,10 +247,12 @@ def single_connect():
         s_settings = {'application_name': state.store['app_name']}
         state.connection = await asyncpg.connect(
             server_settings=s_settings,
+            connection_class=connection_class(state),
             **state.store['setup']
         )
         for ext in state.store.get('extensions', []):
             await Extensions.apply(ext, state.connection)
+        state.share('connection', 'single_connect')
         state.store['temp_exec'] = False
         yield state
 
@@ -183,29 +262,41 @@ def single_connect():
 @provider(reuse=True)
 def pool_connect():
     async def job(state):
-        logger.debug('asyncpg connection pool initiating')
-
-        async def con_setup(connection):
-            for ext in state.store.get('extensions', []):
-                await Extensions.apply(ext, connection)
-
-        s_settings = {'application_name': state.store['app_name']}
-        state.pool = await asyncpg.create_pool(
-            server_settings=s_settings,
-            init=con_setup,
-            **state.store['setup']
-        )
+        # Contexts entered concurrently wait for the first one to create the pool
+        shared = state.parent if state.parent is not None else state
+        async with shared.store.setdefault('pool_lock', asyncio.Lock()):
+            if shared.pool is None:
+                logger.debug('asyncpg connection pool initiating')
+
+                async def con_setup(connection):
+                    for ext in state.store.get('extensions', []):
+                        await Extensions.apply(ext, connection)
+
+                s_settings = {'application_name': state.store['app_name']}
+                state.pool = await asyncpg.create_pool(
+                    server_settings=s_settings,
+                    init=con_setup,
+                    connection_class=connection_class(state),
+                    **state.store['setup']
+                )
+                state.share('pool', 'pool_connect')
+            else:
+                state.pool = shared.pool
         state.store['temp_exec'] = False
         yield state
 
     return job, default_error_handler
 
 
-@provider()
+@provider(reuse=True)
 def acquire():
     async def job(state):
         logger.debug('asyncpg acquiring connection')
+        if state.connection is not None:
+            # Retrying the whole pipeline: give back the previous connection
+            await state.pool.release(state.connection)
         state.connection = await state.pool.acquire()
+        state.store.pop('statement_cache', None)
         yield state
 
     return job, default_error_handler
@@ -223,6 +314,7 @@ def cursor():
 
 
 async def _cursor(state):
+    state.store.pop('temp_rows', None)
     args = [] if state.values is None else state.values
     if state.context & state.context.PREPARED:
         if state.query is not None:
@@ -244,12 +336,51 @@ def prepare():
 
 async def _prepare(state):
     if state.query is not None:
-        state.prepared = await state.connection.prepare(state.query)
+        state.prepared = await _cached_prepare(state, state.query)
         state.store['prepared_query'] = state.query
         logger.debug('Storing prepared query %s', state.query)
         state.query = None
 
 
+async def _cached_prepare(state, query):
+    """
+    Prepare a query, reusing the connection's statement when it already was
+    """
+    size = state.store['special'].get('statement_cache_size', STATEMENT_CACHE_SIZE)
+    if not size:
+        return await state.connection.prepare(query)
+    cache = _statement_cache(state)
+    if cache is None:
+        cache = LRUCache(size)
+        if state.pool is not None:
+            state.store['statement_cache'] = cache
+        else:
+            STATEMENT_CACHES[state.connection] = cache
+    meta = state.store['meta']
+    statement = cache.get(query)
+    if statement is not None:
+        meta['statement_hit_cntr'] += 1
+        return statement
+    meta['statement_miss_cntr'] += 1
+    statement = await state.connection.prepare(query)
+    # asyncpg deallocates evicted statements once they are garbage collected
+    cache.put(query, statement)
+    return statement
+
+
+def _statement_cache(state):
+    """
+    The statements cached for the context's connection, None if there are
+    none yet. Pools hand over connections in a new proxy on each acquisition,
+    whose statements can't be used once it's released: they are cached for
+    the acquisition only (queries run without prepare() are still cached by
+    asyncpg for the pooled connection)
+    """
+    if state.pool is not None:
+        return state.store.get('statement_cache')
+    return STATEMENT_CACHES.get(state.connection)
+
+
 @provider()
 def executemany():
 
@@ -265,18 +396,62 @@ def executemany():
     return job, default_error_handler
 
 
+@provider()
+def copy_in():
+
+    async def job(state):
+        table, columns = state.store['copy_in']
+        schema, _, table = table.rpartition('.')
+        status = await state.connection.copy_records_to_table(
+            table,
+            records=state.valuelist,
+            columns=columns,
+            schema_name=schema or None
+        )
+        state.result = int(status.split()[-1])
+        state.valuelist = None
+
+        yield state
+
+    return job, default_error_handler
+
+
+@provider()
+def copy_out():
+
+    async def job(state):
+        sink, format_ = state.store['copy_out']
+        args = [] if state.values is None else state.values
+        if callable(sink):
+            sink.restart()
+
+            async def output(data):
+                written = sink(data)
+                if inspect.isawaitable(written):
+                    await written
+        else:
+            output = sink
+        status = await state.connection.copy_from_query(state.query, *args, output=output, format=format_)
+        state.result = int(status.split()[-1])
+
+        yield state
+
+    return job, default_error_handler
+
+
 @provider()
 def execute():
 
     async def job(state):
         args = [] if state.values is None else state.values
         ctxt = state.context
+        state.store.pop('temp_rows', None)
         if ctxt & ctxt.CURSOR:
             await _cursor(state)
             state.store['temp_exec'] = True
             results = 1000 if 'n' not in state.store['special'] else state.store['special']['n']
-            logger.warning('Cursor implementation limited: only %s rows retrieved', results)
-            state.result = await state.cursor.fetch(n=10)
+            logger.debug('Cursor: at most %s rows retrieved (see stream)', results)
+            state.result = await state.cursor.fetch(n=results)
         elif ctxt & ctxt.PREPARED:
             await _prepare(state)
             state.store['temp_exec'] = True
@@ -294,7 +469,7 @@ def execute():
 @provider()
 def fetchval():
     async def job(state):
-        if state.store['temp_exec'] and state.values is None and state.query is None:
+        if state.store.get('temp_exec') and state.values is None and state.query is None:
             state.result = state.result[0][0]
         else:
             args = [] if state.values is None else state.values
@@ -321,7 +496,7 @@ def fetchval():
 def fetchone():
     async def job(state):
         args = [] if state.values is None else state.values
-        if state.store['temp_exec'] and state.values is None and state.query is None:
+        if state.store.get('temp_exec') and state.values is None and state.query is None:
             state.result = state.result[0]
         else:
             state.status()
@@ -343,18 +518,37 @@ def fetchone():
     return job, default_error_handler
 
 
+@provider()
+def fetchmany():
+    async def job(state):
+        ctxt = state.context
+        if state.query is not None or (ctxt & ctxt.PREPARED and state.values is not None):
+            if not ctxt & ctxt.CURSOR:
+                raise ProgrammingError('Impossible method call: fetchmany needs a cursor context')
+            await _cursor(state)
+        elif state.store.get('temp_exec') and isinstance(state.result, list):
+            # Rows already fetched by execute come first
+            state.store['temp_rows'] = state.result
+        state.result = await fetch_batch(state, state.store['fetch_size'])
+        state.store['temp_exec'] = True
+
+        yield state
+
+    return job, default_error_handler
+
+
 @provider()
 def fetchall():
     async def job(state):
         args = [] if state.values is None else state.values
-        if state.store['temp_exec'] and state.values is None and state.query is None:
+        if state.store.get('temp_exec') and state.values is None and state.query is None:
             state.result = state.result
         else:
             ctxt = state.context
             if ctxt & ctxt.CURSOR:
                 await _cursor(state)
                 results = 1000 if 'n' not in state.store['special'] else state.store['special']['n']
-                logger.warning('Cursor implementation limited: only %s rows retrieved', results)
+                logger.debug('Cursor: at most %s rows retrieved (see stream)', results)
                 state.result = await state.cursor.fetch(n=results)
             elif ctxt & ctxt.PREPARED:
                 await _prepare(state)
@@ -370,13 +564,53 @@ def fetchall():
     return job, default_error_handler
 
 
+@provider()
+def stream():
+    async def job(state):
+        if state.query is None and not state.context & state.context.PREPARED:
+            raise ProgrammingError('Impossible method call: missing query')
+        await _cursor(state)
+        yield state
+
+    return job, default_error_handler
+
+
+async def fetch_batch(state, size):
+    """
+    Fetch the next batch of (at most) size rows left by the executed query
+    (only cursors leave rows behind)
+    """
+    rows = state.store.pop('temp_rows', None) or []
+    if len(rows) > size:
+        state.store['temp_rows'] = rows[size:]
+        return rows[:size]
+    if state.cursor is not None and len(rows) < size:
+        rows += await state.cursor.fetch(size - len(rows))
+    return rows
+
+
+async def stream_batch(state, size):
+    """
+    Fetch the next batch of (at most size) rows from the streamed cursor
+    """
+    return await state.cursor.fetch(size)
+
+
 @provider()
 def convert_result():
     def job(state):
         sco = state.context
         if DD.DEEP ^ DD.ADAPTERS:
             print(f'$$ Output conversion, context is {sco}')
-        if state.result and isinstance(state.result, asyncpg.Record):
+        if sco & sco.OUTPUT_COLUMNAR:
+            if DD.DEEP ^ DD.ADAPTERS:
+                print(f'$$ Output conversion, converting to columns')
+            if isinstance(state.result, asyncpg.Record):
+                state.result = dict(state.result)
+            elif isinstance(state.result, list):
+                names = list(state.result[0].keys()) if state.result else []
+                state.result = columnar(state.result, names)
+        elif state.result and isinstance(state.result, asyncpg.Record):
             if sco & sco.OUTPUT_DICT:
                 if DD.DEEP ^ DD.ADAPTERS:
                     print(f'$$ Output conversion, converting to dict')
@@ -395,7 +629,6 @@ def convert_result():
                 if DD.DEEP ^ DD.ADAPTERS:
                     print(f'$$ Output conversion, converting to list')
                 for i, row in enumerate(state.result):
-                    print('Changed !')
                     state.result[i] = list(row)
         yield state
 
@@ -419,6 +652,17 @@ def convert_input():
                     state.store['prepared_query'], state.values = ps2pg(state.store['prepared_query'], state.values)
             if DD.DEEP ^ DD.ADAPTERS:
                 print(f'$$ Input conversion AFTER: query "{state.query}" values "{state.values}"')
+        elif state.valuelist is not None:
+            if state.context & state.context.QUERY_ARGS_PSYCOPG2 and state.query and '$' not in state.query:
+                valuelist = list(state.valuelist)
+                if valuelist and isinstance(valuelist[0], dict):
+                    # Named arguments: each set of values has to be ordered
+                    query = state.query
+                    state.query, _ = ps2pg(query, valuelist[0])
+                    valuelist = [ps2pg(query, values)[1] for values in valuelist]
+                elif valuelist:
+                    state.query, _ = ps2pg(state.query, tuple(valuelist[0]))
+                state.valuelist = valuelist
 
         yield state
 
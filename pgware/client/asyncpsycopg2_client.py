@@ -1,33 +1,43 @@
 import asyncio
-import select
-from collections import namedtuple
+import hashlib
+import itertools
+import random
+import string
+
 import psycopg2
+import psycopg2.errors
 import psycopg2.extensions
 import psycopg2.extras
-from psycopg2.extras import Json as pgJson
+
 from pgware import (
-    provider,
-    UnrecoverableError,
-    logger,
     Context as C,
-    pg2ps,
-    DD,
+    ProgrammingError,
+    PublicError,
+    QueryError,
+    logger,
+    provider,
 )
+from pgware.client import psycopg2_client as pg2
+from pgware.utils import ps2pg_query
 
 """
 PGWare asynchronous psycopg2 client definition file
 
-WORK IN PROGRESS
+Connections are opened in psycopg2's asynchronous mode, and waited for on
+the event loop (see wait): queries of concurrent contexts overlap without
+a thread each. Asynchronous connections are always in autocommit mode and
+can't COPY: prepared statements, streams and executemany are run with SQL
+statements (PREPARE/EXECUTE, DECLARE/FETCH, multi-statement queries).
 """
 
 # ## API for integration with PGWare
 __backend__ = 'asyncpsycopg2'
-__supports__ = C.CURSOR | C.SINGLE | C.OUTPUT_DICT | C.QUERY_ARGS_POSTGRESQL | C.QUERY_ARGS_PSYCOPG2 | C.JSON | C.POOLED
+__supports__ = C.CURSOR | C.SINGLE | C.POOLED | C.PREPARED | C.OUTPUT_DICT | C.QUERY_ARGS_POSTGRESQL | C.QUERY_ARGS_PSYCOPG2 | C.JSON | C.OUTPUT_LIST | C.OUTPUT_NATIVE | C.OUTPUT_COLUMNAR
 
 
 # Map format: {ADAPTER_KEY: [PGWARE_KEY, DEFAULT_VALUE] | ...}
-def __config_map__(_context):
-    return {
+def __config_map__(context):
+    config = {
         'dbname': ['database', None],
         'user': ['user', None],
         'password': ['password', None],
@@ -35,36 +45,139 @@ def __config_map__(_context):
         'port': ['port', None],
         'connect_timeout': ['timeout', 3],
         'application_name': ['app_name', 'pgware'],
-        'max_size': ['max_size', 5],
         # 'XXXX' to force default value in config dict
-        'async': ['XXXX', True]
+        'async_': ['XXXX', True]
     }
+    if context & context.POOLED:
+        # Taken out of the connection settings by pool_connect
+        config.update({
+            'min_size': ['min_size', 1],
+            'max_size': ['max_size', 5],
+        })
+    return config
 # ##
 
 
-PoolCon = namedtuple(
-    'PoolCon',
-    'free, conn'
-)
+# Input & result conversions are the psycopg2 client's: same values, same rows
+Extensions = pg2.Extensions
+convert_input = pg2.convert_input
+convert_result = pg2.convert_result
+fetch_batch = pg2.fetch_batch
 
 
-class Extensions():
-    @staticmethod
-    def apply(name, state):
-        logger.debug('Extension "%s" enabled', name)
-        if name == 'dec2float':
-            Extensions.dec2float(state)
+class ConnectionPool():
+    """
+    Pool of asynchronous psycopg2 connections, used from one event loop:
+    min_size connections are opened (concurrently) by open, up to max_size
+    on demand, acquire waits for one to be released once they all are in use
+    """
+    def __init__(self, connect, min_size, max_size):
+        self._connect = connect
+        self._min_size = min_size
+        self._max_size = max(max_size, 1)
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._released = asyncio.Condition()
+
+    async def open(self):
+        count = min(self._min_size, self._max_size) - self._size
+        self._size += count
+        try:
+            self._idle += await asyncio.gather(*[self._connect() for _ in range(count)])
+        except BaseException:
+            self._size -= count
+            raise
+
+    async def acquire(self):
+        async with self._released:
+            while True:
+                if self._closed:
+                    raise ProgrammingError('Connection pool is closed')
+                if self._idle:
+                    connection = self._idle.pop()
+                    if not connection.closed:
+                        return connection
+                    self._size -= 1
+                    continue
+                if self._size < self._max_size:
+                    self._size += 1
+                    break
+                await self._released.wait()
+        try:
+            return await self._connect()
+        except BaseException:
+            async with self._released:
+                self._size -= 1
+                self._released.notify()
+            raise
+
+    async def release(self, connection):
+        """
+        Give a connection back: the transaction it was left in is rolled
+        back, if any, and it is closed if it is broken
+        """
+        if not connection.closed and connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('ROLLBACK')
+                    await wait(connection)
+            except psycopg2.Error:
+                connection.close()
+        async with self._released:
+            if connection.closed or self._closed:
+                connection.close()
+                self._size -= 1
+            else:
+                self._idle.append(connection)
+            self._released.notify()
+
+    async def close(self):
+        async with self._released:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._released.notify_all()
+        for connection in idle:
+            connection.close()
+
+
+async def wait(connection):
+    """
+    Wait for the connection's pending operation to complete: the event loop
+    is told to wake us up when its socket is ready, instead of blocking a
+    thread. A cancelled wait closes the connection, left mid-query.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        status = connection.poll()
+        if status == psycopg2.extensions.POLL_OK:
+            return
+        fileno = connection.fileno()
+        ready = loop.create_future()
+        if status == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fileno, _ready, ready)
+            remove = loop.remove_reader
+        elif status == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fileno, _ready, ready)
+            remove = loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f'bad state from poll: {status}')
+        try:
+            await ready
+        except asyncio.CancelledError:
+            connection.close()
+            raise
+        finally:
+            remove(fileno)
+
 
-    @staticmethod
-    def dec2float(_s):
-        dec2float = psycopg2.extensions.new_type(
-            psycopg2.extensions.DECIMAL.values,
-            'DEC2FLOAT',
-            lambda value, curs: float(value) if value is not None else None)
-        psycopg2.extensions.register_type(dec2float)
+def _ready(future):
+    if not future.done():
+        future.set_result(None)
 
 
-def default_error_handler(ex, state):
+async def default_error_handler(ex, state):
     """
     Handle adapter-specific exceptions and tell pgware
     return pgware-specific exceptions if applicable
@@ -74,44 +187,153 @@ def default_error_handler(ex, state):
 
     return: exception | None
     """
+    if state.transaction and not state.connection.closed:
+        state.store.pop('named_cursor', None)
+        state.transaction = None
+        await _run(state, 'ROLLBACK')
+        logger.warning('asyncpsycopg2 transaction rolled back')
+    if isinstance(ex, (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.DuplicatePreparedStatement)):
+        # Prepared statements out of sync with the server (ie: DISCARD ALL):
+        # start over, they are prepared again on retry. Statements prepared
+        # by others on the connection are left alone
+        logger.warning('asyncpsycopg2: prepared statements lost, preparing them again')
+        state.prepared = None
+        statements = pg2.STATEMENTS.pop(state.connection, None)
+        if statements is not None and not state.connection.closed:
+            cursor = state.connection.cursor()
+            cursor.execute('SELECT name FROM pg_prepared_statements WHERE name = ANY(%s)', (statements.values(),))
+            await wait(state.connection)
+            for (name,) in cursor.fetchall():
+                await _run(state, f'DEALLOCATE {name}')
+        return None
+    if isinstance(ex, PublicError):
+        return ex
+    if not isinstance(ex, psycopg2.Error):
+        # Unhandled exception, raise it
+        logger.exception(ex)
+        return ProgrammingError(ex)
     if isinstance(ex, psycopg2.ProgrammingError):
-        logger.warning('Programming error not recoverable')
-        return UnrecoverableError(ex)
+        logger.warning('asyncpsycopg2: ProgrammingError not recoverable')
+        logger.exception(ex)
+        return QueryError(str(ex))
+    if isinstance(ex, psycopg2.DataError):
+        logger.warning('asyncpsycopg2: DataError not recoverable')
+        return QueryError(str(ex))
+    if isinstance(ex, psycopg2.OperationalError):
+        logger.info('asyncpsycopg2: OperationalError occured, recovering')
+    if isinstance(ex, psycopg2.InterfaceError):
+        logger.info('asyncpsycopg2: InterfaceError occured, recovering')
     return None
 
 
 async def close_context(state):
-    pass
+    await close_stream(state)
+    if 'temp_exec' in state.store:
+        del state.store['temp_exec']
+    if state.pool and state.connection:
+        if state.cursor is not None:
+            state.cursor.close()
+        await state.pool.release(state.connection)
+        state.connection = state.cursor = None
+
+
+async def stream_batch(state, size):
+    """
+    Fetch the next batch of (at most) size rows from the streamed SQL cursor
+    """
+    name, cursor = state.store['named_cursor']
+    cursor.execute(f'FETCH {int(size)} FROM {name}')
+    await wait(state.connection)
+    return cursor.fetchall()
+
+
+async def close_stream(state):
+    named = state.store.pop('named_cursor', None)
+    if named is not None:
+        named[1].close()
+    if state.transaction:
+        state.transaction = None
+        if state.connection.closed:
+            return
+        await _run(state, 'COMMIT')
 
 
 async def close_connection(state):
-    if state.connection:
-        logger.debug('Closing psycopg2 connection')
+    if state.pool:
+        logger.debug('Closing asyncpsycopg2 pooled connections')
+        await state.pool.close()
+    elif state.connection:
+        logger.debug('Closing asyncpsycopg2 connection')
         state.connection.close()
 
 
-async def wait_async(status=None, *, connection=None):
-    conn = status.connection if status else connection
-    loop = asyncio.get_event_loop()
-    while 1:
-        state = conn.poll()
-        if state == psycopg2.extensions.POLL_OK:
-            break
-        elif state == psycopg2.extensions.POLL_READ:
-            await loop.run_in_executor(None, lambda: select.select([conn.fileno()], [], []))
-        elif state == psycopg2.extensions.POLL_WRITE:
-            await loop.run_in_executor(None, lambda: select.select([], [conn.fileno()], []))
-        else:
-            raise psycopg2.OperationalError("bad state from poll: %s" % state)
+async def prepare_statements(state, queries):
+    """
+    Prepare queries on the context's connection ahead of their use by prepare()
+    """
+    for query in queries:
+        if not state.context & state.context.QUERY_ARGS_POSTGRESQL and '$' not in query:
+            query = ps2pg_query(query)
+        await _prepare(state, query)
+
+
+async def _connect(state, setup):
+    connection = psycopg2.connect(**setup)
+    await wait(connection)
+    for ext in state.store.get('extensions', []):
+        Extensions.apply(ext, state)
+    return connection
+
+
+async def _execute(state):
+    query, values = state.query, state.values
+    if state.context & state.context.PREPARED:
+        if values is None:
+            # Fetching what the statement's last execution left on the cursor
+            return
+        if state.prepared is None:
+            # Lost, see default_error_handler
+            state.prepared = await _prepare(state, state.query)
+        mask = ", ".join(['%s'] * len(values))
+        query = f'EXECUTE {state.prepared} ({mask})'
+    await _run(state, query, values)
+
+
+async def _run(state, query, values=None):
+    cursor = state.cursor or state.connection.cursor()
+    cursor.execute(query, values)
+    await wait(state.connection)
+
+
+async def _prepare(state, query):
+    """
+    Return the name of the query's statement, prepared on the connection if
+    it wasn't yet (see the psycopg2 client, whose registry is shared)
+    """
+    statements = pg2.STATEMENTS.get(state.connection)
+    if statements is None:
+        size = state.store['special'].get('statement_cache_size', pg2.STATEMENT_CACHE_SIZE)
+        statements = pg2.STATEMENTS[state.connection] = pg2.LRUCache(max(size, 1))
+    name = statements.get(query)
+    if name is not None:
+        state.store['meta']['statement_hit_cntr'] += 1
+        return name
+    state.store['meta']['statement_miss_cntr'] += 1
+    name = 'pgware_' + hashlib.sha1(query.encode()).hexdigest()[:20]
+    await _run(state, f'PREPARE {name} AS {query}')
+    evicted = statements.put(query, name)
+    if evicted is not None:
+        logger.debug('Deallocating prepared statement %s', evicted[1])
+        await _run(state, f'DEALLOCATE {evicted[1]}')
+    return name
 
 
 @provider(reuse=True)
 def single_connect():
-    def job(state):
-        state.connection = psycopg2.connect(**state.store['setup'])
-        state.connection.autocommit = True
-        for ext in state.store.get('extensions', []):
-            Extensions.apply(ext, state)
+    async def job(state):
+        logger.debug('asyncpsycopg2 single connect initiating')
+        state.connection = await _connect(state, state.store['setup'])
+        state.share('connection', 'single_connect')
         yield state
 
     return job, default_error_handler
@@ -120,31 +342,33 @@ def single_connect():
 @provider(reuse=True)
 def pool_connect():
     async def job(state):
-        logger.debug('psycopg2 connection pool initiating')
-
-        size = state.store['max_size']
-        del state.store['max_size']
-        for _ in range(0, size):
-            newc = psycopg2.connect(**state.store['setup'])
-            await wait_async(connection=newc)
-            state.pool.append(PoolCon(free=True, conn=newc))
-
+        # Contexts entered concurrently wait for the first one to create the pool
+        shared = state.parent if state.parent is not None else state
+        async with shared.store.setdefault('pool_lock', asyncio.Lock()):
+            if shared.pool is None:
+                logger.debug('asyncpsycopg2 connection pool initiating')
+                setup = dict(state.store['setup'])
+                min_size, max_size = setup.pop('min_size'), setup.pop('max_size')
+                pool = ConnectionPool(lambda: _connect(shared, setup), min_size, max_size)
+                await pool.open()
+                state.pool = pool
+                state.share('pool', 'pool_connect')
+            else:
+                state.pool = shared.pool
         yield state
 
     return job, default_error_handler
 
 
-@provider()
+@provider(reuse=True)
 def acquire():
     async def job(state):
-        logger.debug('psycogp2 acquiring connection')
-        pooll = len(state.pool)
-        for i in range(0, pooll):
-            conn = state.pool[i]
-            state = conn.poll()
-            if state == psycopg2.extensions.POLL_OK:
-                state.connection = conn
-            await asyncio.sleep(.001)
+        logger.debug('asyncpsycopg2 acquiring connection')
+        if state.connection is not None:
+            # Retrying the whole pipeline: give back the previous connection
+            await state.pool.release(state.connection)
+        state.connection = await state.pool.acquire()
+        yield state
 
     return job, default_error_handler
 
@@ -153,9 +377,19 @@ def acquire():
 def cursor():
     async def job(state):
         state.cursor = state.connection.cursor(
-            cursor_factory=psycopg2.extras.RealDictCursor
+            cursor_factory=psycopg2.extras.DictCursor
         )
-        await wait_async(state)
+        yield state
+
+    return job, default_error_handler
+
+
+@provider()
+def prepare():
+    async def job(state):
+        if state.context & state.context.PREPARED:
+            state.prepared = await _prepare(state, state.query)
+
         yield state
 
     return job, default_error_handler
@@ -164,8 +398,85 @@ def cursor():
 @provider()
 def execute():
     async def job(state):
-        state.cursor.execute(state.query, state.values)
-        await wait_async(state)
+        if state.query is not None:
+            await _execute(state)
+        state.store['temp_exec'] = True
+        yield state
+
+    return job, default_error_handler
+
+
+@provider()
+def executemany():
+    async def job(state):
+        # executemany can't be used in asynchronous mode: pages of
+        # statements are sent as one multi-statement query instead
+        page_size, rewrite, exact = state.store['executemany']
+        rewritten = pg2._values_template(state.query) if rewrite else None
+        paged = rewritten is None and page_size > 1
+        counted = paged and exact and pg2._countable(state.query)
+        batched = paged and not exact
+        # Others are executed one by one
+        page_size = max(page_size, 1) if rewritten is not None or batched or counted else 1
+        mogrify = state.cursor.mogrify
+        rowcount = 0
+        records = iter(state.valuelist)
+        page = list(itertools.islice(records, page_size))
+        while page:
+            if rewritten is not None:
+                # One multi-row INSERT per page: rowcounts add up
+                sql, template = rewritten
+                rows = b','.join(mogrify(template, values) for values in page).decode()
+                await _run(state, sql, (psycopg2.extensions.AsIs(rows),))
+            elif counted:
+                # One DO block per page, adding up the statements' rowcounts
+                await _run(state, pg2._counted_page([mogrify(state.query, values) for values in page]))
+            elif batched:
+                await _run(state, b';'.join(mogrify(state.query, values) for values in page))
+            else:
+                await _run(state, state.query, page[0])
+            rowcount += state.cursor.fetchone()[0] if counted else state.cursor.rowcount
+            page = list(itertools.islice(records, page_size))
+        state.valuelist = None
+        # Multi-statement queries only report the last statement's rowcount
+        state.result = -1 if batched else rowcount
+        yield state
+
+    return job, default_error_handler
+
+
+@provider()
+def copy_in():
+    async def job(state):
+        raise ProgrammingError('COPY can not be used by asyncpsycopg2 (asynchronous psycopg2 connections)')
+        yield state  # pylint: disable=unreachable
+
+    return job, default_error_handler
+
+
+@provider()
+def copy_out():
+    async def job(state):
+        raise ProgrammingError('COPY can not be used by asyncpsycopg2 (asynchronous psycopg2 connections)')
+        yield state  # pylint: disable=unreachable
+
+    return job, default_error_handler
+
+
+@provider()
+def stream():
+    async def job(state):
+        if state.query is None or state.context & state.context.PREPARED:
+            raise ProgrammingError('Impossible method call: streams need a (not prepared) query')
+        if not state.transaction:
+            # SQL cursors live in a transaction, committed when the stream is closed
+            await _run(state, 'BEGIN')
+            state.transaction = state.connection
+        name = 'pgware_' + ''.join(random.choice(string.ascii_letters) for _ in range(10))
+        cursor = state.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        state.store['named_cursor'] = (name, cursor)
+        cursor.execute(f'DECLARE {name} NO SCROLL CURSOR FOR {state.query}', state.values)
+        await wait(state.connection)
         yield state
 
     return job, default_error_handler
@@ -174,10 +485,9 @@ def execute():
 @provider()
 def fetchval():
     async def job(state):
+        if state.query is not None:
+            await _execute(state)
         row = state.cursor.fetchone()
-        await wait_async(state)
-        if isinstance(row, dict):
-            row = list(row.values())
         state.result = row[0]
         yield state
 
@@ -188,8 +498,7 @@ def fetchval():
 def fetchone():
     async def job(state):
         if state.query is not None:
-            state.cursor.execute(state.query, state.values)
-            await wait_async(state)
+            await _execute(state)
         state.result = state.cursor.fetchone()
         yield state
 
@@ -197,33 +506,23 @@ def fetchone():
 
 
 @provider()
-def fetchall():
+def fetchmany():
     async def job(state):
-        state.result = state.cursor.fetchall()
+        if state.query is not None:
+            await _execute(state)
+        state.result = state.cursor.fetchmany(state.store['fetch_size'])
+        state.store['temp_exec'] = True
         yield state
 
     return job, default_error_handler
 
 
 @provider()
-def convert_input():
-    def job(state):
-        if state.values is not None:
-            if DD.DEEP ^ DD.ADAPTERS:
-                print(f'$$ Input conversion BEFORE: query "{state.query}" values "{state.values}"')
-            if state.context & state.context.QUERY_ARGS_POSTGRESQL:
-                if DD.DEEP ^ DD.ADAPTERS:
-                    print('$$ PG=>PS syntax conversion')
-                state.query, state.values = pg2ps(state.query, state.values)
-            if state.context & state.context.JSON:
-                if DD.DEEP ^ DD.ADAPTERS:
-                    print('$$ JSON value conversion')
-                if isinstance(state.values, dict):
-                    state.values = {k: pgJson(v) if isinstance(v, (dict, list)) else v for k, v in state.values.items()}
-                if isinstance(state.values, (list, tuple)):
-                    state.values = [pgJson(v) if isinstance(v, (dict, list)) else v for v in state.values]
-            if DD.DEEP ^ DD.ADAPTERS:
-                print(f'$$ Input conversion AFTER: query "{state.query}" values "{state.values}"')
+def fetchall():
+    async def job(state):
+        if state.query is not None:
+            await _execute(state)
+        state.result = state.cursor.fetchall()
         yield state
 
     return job, default_error_handler
@@ -1,21 +1,37 @@
+import csv
+import datetime
+import decimal
+import hashlib
+import io
+import itertools
+import json
+import math
 import random
+import re
 import string
+import threading
+import time
+import weakref
 
 import psycopg2
+import psycopg2.errors
 import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.sql
 from psycopg2.extras import Json as pgJson
 
 from pgware import (
     DD,
     Context as C,
     ProgrammingError,
+    PublicError,
     QueryError,
     logger,
     pg2ps,
     provider,
     ps2pg,
 )
+from pgware.utils import LRUCache, cast_params, columnar, pg2ps_query, ps2pg_query
 
 """
 PGWare psycopg2 client definition file
@@ -23,12 +39,12 @@ PGWare psycopg2 client definition file
 
 # ## API for integration with PGWare
 __backend__ = 'psycopg2'
-__supports__ = C.CURSOR | C.SINGLE | C.PREPARED | C.OUTPUT_DICT | C.QUERY_ARGS_POSTGRESQL | C.QUERY_ARGS_PSYCOPG2 | C.JSON | C.OUTPUT_LIST | C.OUTPUT_NATIVE
+__supports__ = C.CURSOR | C.SINGLE | C.POOLED | C.PREPARED | C.OUTPUT_DICT | C.QUERY_ARGS_POSTGRESQL | C.QUERY_ARGS_PSYCOPG2 | C.JSON | C.OUTPUT_LIST | C.OUTPUT_NATIVE | C.OUTPUT_COLUMNAR
 
 
 # Map format: {ADAPTER_KEY: [PGWARE_KEY, DEFAULT_VALUE] | ...}
-def __config_map__(_context):
-    return {
+def __config_map__(context):
+    config = {
         'dbname': ['database', None],
         'user': ['user', None],
         'password': ['password', None],
@@ -37,9 +53,67 @@ def __config_map__(_context):
         'connect_timeout': ['timeout', 3],
         'application_name': ['app_name', 'pgware'],
     }
+    if context & context.POOLED:
+        # Taken out of the connection settings by pool_connect
+        config.update({
+            'min_size': ['min_size', 1],
+            'max_size': ['max_size', 5],
+            'pool_timeout': ['pool_timeout', 30],
+        })
+    return config
 # ##
 
 
+# Prepared statements kept per connection (see special 'statement_cache_size')
+STATEMENT_CACHE_SIZE = 100
+# Executions after which a query is prepared (see special 'prepare_threshold')
+PREPARE_THRESHOLD = 5
+HOT_QUERIES_SIZE = 1000
+PREPARABLE_RE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b', re.IGNORECASE)
+COPY_BUFFER_SIZE = 2 ** 16
+COPY_ROWS_PER_WRITE = 100
+COUNTABLE_RE = re.compile(r'^\s*(INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+RETURNING_RE = re.compile(r'\bRETURNING\b', re.IGNORECASE)
+VALUES_RE = re.compile(r'^\s*INSERT\s+INTO\s+[\w."]+\s*(\([^()]*\))?\s*VALUES\s*\(', re.IGNORECASE)
+
+
+def _integer_type(value):
+    # Type of an integer constant: negative ones are negated constants
+    magnitude = abs(value)
+    if magnitude < 2 ** 31:
+        return 'integer'
+    return 'bigint' if magnitude < 2 ** 63 else 'numeric'
+
+
+# Type of the literals psycopg2 adapts values into, given to the parameters
+# of hot queries: None for untyped literals (quoted strings, NULL), resolved
+# by the server the way parameters are
+PARAM_TYPES = {
+    type(None): None,
+    str: None,
+    pgJson: None,
+    bool: 'boolean',
+    int: _integer_type,
+    float: lambda value: 'numeric' if math.isfinite(value) else 'double precision',
+    decimal.Decimal: lambda value: (
+        _integer_type(int(value)) if value.is_finite() and value.as_tuple().exponent == 0 else 'numeric'
+    ),
+    datetime.date: 'date',
+    datetime.datetime: lambda value: 'timestamp' if value.tzinfo is None else 'timestamptz',
+    datetime.time: lambda value: 'time' if value.tzinfo is None else 'timetz',
+    datetime.timedelta: 'interval',
+    bytes: 'bytea',
+    bytearray: 'bytea',
+    memoryview: 'bytea',
+}
+
+
+# Connection => LRUCache of query => prepared statement name
+STATEMENTS = weakref.WeakKeyDictionary()
+# Connection => LRUCache of query => executions count (-1: can't be prepared)
+HOT_QUERIES = weakref.WeakKeyDictionary()
+
+
 class Extensions():
     @staticmethod
     def apply(name, state):
@@ -56,7 +130,161 @@ class Extensions():
         psycopg2.extensions.register_type(dec2float)
 
 
-async def default_error_handler(ex, state):
+class CopyNull(int):
+    """
+    NULL value for COPY ... CSV: written unquoted (as a number) and empty
+    by csv writers in QUOTE_NONNUMERIC mode
+    """
+    def __str__(self):
+        return ''
+
+
+def _copy_array(values):
+    """
+    Postgres array literal of a (nested) list: elements but NULL are
+    quoted, which the input function of every element type accepts
+    """
+    return '{' + ','.join(_copy_array_element(value) for value in values) + '}'
+
+
+def _copy_array_element(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, list):
+        return _copy_array(value)
+    adapter = COPY_ADAPTERS.get(type(value))
+    text = str(value) if adapter is None else adapter(value)
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+COPY_NULL = CopyNull()
+COPY_ADAPTERS = {
+    type(None): lambda _value: COPY_NULL,
+    dict: json.dumps,
+    list: _copy_array,
+    bytes: lambda value: '\\x' + value.hex(),
+    bytearray: lambda value: '\\x' + value.hex(),
+    memoryview: lambda value: '\\x' + value.hex(),
+}
+
+
+class CopyBuffer():
+    """
+    File-like object serving records as CSV while they are read by
+    copy_expert, so that only a few of them are held in memory at once
+    """
+    def __init__(self, records):
+        adapter = COPY_ADAPTERS.get
+        self._rows = (
+            [value if adapter(type(value)) is None else adapter(type(value))(value) for value in record]
+            for record in records
+        )
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+
+    def read(self, size=-1):
+        # Like files, a negative (or no) size reads all that's left
+        drain = size is None or size < 0
+        buffer = self._buffer
+        buffer.seek(0)
+        buffer.truncate()
+        while drain or buffer.tell() < size:
+            batch = [row for _, row in zip(range(COPY_ROWS_PER_WRITE), self._rows)]
+            if not batch:
+                break
+            self._writer.writerows(batch)
+        return buffer.getvalue()
+
+
+class CopyWriter():
+    """
+    File-like object handing the data read by copy_expert over to a writer
+    """
+    def __init__(self, write):
+        self.write = write
+
+
+class ConnectionPool():
+    """
+    Thread-safe pool of psycopg2 connections: min_size connections are
+    opened up front and up to max_size on demand, acquire waits for one to
+    be released once they all are in use
+    """
+    def __init__(self, connect, min_size, max_size, timeout):
+        self._connect = connect
+        self._max_size = max(max_size, 1)
+        self._timeout = timeout
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Condition()
+        for _ in range(min(min_size, self._max_size)):
+            self._idle.append(connect())
+            self._size += 1
+
+    def acquire(self):
+        deadline = time.monotonic() + self._timeout
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise ProgrammingError('Connection pool is closed')
+                if self._idle:
+                    connection = self._idle.pop()
+                    if not connection.closed:
+                        return connection
+                    self._size -= 1
+                    continue
+                if self._size < self._max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise psycopg2.OperationalError(f'No pooled connection released within {self._timeout}s')
+                self._lock.wait(remaining)
+        try:
+            return self._connect()
+        except BaseException:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, connection):
+        """
+        Give a connection back: its transaction is rolled back, if any, and
+        it is closed if it is broken
+        """
+        if not connection.closed:
+            try:
+                idle = connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                if not idle and connection.autocommit:
+                    # Transaction started by a query: rollback() is a no-op in autocommit mode
+                    with connection.cursor() as cursor:
+                        cursor.execute('ROLLBACK')
+                elif not idle:
+                    connection.rollback()
+                connection.autocommit = True
+            except psycopg2.Error:
+                connection.close()
+        with self._lock:
+            if connection.closed or self._closed:
+                connection.close()
+                self._size -= 1
+            else:
+                self._idle.append(connection)
+            self._lock.notify()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._lock.notify_all()
+        for connection in idle:
+            connection.close()
+
+
+def default_error_handler(ex, state):
     """
     Handle adapter-specific exceptions and tell pgware
     return pgware-specific exceptions if applicable
@@ -66,6 +294,27 @@ async def default_error_handler(ex, state):
 
     return: exception | None
     """
+    if state.transaction and not state.connection.closed:
+        state.connection.rollback()
+        state.connection.autocommit = True
+        state.transaction = None
+        state.store.pop('named_cursor', None)
+        logger.warning('psycopg2 transaction rolled back')
+    if isinstance(ex, (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.DuplicatePreparedStatement)):
+        # Prepared statements out of sync with the server (ie: DISCARD ALL):
+        # start over, they are prepared again on retry. Statements prepared
+        # by others on the connection are left alone
+        logger.warning('psycopg2: prepared statements lost, preparing them again')
+        state.prepared = None
+        statements = STATEMENTS.pop(state.connection, None)
+        if statements is not None and not state.connection.closed:
+            with state.connection.cursor() as cursor:
+                cursor.execute('SELECT name FROM pg_prepared_statements WHERE name = ANY(%s)', (statements.values(),))
+                for (name,) in cursor.fetchall():
+                    cursor.execute(f'DEALLOCATE {name}')
+        return None
+    if isinstance(ex, PublicError):
+        return ex
     if not isinstance(ex, psycopg2.Error):
         # Unhandled exception, raise it
         logger.exception(ex)
@@ -84,24 +333,119 @@ async def default_error_handler(ex, state):
     return None
 
 
-async def close_context(state):
+def close_context(state):
+    close_stream(state)
     if 'temp_exec' in state.store:
         del state.store['temp_exec']
+    if state.pool and state.connection:
+        if state.cursor is not None:
+            state.cursor.close()
+        state.pool.release(state.connection)
+        state.connection = state.cursor = None
 
 
-async def close_connection(state):
-    if state.connection:
+def fetch_batch(state, size):
+    """
+    Fetch the next batch of (at most) size rows left by the executed query
+    """
+    if state.cursor is None or state.cursor.description is None:
+        return []
+    return state.cursor.fetchmany(size)
+
+
+def stream_batch(state, size):
+    """
+    Fetch the next batch of (at most) size rows from the streamed named cursor
+    """
+    return state.store['named_cursor'].fetchmany(size)
+
+
+def close_stream(state):
+    named = state.store.pop('named_cursor', None)
+    if named is not None and not named.closed:
+        named.close()
+    if state.transaction:
+        state.connection.commit()
+        state.connection.autocommit = True
+        state.transaction = None
+
+
+def close_connection(state):
+    if state.pool:
+        logger.debug('Closing psycopg2 pooled connections')
+        state.pool.close()
+    elif state.connection:
         logger.debug('Closing psycopg2 connection')
         state.connection.close()
 
 
+def prepare_statements(state, queries):
+    """
+    Prepare queries on the context's connection ahead of their use by
+    prepare(), and mark them as hot queries: prepared on their first
+    execution, once the types of their values are known
+    """
+    threshold = state.store['special'].get('prepare_threshold', PREPARE_THRESHOLD)
+    counts = HOT_QUERIES.get(state.connection)
+    if counts is None:
+        counts = HOT_QUERIES[state.connection] = LRUCache(HOT_QUERIES_SIZE)
+    for query in queries:
+        if state.context & state.context.QUERY_ARGS_POSTGRESQL:
+            pg_query, ps_query = query, pg2ps_query(query)
+        else:
+            pg_query, ps_query = ps2pg_query(query), query
+        _prepare(state, pg_query)
+        if threshold is None or not _preparable(ps_query, ()):
+            continue
+        if 0 <= (counts.get(ps_query) or 0) < threshold:
+            counts.put(ps_query, threshold)
+
+
+def _connect(state, setup):
+    connection = psycopg2.connect(**setup)
+    connection.autocommit = True
+    for ext in state.store.get('extensions', []):
+        Extensions.apply(ext, state)
+    return connection
+
+
 @provider(reuse=True)
 def single_connect():
     def job(state):
-        state.connection = psycopg2.connect(**state.store['setup'])
-        state.connection.autocommit = True
-        for ext in state.store.get('extensions', []):
-            Extensions.apply(ext, state)
+        state.connection = _connect(state, state.store['setup'])
+        state.share('connection', 'single_connect')
+        yield state
+
+    return job, default_error_handler
+
+
+@provider(reuse=True)
+def pool_connect():
+    def job(state):
+        # Contexts entered concurrently (from other threads) wait for the first one to create the pool
+        shared = state.parent if state.parent is not None else state
+        with shared.store.setdefault('pool_lock', threading.Lock()):
+            if shared.pool is None:
+                logger.debug('psycopg2 connection pool initiating')
+                setup = dict(state.store['setup'])
+                min_size, max_size, timeout = setup.pop('min_size'), setup.pop('max_size'), setup.pop('pool_timeout')
+                state.pool = ConnectionPool(lambda: _connect(shared, setup), min_size, max_size, timeout)
+                state.share('pool', 'pool_connect')
+            else:
+                state.pool = shared.pool
+        yield state
+
+    return job, default_error_handler
+
+
+@provider(reuse=True)
+def acquire():
+    def job(state):
+        logger.debug('psycopg2 acquiring connection')
+        if state.connection is not None:
+            # Retrying the whole pipeline: give back the previous connection
+            state.pool.release(state.connection)
+        state.connection = state.pool.acquire()
         yield state
 
     return job, default_error_handler
@@ -118,12 +462,11 @@ def cursor():
     return job, default_error_handler
 
 
-@provider(reuse=True)
+@provider()
 def prepare():
-    async def job(state):
-        state.prepared = ''.join(random.choice(string.ascii_letters) for _ in range(10))
-        prep_sql = f'PREPARE {state.prepared} AS {state.query}'
-        state.cursor.execute(prep_sql)
+    def job(state):
+        if state.context & state.context.PREPARED:
+            state.prepared = _prepare(state, state.query)
 
         yield state
 
@@ -143,14 +486,98 @@ def execute():
 @provider()
 def executemany():
 
-    async def job(state):
-        i = 0
-        for values in state.valuelist:
-            state.cursor.execute(state.query, values)
-            i += 1
+    def job(state):
+        page_size, rewrite, exact = state.store['executemany']
+        rewritten = _values_template(state.query) if rewrite else None
+        if rewritten is not None:
+            # One multi-row INSERT per page: rowcounts add up
+            sql, template = rewritten
+            rowcount = 0
+            records = iter(state.valuelist)
+            page = list(itertools.islice(records, page_size))
+            while page:
+                psycopg2.extras.execute_values(state.cursor, sql, page, template=template, page_size=page_size)
+                rowcount += state.cursor.rowcount
+                page = list(itertools.islice(records, page_size))
+        elif page_size > 1 and exact and _countable(state.query):
+            # One DO block per page, adding up the statements' rowcounts
+            rowcount = 0
+            records = iter(state.valuelist)
+            page = list(itertools.islice(records, page_size))
+            while page:
+                state.cursor.execute(_counted_page([state.cursor.mogrify(state.query, values) for values in page]))
+                rowcount += state.cursor.fetchone()[0]
+                page = list(itertools.islice(records, page_size))
+        elif page_size > 1 and not exact:
+            # Pages are sent as multi-statement queries, which only report
+            # the last statement's rowcount
+            psycopg2.extras.execute_batch(state.cursor, state.query, state.valuelist, page_size=page_size)
+            rowcount = -1
+        else:
+            rowcount = 0
+            for values in state.valuelist:
+                state.cursor.execute(state.query, values)
+                rowcount += state.cursor.rowcount
         state.valuelist = None
-        state.result = i
+        state.result = rowcount
+
+        yield state
 
+    return job, default_error_handler
+
+
+@provider()
+def copy_in():
+    def job(state):
+        table, columns = state.store['copy_in']
+        sql = psycopg2.sql.SQL('COPY {} {} FROM STDIN WITH (FORMAT csv)').format(
+            psycopg2.sql.Identifier(*table.split('.')),
+            psycopg2.sql.SQL('({})').format(
+                psycopg2.sql.SQL(', ').join(psycopg2.sql.Identifier(column) for column in columns)
+            ) if columns else psycopg2.sql.SQL('')
+        )
+        state.cursor.copy_expert(sql, CopyBuffer(state.valuelist), size=COPY_BUFFER_SIZE)
+        state.result = state.cursor.rowcount
+        state.valuelist = None
+        yield state
+
+    return job, default_error_handler
+
+
+@provider()
+def copy_out():
+    def job(state):
+        sink, format_ = state.store['copy_out']
+        query = state.query
+        if state.values is not None:
+            query = state.cursor.mogrify(query, state.values).decode()
+        sql = psycopg2.sql.SQL('COPY ({}) TO STDOUT WITH (FORMAT {})').format(
+            psycopg2.sql.SQL(query), psycopg2.sql.SQL(format_)
+        )
+        if callable(sink):
+            sink.restart()
+            state.cursor.copy_expert(sql, CopyWriter(sink), size=COPY_BUFFER_SIZE)
+        else:
+            with open(sink, 'wb') as file:
+                state.cursor.copy_expert(sql, file, size=COPY_BUFFER_SIZE)
+        state.result = state.cursor.rowcount
+        yield state
+
+    return job, default_error_handler
+
+
+@provider()
+def stream():
+    def job(state):
+        if state.query is None or state.context & state.context.PREPARED:
+            raise ProgrammingError('Impossible method call: streams need a (not prepared) query')
+        if state.connection.autocommit:
+            # Named cursors live in a transaction, committed when the stream is closed
+            state.connection.autocommit = False
+            state.transaction = state.connection
+        name = 'pgware_' + ''.join(random.choice(string.ascii_letters) for _ in range(10))
+        state.store['named_cursor'] = state.connection.cursor(name, cursor_factory=psycopg2.extras.DictCursor)
+        state.store['named_cursor'].execute(state.query, state.values)
         yield state
 
     return job, default_error_handler
@@ -179,6 +606,17 @@ def fetchone():
     return job, default_error_handler
 
 
+@provider()
+def fetchmany():
+    def job(state):
+        _execute(state)
+        state.result = state.cursor.fetchmany(state.store['fetch_size'])
+        state.store['temp_exec'] = True
+        yield state
+
+    return job, default_error_handler
+
+
 @provider()
 def fetchall():
     def job(state):
@@ -198,7 +636,15 @@ def convert_result():
         sco = state.context
         if DD.DEEP ^ DD.ADAPTERS:
             print(f'$$ Output conversion, context is {sco}')
-        if state.result:
+        if sco & sco.OUTPUT_COLUMNAR:
+            if DD.DEEP ^ DD.ADAPTERS:
+                print(f'$$ Output conversion, converting to columns')
+            if isinstance(state.result, psycopg2.extras.DictRow):
+                state.result = dict(state.result)
+            elif isinstance(state.result, list):
+                description = state.cursor.description or []
+                state.result = columnar(state.result, [column.name for column in description])
+        elif state.result:
             if state.context & state.context.OUTPUT_DICT:
                 if isinstance(state.result, psycopg2.extras.DictRow):
                     state.result = dict(state.result)
@@ -261,9 +707,189 @@ def _execute(state):
         del state.store['temp_exec']
     if state.query is not None:
         if state.context & state.context.PREPARED:
+            if state.prepared is None:
+                # Lost, see default_error_handler
+                state.prepared = _prepare(state, state.query)
             if state.values is not None:
                 mask = ", ".join(['%s'] * len(state.values))
                 exec_sql = f'EXECUTE {state.prepared} ({mask})'
                 state.cursor.execute(exec_sql, state.values)
         else:
-            state.cursor.execute(state.query, state.values)
+            promoted = _promote(state)
+            if promoted is None:
+                state.cursor.execute(state.query, state.values)
+            else:
+                name, values = promoted
+                mask = ", ".join(['%s'] * len(values))
+                state.cursor.execute(f'EXECUTE {name} ({mask})' if values else f'EXECUTE {name}', values)
+
+
+def _promote(state):
+    """
+    Count the query's executions and prepare it once it reached the
+    threshold: returns its statement name and values, None while it isn't
+    (or can't be) prepared. Parameters are cast to the types psycopg2 gives
+    the values it inlines, so that they aren't inferred otherwise by the
+    server: the query is prepared once per set of value types
+    """
+    threshold = state.store['special'].get('prepare_threshold', PREPARE_THRESHOLD)
+    if threshold is None:
+        return None
+    query, values = state.query, state.values
+    if not isinstance(query, str) or not _preparable_values(values):
+        return None
+    counts = HOT_QUERIES.get(state.connection)
+    if counts is None:
+        counts = HOT_QUERIES[state.connection] = LRUCache(HOT_QUERIES_SIZE)
+    count = counts.get(query) or 0
+    if 0 <= count < threshold:
+        counts.put(query, count + 1)
+        return None
+    if count < 0:
+        return None
+    if count == threshold and not _preparable(query, values):
+        counts.put(query, -1)
+        return None
+    pg_query, pg_values = ps2pg(query, values if isinstance(values, dict) else tuple(values or ()))
+    types = _param_types(pg_values)
+    if types is None:
+        # Values of unknown types this time
+        return None
+    name = _try_prepare(state, cast_params(pg_query, types))
+    if name is None:
+        logger.debug('Query can not be prepared: %s', query)
+        if count == threshold:
+            counts.put(query, -1)
+        return None
+    counts.put(query, threshold + 1)
+    return name, pg_values
+
+
+def _param_types(values):
+    # Types of the values' parameters, None if one of them is of an unknown type
+    types = []
+    for value in values:
+        try:
+            type_ = PARAM_TYPES[type(value)]
+        except KeyError:
+            return None
+        types.append(type_(value) if callable(type_) else type_)
+    return tuple(types)
+
+
+def _try_prepare(state, query):
+    """
+    Prepare a query, None if the server refused it (ie: values psycopg2
+    adapts into SQL, not into a parameter): within a transaction, the
+    failure is rolled back to a savepoint so that it can go on
+    """
+    statements = STATEMENTS.get(state.connection)
+    if statements is not None and statements.get(query) is not None:
+        return _prepare(state, query)
+    in_transaction = state.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if in_transaction:
+        state.cursor.execute('SAVEPOINT pgware_prepare')
+    try:
+        name = _prepare(state, query)
+    except psycopg2.Error:
+        if in_transaction:
+            state.cursor.execute('ROLLBACK TO SAVEPOINT pgware_prepare')
+        return None
+    if in_transaction:
+        state.cursor.execute('RELEASE SAVEPOINT pgware_prepare')
+    return name
+
+
+def _preparable_values(values):
+    # Sequences are adapted by psycopg2 into SQL (ie: "IN %s"), as are
+    # AsIs and sql.Composable values, not into parameters
+    if values is None:
+        return True
+    for value in (values.values() if isinstance(values, dict) else values):
+        if isinstance(value, (tuple, list, psycopg2.extensions.AsIs, psycopg2.sql.Composable)):
+            return False
+    return True
+
+
+def _preparable(query, values):
+    # Only single DML statements can be prepared, % are only escapes when
+    # there are values
+    if not PREPARABLE_RE.match(query) or ';' in query:
+        return False
+    return values is not None or '%' not in query
+
+
+def _countable(query):
+    # DML statements whose rowcounts a DO block can add up: plpgsql needs a
+    # destination for the rows of others
+    return bool(COUNTABLE_RE.match(query)) and not RETURNING_RE.search(query) and ';' not in query
+
+
+def _counted_page(statements):
+    """
+    A page of (mogrified) statements as one DO block adding up their
+    rowcounts, followed by the query reading the total: multi-statement
+    queries only report the last statement's rowcount
+    """
+    body = b''.join(
+        statement + b'\n; GET DIAGNOSTICS pgware_count = ROW_COUNT; pgware_rows := pgware_rows + pgware_count;\n'
+        for statement in statements
+    )
+    tag = b'$pgware$'
+    while tag in body:
+        tag = tag[:-1] + b'_$'
+    return (
+        b'DO ' + tag + b' DECLARE pgware_rows bigint := 0; pgware_count bigint; BEGIN\n' + body
+        + b"PERFORM set_config('pgware.rowcount', pgware_rows::text, true); END " + tag
+        + b"; SELECT current_setting('pgware.rowcount')::bigint"
+    )
+
+
+def _values_template(query):
+    """
+    Split an INSERT ... VALUES (...) query in an execute_values query and
+    its row template, None if it isn't one
+    """
+    match = VALUES_RE.match(query)
+    if match is None:
+        return None
+    start = match.end() - 1
+    depth = 0
+    quoted = False
+    for i in range(start, len(query)):
+        char = query[i]
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return query[:start] + '%s' + query[i + 1:], query[start:i + 1]
+    return None
+
+
+def _prepare(state, query):
+    """
+    Return the name of the query's statement, prepared on the connection if
+    it wasn't yet: statements are named after their query, the least
+    recently used ones are deallocated once there are too many
+    """
+    statements = STATEMENTS.get(state.connection)
+    if statements is None:
+        size = state.store['special'].get('statement_cache_size', STATEMENT_CACHE_SIZE)
+        statements = STATEMENTS[state.connection] = LRUCache(max(size, 1))
+    name = statements.get(query)
+    if name is not None:
+        state.store['meta']['statement_hit_cntr'] += 1
+        return name
+    state.store['meta']['statement_miss_cntr'] += 1
+    name = 'pgware_' + hashlib.sha1(query.encode()).hexdigest()[:20]
+    state.cursor.execute(f'PREPARE {name} AS {query}')
+    evicted = statements.put(query, name)
+    if evicted is not None:
+        logger.debug('Deallocating prepared statement %s', evicted[1])
+        state.cursor.execute(f'DEALLOCATE {evicted[1]}')
+    return name
@@ -1,8 +1,12 @@
+import asyncio
 import inspect
 import logging
+import threading
 import time
 import uuid
-from collections import defaultdict, namedtuple
+import weakref
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from enum import Flag, auto
 
 from .exceptions import (
@@ -10,6 +14,7 @@ from .exceptions import (
 )
 from .utils import (
     config_map,
+    numpy,
     raise_,
 )
 
@@ -38,6 +43,14 @@ class DD(Flag):
 MAX_STAGE_RETRIES = 1
 MAX_TOTAL_RETRIES = 3
 CONTEXT_STAT_INTERVAL_SECONDS = 60
+ITER_BATCH_SIZE = 1000
+COPY_CHUNK_SIZE = 10000
+EXECUTEMANY_PAGE_SIZE = 100
+COPY_SPOOL_SIZE = 2 ** 24
+# Threads running sync pipelines for async contexts (see special 'async_workers')
+ASYNC_WORKERS = 8
+# Seconds preheated connections are held, waiting for the others to be opened
+PREHEAT_TIMEOUT = 10
 
 
 def logger_setup():
@@ -55,9 +68,17 @@ LOGGER = logger_setup()
 # #############################################################################
 Setup = namedtuple(
     'setup',
-    'client, op_list, cmd_dict'
+    'client, pipeline, loops, cmd_dict, workers',
+    defaults=(None,)
 )
 
+Plan = namedtuple(
+    'plan',
+    'stages, sync'
+)
+
+STAGES = ('connection', 'parsing', 'execution', 'result', 'errors')
+
 
 class Context(Flag):
     """
@@ -73,9 +94,82 @@ class Context(Flag):
     OUTPUT_DICT = auto()
     OUTPUT_LIST = auto()
     OUTPUT_NATIVE = auto()
+    OUTPUT_COLUMNAR = auto()
     JSON = auto()
 
 
+class Pipeline():
+    """
+    Execution pipeline definition: the ops (providers & doodads) of each stage,
+    along with the execution plans compiled from them.
+
+    A plan holds an immutable tuple of `(stage, ops)` tuples, with only the
+    stages that have something to execute, and the method provider
+    (`execute`, `fetchone`, ...) appended to the execution stage. It is
+    flagged `sync` when no op nor error handler is a coroutine, so it can be
+    executed without an event loop. Plans are compiled once per
+    (method, context) and cached.
+
+    Pipelines are never modified in place: adding an op returns a new pipeline
+    with a bumped version, so contexts holding on to an older pipeline keep
+    their own cached plans.
+    """
+    __slots__ = ['client', 'ops', 'version', '_plans']
+
+    def __init__(self, client, ops=None, version=0):
+        ops = {} if ops is None else ops
+        self.client = client
+        self.ops = {stage: tuple(ops.get(stage, ())) for stage in STAGES}
+        self.version = version
+        self._plans = {}
+
+    def extend(self, stage, op, first=False):
+        """
+        Return a new pipeline with the op added to the stage,
+        at the front (doodads) or at the back (providers)
+        """
+        if stage not in STAGES:
+            raise AttributeError(f'Doodad for stage {stage} not supported')
+        ops = dict(self.ops)
+        ops[stage] = (op,) + ops[stage] if first else ops[stage] + (op,)
+        return Pipeline(self.client, ops, self.version + 1)
+
+    def has(self, stage, jobname):
+        return any(op[0] == jobname for op in self.ops[stage])
+
+    def plan(self, method, context):
+        """
+        Return the execution plan for a method (None for the bare pipeline)
+        in the given context
+        """
+        key = (method, context, self.version)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = self._compile(method, context)
+            if DD.OPS ^ DD.DEEP:
+                print(f'=>  Compiled plan {key}: {plan}')
+        return plan
+
+    def _compile(self, method, context):
+        client = self.client
+        ops = dict(self.ops)
+        if context & Context.CURSOR and client.__backend__ == 'asyncpg':
+            # Cursor is redundant for psycopg2
+            ops['connection'] += (client.cursor(),)
+        if method is not None:
+            ops['execution'] += (getattr(client, method)(),)
+        if method in ('execute', 'stream', 'copy_in', 'copy_out'):
+            # Execute statement & copies ignore result parsing, streams parse each batch
+            ops['result'] = ()
+        stages = tuple((stage, ops[stage]) for stage in STAGES if ops[stage])
+        sync = not any(
+            coroutine or inspect.iscoroutinefunction(err_handler)
+            for _stage, stage_ops in stages
+            for (_jobname, _job, err_handler, _reuse, coroutine) in stage_ops
+        )
+        return Plan(stages=stages, sync=sync)
+
+
 class State():
     """
     State object that get's passed between the functions and represents
@@ -95,21 +189,28 @@ class State():
     - retries: the number of times the execution pipeline has been retried
     - done: interal list of executed steps
     - pool: pool of connections to use
-    - loop: current event loop (for sync operation)
+    - parent: the builder's state, shared by its contexts (None for the builder's own)
 
+    Each context executes with its own child state (see `child`), sharing the
+    builder's pool, single connection and config.
+
+    Attributes are plain slots, as they are accessed many times per query;
+    when debugging the state (DD.STATE), a TracingState is instantiated instead.
     """
     __slots__ = ['connection', 'transaction', 'cursor', 'result', 'prepared', 'done',
                  'pool', 'store', 'query', 'values', 'context', 'retries', 'valuelist',
-                 'loop', '_me', '_v', '_context']
+                 'parent', '_me', '_context']
+
+    def __new__(cls, *_args, **_kwargs):
+        if cls is State and DD.STATE ^ DD.DEEP:
+            cls = TracingState
+        return object.__new__(cls)
 
     def __init__(self, connection=None, cursor=None, result=None,  # pylint: disable=too-many-arguments
                  store=None, query=None, values=None, done=None, pool=None, valuelist=None,
-                 transaction=None, prepared=None, context=Context(False), loop=None):
-        # _me and _v serve for debugging purpouses
-        object.__setattr__(self, '_me', uuid.uuid4())
-        object.__setattr__(self, '_v', 0)
-        object.__setattr__(self, '_context', context)
-        self._me = uuid.uuid4()
+                 transaction=None, prepared=None, context=Context(False), parent=None):
+        self._context = context
+        self.parent = parent
         self.pool = pool
         self.connection = connection
         self.cursor = cursor
@@ -122,33 +223,56 @@ class State():
         self.context = context
         self.transaction = transaction
         self.prepared = prepared
-        self.loop = loop
         self.retries = {'total': 0, 'stage': 0}
 
+    @property
+    def uid(self):
+        """
+        Unique id of the state (for debugging purpouses), generated on first use
+        """
+        try:
+            return object.__getattribute__(self, '_me')
+        except AttributeError:
+            uid = uuid.uuid4()
+            object.__setattr__(self, '_me', uid)
+            return uid
+
+    def child(self):
+        """
+        Return a state for a new context: it shares the pool, single connection,
+        config and the connection ops done, but has its own transaction, cursor,
+        query, results, ...
+        """
+        return State(
+            connection=self.connection,
+            pool=self.pool,
+            store=dict(self.store),
+            done=list(self.done),
+            context=self._context,
+            parent=self,
+        )
+
+    def share(self, attr, jobname):
+        """
+        Share a connection-level resource (single connection, pool) opened by a
+        context with the builder's state, hence with the following contexts
+        """
+        if self.parent is None:
+            return
+        setattr(self.parent, attr, getattr(self, attr))
+        if jobname not in self.parent.done:
+            self.parent.done.append(jobname)
+
     def status(self):
-        print(f'#### {self._me} status dump:')
-        for k in self.__slots__:
-            val = object.__getattribute__(self, k)
-            print(f"\t{k} => {val}")
+        print(f'#### {self.uid} status dump:')
+        for k in State.__slots__:
+            if k not in ('_me', 'parent'):
+                val = object.__getattribute__(self, k)
+                print(f"\t{k} => {val}")
 
     def __getattr__(self, _attr):
         return None
 
-    def __getattribute__(self, attr):
-        if DD.STATE ^ DD.DEEP:
-            _v = object.__getattribute__(self, '_v')
-            _me = object.__getattribute__(self, '_me')
-            print(f"\tS => {attr} ({_me}:{_v})")
-        return object.__getattribute__(self, attr)
-
-    def __setattr__(self, attr, value):
-        if DD.STATE ^ DD.DEEP:
-            _v = object.__getattribute__(self, '_v')
-            object.__setattr__(self, '_v', _v + 1)
-            _me = object.__getattribute__(self, '_me')
-            print(f"\tS <= {attr} ({_me}: {_v} => {_v+1})")
-        object.__setattr__(self, attr, value)
-
     def clean(self, to_clean=['transaction', 'cursor', 'result', 'prepared', 'query', 'values']):
         LOGGER.debug('Cleansing state')
         for key in to_clean:
@@ -156,7 +280,161 @@ class State():
         keep_done = ['single_connect']
         self.done = list(set(keep_done) & set(self.done))
         self.retries = {'total': 0, 'stage': 0}
-        self.context = object.__getattribute__(self, '_context')
+        self.context = self._context
+
+
+class TracingState(State):
+    """
+    State printing every attribute read & write, along with a version
+    number bumped on each write
+    """
+    __slots__ = ['_v']
+
+    def __init__(self, *args, **kwargs):
+        object.__setattr__(self, '_v', 0)
+        super().__init__(*args, **kwargs)
+
+    def __getattribute__(self, attr):
+        _v = object.__getattribute__(self, '_v')
+        _me = State.uid.__get__(self)
+        print(f"\tS => {attr} ({_me}:{_v})")
+        return object.__getattribute__(self, attr)
+
+    def __setattr__(self, attr, value):
+        _v = object.__getattribute__(self, '_v')
+        object.__setattr__(self, '_v', _v + 1)
+        _me = State.uid.__get__(self)
+        print(f"\tS <= {attr} ({_me}: {_v} => {_v+1})")
+        object.__setattr__(self, attr, value)
+
+
+class EventLoops():
+    """
+    Event loops used to run async pipelines in sync mode: one persistent loop
+    per thread, reused by all the sync contexts of a builder, and closed along
+    with the builder's connections.
+
+    Note that asyncpg connections are bound to the loop (hence the thread)
+    which opened them.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._loops = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the current thread's loop, creating it if needed
+        """
+        loop = getattr(self._local, 'loop', None)
+        if loop is None or loop.is_closed():
+            loop = asyncio.new_event_loop()
+            self._local.loop = loop
+            with self._lock:
+                self._loops.append(loop)
+        return loop
+
+    def run(self, coro):
+        """
+        Run a coroutine to completion in the current thread's loop
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self.get().run_until_complete(coro)
+        coro.close()
+        LOGGER.critical('''Running sync PGWare within eventloop;
+        please refactor to async/await use''')
+        raise ProgrammingError(''''Running sync PGWare within eventloop;
+        please refactor to async/await use''')
+
+    def close(self):
+        """
+        Close all the loops that are not running
+        """
+        with self._lock:
+            loops, self._loops = self._loops, []
+        for loop in loops:
+            if loop.is_running():
+                with self._lock:
+                    self._loops.append(loop)
+                continue
+            if not loop.is_closed():
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.close()
+        LOGGER.debug('Closed %s event loops', len(loops))
+
+
+class Workers():
+    """
+    Bounded pool of threads running sync pipelines (ie: psycopg2's) for async
+    contexts, so that their blocking calls don't stall the event loop. The
+    threads are started on first use, and stopped along with the builder's
+    connections.
+
+    Contexts without a connection may have to wait for a pooled one: they
+    are kept from taking all the threads, leaving at least one to the
+    contexts that hold a connection (and will release it).
+    """
+
+    def __init__(self, size):
+        self._size = max(size, 2)
+        self._executor = None
+        # asyncio objects are bound to their loop: one semaphore per loop
+        self._connecting = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    async def run(self, fun, *args, connecting=False, running=None):
+        """
+        Run fun(*args) in a worker thread. Cancelling the awaiting task
+        doesn't stop the thread: running(future) is given its future, to be
+        waited for before using the connection again
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._size, thread_name_prefix='pgware')
+            executor = self._executor
+            semaphore = self._connecting.get(loop)
+            if semaphore is None and connecting:
+                semaphore = self._connecting[loop] = asyncio.Semaphore(self._size - 1)
+        if connecting:
+            await semaphore.acquire()
+        try:
+            future = asyncio.wrap_future(executor.submit(fun, *args), loop=loop)
+        except BaseException:
+            if connecting:
+                semaphore.release()
+            raise
+        if connecting:
+            # Released once the thread is done, not when the caller gives up on it
+            future.add_done_callback(lambda _future: semaphore.release())
+        if running is not None:
+            running(future)
+        return await asyncio.shield(future)
+
+    def close(self):
+        """
+        Stop the threads, once they are done with their pipelines
+        """
+        executor = self._detach()
+        if executor is not None:
+            executor.shutdown()
+
+    async def close_async(self):
+        """
+        Stop the threads, waiting for them in the loop's default executor
+        rather than in the event loop
+        """
+        executor = self._detach()
+        if executor is not None:
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+    def _detach(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        return executor
 
 
 # ################################################################# Exposed API
@@ -169,12 +447,13 @@ def build(client='psycopg2', *, connection_type='single', output='list',  # pyli
 
     **Parameters:**
 
-    client: str [psycopg2, asyncpg, ...]
+    client: str [psycopg2, asyncpg, asyncpsycopg2]
         The client you wish to use
     connection_type: str [single, pooled]
         Single connection or a pooled one
-    output: str [list, dict, native]
-        Output results as a list or a dict, or as the native format
+    output: str [list, dict, native, columnar]
+        Output results as a list or a dict, or as the native format;
+        columnar outputs a dict of column name => numpy array (needs numpy)
     param_format: str [native, psycopg2, asyncpg/postgresql]
         Query parameter format (%s is psycopg2, $1 is asyncpg/postgresql)
         native depends on the chosen client
@@ -198,9 +477,10 @@ def build(client='psycopg2', *, connection_type='single', output='list',  # pyli
     LOGGER.info('Building pgware for %s:%s', client, connection_type)
     from .client import psycopg2_client as pg2
     from .client import asyncpg_client as apg
-    op_list = defaultdict(list)
+    from .client import asyncpsycopg2_client as apg2
+    op_list = {}
 
-    if client not in ['psycopg2', 'asyncpg']:
+    if client not in ['psycopg2', 'asyncpg', 'asyncpsycopg2']:
         msg = f"Backend '{client}' not known / unsupported"
         raise ProgrammingError(msg)
 
@@ -229,6 +509,10 @@ def build(client='psycopg2', *, connection_type='single', output='list',  # pyli
         context |= context.OUTPUT_DICT
     elif output == 'list':
         context |= context.OUTPUT_LIST
+    elif output == 'columnar':
+        if numpy is None:
+            raise ProgrammingError("Columnar output needs numpy: pip install pgware[columnar]")
+        context |= context.OUTPUT_COLUMNAR
     else:
         context |= context.OUTPUT_NATIVE
     if auto_json:
@@ -239,16 +523,27 @@ def build(client='psycopg2', *, connection_type='single', output='list',  # pyli
         backend = pg2
         if context & context.SINGLE:
             op_list['connection'] = [pg2.single_connect(), pg2.cursor()]
-        if context & context.OUTPUT_DICT or context & context.OUTPUT_LIST:
+        if context & context.POOLED:
+            op_list['connection'] = [pg2.pool_connect(), pg2.acquire(), pg2.cursor()]
+        if context & (context.OUTPUT_DICT | context.OUTPUT_LIST | context.OUTPUT_COLUMNAR):
             op_list['result'] = [pg2.convert_result()]
         op_list['parsing'] = [pg2.convert_input()]
+    elif client == 'asyncpsycopg2':
+        backend = apg2
+        if context & context.SINGLE:
+            op_list['connection'] = [apg2.single_connect(), apg2.cursor()]
+        if context & context.POOLED:
+            op_list['connection'] = [apg2.pool_connect(), apg2.acquire(), apg2.cursor()]
+        if context & (context.OUTPUT_DICT | context.OUTPUT_LIST | context.OUTPUT_COLUMNAR):
+            op_list['result'] = [apg2.convert_result()]
+        op_list['parsing'] = [apg2.convert_input()]
     elif client == 'asyncpg':
         backend = apg
         if context & context.SINGLE:
             op_list['connection'] = [apg.single_connect()]
         if context & context.POOLED:
             op_list['connection'] = [apg.pool_connect(), apg.acquire()]
-        if context & context.OUTPUT_DICT or context & context.OUTPUT_LIST:
+        if context & (context.OUTPUT_DICT | context.OUTPUT_LIST | context.OUTPUT_COLUMNAR):
             op_list['result'] = [apg.convert_result()]
         if context & context.QUERY_ARGS_PSYCOPG2:
             op_list['parsing'] = [apg.convert_input()]
@@ -268,11 +563,14 @@ def build(client='psycopg2', *, connection_type='single', output='list',  # pyli
         LOGGER.info('Client supports desired context (%s)', supported_str)
 
     cfg_map = backend.__config_map__(context)
+    workers = kwargs.get('special', {}).get('async_workers', ASYNC_WORKERS)
     return _PgwareBuilder(
         setup=Setup(
             client=backend,
-            op_list=op_list,
-            cmd_dict={}
+            pipeline=Pipeline(backend, op_list),
+            loops=EventLoops(),
+            cmd_dict={},
+            workers=Workers(workers) if workers else None
         ),
         state=State(
             store={
@@ -315,7 +613,11 @@ class _PgwareBuilder():
             'context_cntr': 0,
             'stage_retries_cntr': 0,
             'total_retries_cntr': 0,
+            'statement_hit_cntr': 0,
+            'statement_miss_cntr': 0,
         }
+        # Clients count their statement cache hits & misses in there
+        state.store['meta'] = self._meta
 
     def get_connection(self, cursor=False):
         # Return pgware object context manager
@@ -338,34 +640,106 @@ class _PgwareBuilder():
         ).raw()
 
     async def close_all(self):
+        """
+        Close all open connections, the event loops used by sync contexts
+        and the worker threads used by async ones
+        """
+        LOGGER.debug('PGWare closing connection')
+        closing = self._setup.client.close_connection(self._state)
+        if inspect.isawaitable(closing):
+            await closing
+        self._setup.loops.close()
+        if self._setup.workers is not None:
+            await self._setup.workers.close_async()
+
+    def close_all_sync(self):
+        """
+        Close all open connections, the event loops used by sync contexts
+        and the worker threads used by async ones
+        """
+        client = self._setup.client
         LOGGER.debug('PGWare closing connection')
-        await self._setup.client.close_connection(self._state)
+        if inspect.iscoroutinefunction(client.close_connection):
+            self._setup.loops.run(client.close_connection(self._state))
+        else:
+            client.close_connection(self._state)
+        self._setup.loops.close()
+        if self._setup.workers is not None:
+            self._setup.workers.close()
 
-    def preheat(self):
+    def preheat(self, min_connections=1, prepare=None):
         """
         Preheat lazy connection acquisition, avoid doing
-        it later on and incuring timeout penalty
+        it later on and incuring timeout penalty: min_connections
+        connections are opened concurrently (and held at once, so that pools
+        open as many), extensions are set up on each and the queries to
+        prepare are prepared on each
         """
         if DD.DEEP ^ DD.BUILDER:
             print(f'-- Preheating pgware')
-        with self.get_connection() as pgw:
-            pgw.preheat()
-            # hacky but the job get's done
-            pgw.execute('SELECT 1')
-            LOGGER.info('Preheated')
+        if not self._setup.pipeline.plan(None, self._state.context).sync:
+            # Async clients connect concurrently within the thread's event loop
+            return self._setup.loops.run(self.preheat_async(min_connections, prepare))
+        min_connections = self._preheat_size(min_connections)
+        barrier = threading.Barrier(min_connections)
+
+        def preheat_one():
+            with self.get_connection() as pgw:
+                try:
+                    pgw.preheat(prepare)
+                finally:
+                    try:
+                        barrier.wait(PREHEAT_TIMEOUT)
+                    except threading.BrokenBarrierError:
+                        # Connections in use elsewhere: give ours back to the others
+                        pass
+
+        with ThreadPoolExecutor(min_connections, thread_name_prefix='pgware-preheat') as executor:
+            futures = [executor.submit(preheat_one) for _ in range(min_connections)]
+        for future in futures:
+            future.result()
+        if barrier.broken:
+            LOGGER.warning('Preheated %s connection(s), not all held at once within %ss', min_connections, PREHEAT_TIMEOUT)
+        else:
+            LOGGER.info('Preheated %s connection(s)', min_connections)
+        return None
 
-    async def preheat_async(self):
+    async def preheat_async(self, min_connections=1, prepare=None):
         """
         Preheat lazy connection acquisition in async mode, avoid doing
-        it later on and incuring timeout penalty
+        it later on and incuring timeout penalty (see preheat)
         """
         if DD.DEEP ^ DD.BUILDER:
             print(f'-- Preheating pgware in async')
-        async with self.get_connection() as pgw:
-            await pgw.preheat()
-            # hacky but the job get's done
-            await pgw.execute('SELECT 1')
-            LOGGER.info('Preheated (async)')
+        min_connections = self._preheat_size(min_connections)
+        preheated = []
+        all_preheated = asyncio.Event()
+
+        async def preheat_one():
+            async with self.get_connection() as pgw:
+                try:
+                    await pgw.preheat(prepare)
+                finally:
+                    preheated.append(pgw)
+                    if len(preheated) == min_connections:
+                        all_preheated.set()
+                # Connections are given back once all of them were opened
+                try:
+                    await asyncio.wait_for(all_preheated.wait(), PREHEAT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # Connections in use elsewhere: give ours back to the others
+                    pass
+
+        await asyncio.gather(*[preheat_one() for _ in range(min_connections)])
+        LOGGER.info('Preheated %s connection(s) (async)', min_connections)
+
+    def _preheat_size(self, min_connections):
+        if self._state.context & Context.SINGLE:
+            # Contexts share the one connection
+            return 1
+        # Pools don't open more than max_size connections: more contexts would wait for them forever
+        max_size = self._state.store['setup'].get('max_size') or min_connections
+        return max(min(min_connections, max_size), 1)
 
     def _stats(self, force=False):
         obj = self._meta
@@ -374,7 +748,8 @@ class _PgwareBuilder():
         if force or now - obj['timer'] > CONTEXT_STAT_INTERVAL_SECONDS:
             delta = now - obj['timer']
             LOGGER.info(
-                'stats: contexts @ %s (%s/sec) - ops @ %s (%s/sec) - total/stage retries @ %s/%s (%s/sec)',
+                'stats: contexts @ %s (%s/sec) - ops @ %s (%s/sec) - total/stage retries @ %s/%s (%s/sec)'
+                ' - statement cache hits/misses @ %s/%s',
                 obj['context_cntr'],
                 round(self._stats_cntr_delta('context_cntr') / delta, 2),
                 obj['operation_cntr'],
@@ -382,6 +757,8 @@ class _PgwareBuilder():
                 obj['total_retries_cntr'],
                 obj['stage_retries_cntr'],
                 round((self._stats_cntr_delta('total_retries_cntr') + self._stats_cntr_delta('stage_retries_cntr')) / delta, 2),
+                obj['statement_hit_cntr'],
+                obj['statement_miss_cntr'],
             )
             obj['timer'] = now
             if 'prev_cntr' not in obj:
@@ -418,18 +795,8 @@ class _PgwareBuilder():
             doodad = ('doodad', job, err_handler, False, True)
         else:
             doodad = ('doodad', job, err_handler, False, False)
-        if stage == 'connection':
-            self._setup.op_list['connection'].insert(0, doodad)
-        elif stage == 'parsing':
-            self._setup.op_list['parsing'].insert(0, doodad)
-        elif stage == 'execution':
-            self._setup.op_list['execution'].insert(0, doodad)
-        elif stage == 'result':
-            self._setup.op_list['result'].insert(0, doodad)
-        elif stage == 'errors':
-            self._setup.op_list['errors'].insert(0, doodad)
-        else:
-            raise AttributeError(f'Doodad for stage {stage} not supported')
+        pipeline = self._setup.pipeline.extend(stage, doodad, first=True)
+        self._setup = self._setup._replace(pipeline=pipeline)
 
 
 # ############################################################## CONTEXTMANAGER
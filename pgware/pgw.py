@@ -1,11 +1,17 @@
 import asyncio
-import copy
 import inspect
+import itertools
+import os
+import tempfile
+import time
 from .main import (
+    COPY_CHUNK_SIZE,
+    COPY_SPOOL_SIZE,
     DD,
+    EXECUTEMANY_PAGE_SIZE,
+    ITER_BATCH_SIZE,
     LOGGER,
     Context,
-    Setup,
     MAX_STAGE_RETRIES,
     MAX_TOTAL_RETRIES,
 )
@@ -31,13 +37,14 @@ class _Pgware():
     # Internals
     # ########################################################################
     def __init__(self, setup, state, sync, cursor, meta):  # pylint: disable=too-many-arguments
-        self._setup = Setup(
-            client=setup.client,
-            op_list=copy.deepcopy(setup.op_list),
-            cmd_dict=setup.cmd_dict
-        )
+        # Contexts don't step on each other's toes: each has its own state
+        state = state.child()
+        self._setup = setup
         self._meta = meta
-        self._itercursor = 0
+        self._sync = sync
+        self._streaming = None  # the stream whose cursor is open, if any
+        self._offloaded = None  # the last worker thread's future (see _offload)
+        self.rowcount = -1  # rows affected by the last executemany, -1 if unknown
         self.closed = False
 
         if sync:
@@ -46,7 +53,11 @@ class _Pgware():
             self.fetchval = self.fetchval_sync
             self.fetchone = self.fetchone_sync
             self.fetchall = self.fetchall_sync
+            self.fetchmany = self.fetchmany_sync
+            self.iter_batches = self.iter_batches_sync
             self.executemany = self.executemany_sync
+            self.copy_in = self.copy_in_sync
+            self.copy_out = self.copy_out_sync
             self.prepare = self.prepare_sync
             self.close = self.close_context_sync
             self.preheat = self.preheat_sync
@@ -59,9 +70,6 @@ class _Pgware():
             if DD.OPS ^ DD.DEEP:
                 LOGGER.debug('Using cursor')
                 print(f'=>  Cursor Enabled')
-            if self._setup.client.__backend__ == 'asyncpg':
-                LOGGER.debug('Adding cursor to connection pipeline')
-                self._setup.op_list['connection'] += [(self._setup.client.cursor())]
             state.context |= state.context.CURSOR
 
         self._state = state
@@ -79,34 +87,68 @@ class _Pgware():
     def _incr(self, cntr):
         self._meta[cntr] += 1
 
-    def _exec_ops_sync(self, pipeline):
+    def _plan(self, method=None):
+        return self._setup.pipeline.plan(method, self._state.context)
+
+    def _exec_ops_sync(self, plan):
         """
-        Execute the pipeline in an event loop (pgware has been called
-        in a synchronous context, we try to run it in an eventloop
-        and return the results anyway)
+        Execute the pipeline synchronously (pgware has been called in a
+        synchronous context): plans made of sync ops only are executed
+        directly, others are run in an eventloop to return the results anyway
         """
-        state = self._state
         if DD.OPS ^ DD.DEEP:
-            print(f'received pipeline {pipeline} (sync)')
-        try:
-            if state.loop is None:
-                state.loop = asyncio.new_event_loop()
-            # return asyncio.run(self._exec_opline(pipeline))
-            return state.loop.run_until_complete(self._exec_opline(pipeline))
-        except RuntimeError:
-            LOGGER.critical('''Running sync PGWare within eventloop;
-            please refactor to async/await use''')
-            raise ProgrammingError(''''Running sync PGWare within eventloop;
-            please refactor to async/await use''')
-
-    async def _exec_ops(self, pipeline):
+            print(f'received plan {plan} (sync)')
+        if plan.sync:
+            return self._exec_opline_sync(plan)
+        return self._setup.loops.run(self._exec_opline(plan))
+
+    async def _exec_ops(self, plan):
         if DD.OPS ^ DD.DEEP:
-            print(f'received pipeline {pipeline} (async)')
-        return await self._exec_opline(pipeline)
+            print(f'received plan {plan} (async)')
+        if self._streaming is not None:
+            # Wait for the stream's prefetch to free the connection
+            await self._streaming.settle()
+        if plan.sync and self._setup.workers is not None:
+            # Blocking ops (ie: psycopg2's) run in a worker thread, not in the event loop
+            return await self._offload(self._exec_opline_sync, plan, connecting=self._state.connection is None)
+        return await self._exec_opline(plan)
 
-    async def _exec_opline(self, opline):
+    async def _call(self, fun, *args):
+        """
+        Call a client function in async mode: coroutines are awaited, blocking
+        functions run in a worker thread (if the builder has them)
+        """
+        if self._setup.workers is None or inspect.iscoroutinefunction(fun):
+            result = fun(*args)
+            return await result if inspect.isawaitable(result) else result
+        return await self._offload(fun, *args)
+
+    async def _offload(self, fun, *args, connecting=False):
+        """
+        Run a blocking function in a worker thread. The thread goes on when
+        the awaiting task is cancelled: it is waited for before anything
+        else uses the context's connection (ie: close_context releasing it)
         """
-        Execution of task pipeline.
+        await self._settle_offloaded()
+        return await self._setup.workers.run(fun, *args, connecting=connecting, running=self._track_offloaded)
+
+    def _track_offloaded(self, future):
+        self._offloaded = future
+
+    async def _settle_offloaded(self):
+        offloaded, self._offloaded = self._offloaded, None
+        if offloaded is None:
+            return
+        if not offloaded.done():
+            LOGGER.debug('Waiting for the worker thread of a cancelled call')
+            await asyncio.wait([offloaded])
+        if not offloaded.cancelled():
+            # Retrieved for the cancelled caller, if any: it is gone
+            offloaded.exception()
+
+    async def _exec_opline(self, plan):
+        """
+        Execution of task pipeline, following a compiled plan.
         Tasks are ordered left to right in execution pipeline
         ex: [connect, acquire, cursor, execute, fetchval]
         Each operation executes itself and passes its result
@@ -117,171 +159,415 @@ class _Pgware():
         if 'temp_exec' not in state.store or not state.store['temp_exec']:
             LOGGER.debug('Resetting state result')
             self._state.result = []
-        stages = ['connection', 'parsing', 'execution', 'result', 'errors']
+        stage = None
 
         while True:
             try:
-                for stage in stages:
-                    stage_ops = opline[stage]
+                for stage, stage_ops in plan.stages:
                     if DD.OPS ^ DD.DEEP:
                         print(f'-- Launching stage {stage} {len(stage_ops)} context:{state.context}')
-                    if not stage_ops:
-                        continue
                     state.retries['stage'] = 0
                     state = await self._exec_stage(stage, stage_ops, state)
                 break
             except (RetriesExhausted, PrivateError) as ex:
-                if DD.OPS ^ DD.DEEP:
-                    print(f'!! {stage} exception, retrying pipeline')
-                if state.retries['total'] > MAX_TOTAL_RETRIES:
-                    LOGGER.debug('Total retries (%s) exhausted allowable amount (%s)', state.retries['total'], MAX_TOTAL_RETRIES)
-                    raise RetriesExhausted(
-                        f'Exhaused total retries, abandoning'
-                    )
-                LOGGER.warning('Pipeline Stage exception: %s', ex)
-                state.retries['total'] += 1
-                await asyncio.sleep(state.retries['total'] * .5)
-                self._incr('total_retries_cntr')
-                state.done = []
+                await asyncio.sleep(self._retry_opline(stage, state, ex))
             except Exception as ex:  # pylint: disable=broad-except
-                LOGGER.debug('unrecoverable op exec exception (%s) - query: %s\tValues: %s', type(ex), self._state.query, self._state.values)
-                if isinstance(ex, PublicError):
-                    raise ex
-                else:
-                    LOGGER.exception(ex)
-                    raise UnrecoverableError(f'unrecognized exception occured')
+                self._abort_opline(ex)
 
         self._state = state
         return self._state.result
 
-    async def _exec_stage(self, name, ops, state):
-        (jobname, job, err_handler, reuse, coroutine) = ops[0]
-        if DD.OPS ^ DD.DEEP:
-            print(f'#  {name}:{jobname}, reuse:{reuse}, coroutine:{coroutine}')
+    def _exec_opline_sync(self, plan):
+        """
+        Execution of task pipeline, without event loop
+        (all ops of the plan being sync, see _exec_opline)
+        """
+        state = self._state
+        if 'temp_exec' not in state.store or not state.store['temp_exec']:
+            LOGGER.debug('Resetting state result')
+            self._state.result = []
+        stage = None
+
         while True:
             try:
-                if reuse and (jobname in state.done):
-                    if DD.OPS ^ DD.DEEP:
-                        print(f'#  {name}:{jobname} already done')
-                    out_state = await self._exec_stage(
-                        name,
-                        ops[1:],
-                        state
-                    ) if len(ops) > 1 else state
-                else:
+                for stage, stage_ops in plan.stages:
                     if DD.OPS ^ DD.DEEP:
+                        print(f'-- Launching stage {stage} {len(stage_ops)} context:{state.context} (sync)')
+                    state.retries['stage'] = 0
+                    state = self._exec_stage_sync(stage, stage_ops, state)
+                break
+            except (RetriesExhausted, PrivateError) as ex:
+                time.sleep(self._retry_opline(stage, state, ex))
+            except Exception as ex:  # pylint: disable=broad-except
+                self._abort_opline(ex)
+
+        self._state = state
+        return self._state.result
+
+    def _retry_opline(self, stage, state, ex):
+        """
+        Prepare the pipeline to be retried after a stage failure,
+        returns the delay to wait for before retrying
+        """
+        if DD.OPS ^ DD.DEEP:
+            print(f'!! {stage} exception, retrying pipeline')
+        if state.retries['total'] > MAX_TOTAL_RETRIES:
+            LOGGER.debug('Total retries (%s) exhausted allowable amount (%s)', state.retries['total'], MAX_TOTAL_RETRIES)
+            raise RetriesExhausted(
+                f'Exhaused total retries, abandoning'
+            )
+        LOGGER.warning('Pipeline Stage exception: %s', ex)
+        state.retries['total'] += 1
+        self._incr('total_retries_cntr')
+        state.done = []
+        return state.retries['total'] * .5
+
+    def _abort_opline(self, ex):
+        LOGGER.debug('unrecoverable op exec exception (%s) - query: %s\tValues: %s', type(ex), self._state.query, self._state.values)
+        if isinstance(ex, PublicError):
+            raise ex
+        else:
+            LOGGER.exception(ex)
+            raise UnrecoverableError(f'unrecognized exception occured')
+
+    async def _exec_stage(self, name, ops, state):
+        """
+        Execution of a stage's ops, each op wrapping the ones following it:
+        ops are entered left to right and exited right to left.
+
+        Runs as a flat loop over a stack of entered frames, instead of
+        recursing once per op. When an op fails (entering or exiting), it is
+        retried along with all the ops it wraps, unless its error handler
+        gives up: the error is then passed on to the enclosing op.
+        """
+        debug = bool(DD.OPS ^ DD.DEEP)
+        frames = []  # entered ops, as (op, input state, context manager | None if reused)
+        depth = len(ops)
+        error = None
+        ascending = False
+        try:
+            while True:
+                if error is not None:
+                    # Recovery of the op at the top of the frame stack
+                    op = ops[len(frames)]
+                    try:
+                        await self._recover_op(name, op, state, error)
+                    except Exception as ex:  # pylint: disable=broad-except
+                        if not frames:
+                            raise
+                        op, state, manager = frames.pop()
+                        error = ex
+                        if manager is not None:
+                            try:
+                                if await self._exit_op(op, manager, ex):
+                                    # Error swallowed: the op is considered done
+                                    error = None
+                                    ascending = True
+                                    self._done_op(name, op, state, debug)
+                            except Exception as exit_ex:  # pylint: disable=broad-except
+                                error = exit_ex
+                    else:
+                        error = None
+                        ascending = False
+                elif not ascending and len(frames) < depth:
+                    op = ops[len(frames)]
+                    (jobname, job, _err_handler, reuse, coroutine) = op
+                    if debug:
+                        print(f'#  {name}:{jobname}, reuse:{reuse}, coroutine:{coroutine}')
+                    if reuse and (jobname in state.done):
+                        if debug:
+                            print(f'#  {name}:{jobname} already done')
+                        frames.append((op, state, None))
+                        continue
+                    if debug:
                         print(f'#  {name}:{jobname} must be (re)done')
-                    if coroutine:
-                        async with job(state) as new_state:
-                            out_state = await self._exec_stage(
-                                name,
-                                ops[1:],
-                                new_state
-                            ) if len(ops) > 1 else new_state
-                        if DD.OPS ^ DD.DEEP:
-                            print(f'#  {name}:{jobname} yielded async!')
+                    try:
+                        manager = job(state)
+                        if coroutine:
+                            new_state = await manager.__aenter__()
+                        else:
+                            new_state = manager.__enter__()
+                    except Exception as ex:  # pylint: disable=broad-except
+                        error = ex
+                        continue
+                    frames.append((op, state, manager))
+                    state = new_state
+                elif frames:
+                    ascending = True
+                    op, in_state, manager = frames.pop()
+                    if manager is None:
+                        continue
+                    try:
+                        if op[4]:
+                            await manager.__aexit__(None, None, None)
+                        else:
+                            manager.__exit__(None, None, None)
+                    except Exception as ex:  # pylint: disable=broad-except
+                        error = ex
+                        state = in_state
+                        continue
+                    self._done_op(name, op, state, debug)
+                else:
+                    return state
+        except BaseException as ex:
+            # Cancellation & co: let every entered op clean up
+            while frames:
+                op, _in_state, manager = frames.pop()
+                if manager is not None:
+                    await self._exit_op(op, manager, ex)
+            raise
+
+    def _exec_stage_sync(self, name, ops, state):
+        """
+        Execution of a stage's ops without event loop
+        (all ops being sync, see _exec_stage)
+        """
+        debug = bool(DD.OPS ^ DD.DEEP)
+        frames = []  # entered ops, as (op, input state, context manager | None if reused)
+        depth = len(ops)
+        error = None
+        ascending = False
+        try:
+            while True:
+                if error is not None:
+                    # Recovery of the op at the top of the frame stack
+                    op = ops[len(frames)]
+                    try:
+                        self._recover_op_sync(name, op, state, error)
+                    except Exception as ex:  # pylint: disable=broad-except
+                        if not frames:
+                            raise
+                        op, state, manager = frames.pop()
+                        error = ex
+                        if manager is not None:
+                            try:
+                                if self._exit_op_sync(manager, ex):
+                                    # Error swallowed: the op is considered done
+                                    error = None
+                                    ascending = True
+                                    self._done_op(name, op, state, debug)
+                            except Exception as exit_ex:  # pylint: disable=broad-except
+                                error = exit_ex
                     else:
-                        with job(state) as new_state:
-                            out_state = await self._exec_stage(
-                                name,
-                                ops[1:],
-                                new_state
-                            ) if len(ops) > 1 else new_state
-                        if DD.OPS ^ DD.DEEP:
-                            print(f'#  {name}:{jobname} yielded sync!')
-                    if reuse:
-                        out_state.done.append(jobname)
-                return out_state
-            except asyncio.TimeoutError:
-                if state.retries['stage'] > MAX_STAGE_RETRIES:
-                    raise RetriesExhausted(name)
-                LOGGER.warning('Asyncio timeout error, recovering')
-                state.retries['stage'] += 1
-                self._incr('stage_retries_cntr')
-                await asyncio.sleep(state.retries['stage'] * .2)
-            except Exception as ex:  # pylint: disable=broad-except
-                if state.retries['stage'] > MAX_STAGE_RETRIES:
-                    LOGGER.exception(ex)
-                    raise RetriesExhausted(name)
-                state.retries['stage'] += 1
-                reraise = await err_handler(ex, state)
-                LOGGER.warning('Stage exception: %s', ex)
-                if DD.OPS ^ DD.DEEP:
-                    print(f'!! {name}:{jobname} FAILED! retrying')
-                if isinstance(reraise, Exception):
-                    raise reraise
+                        error = None
+                        ascending = False
+                elif not ascending and len(frames) < depth:
+                    op = ops[len(frames)]
+                    (jobname, job, _err_handler, reuse, coroutine) = op
+                    if debug:
+                        print(f'#  {name}:{jobname}, reuse:{reuse}, coroutine:{coroutine}')
+                    if reuse and (jobname in state.done):
+                        if debug:
+                            print(f'#  {name}:{jobname} already done')
+                        frames.append((op, state, None))
+                        continue
+                    if debug:
+                        print(f'#  {name}:{jobname} must be (re)done')
+                    try:
+                        manager = job(state)
+                        new_state = manager.__enter__()
+                    except Exception as ex:  # pylint: disable=broad-except
+                        error = ex
+                        continue
+                    frames.append((op, state, manager))
+                    state = new_state
+                elif frames:
+                    ascending = True
+                    op, in_state, manager = frames.pop()
+                    if manager is None:
+                        continue
+                    try:
+                        manager.__exit__(None, None, None)
+                    except Exception as ex:  # pylint: disable=broad-except
+                        error = ex
+                        state = in_state
+                        continue
+                    self._done_op(name, op, state, debug)
+                else:
+                    return state
+        except BaseException as ex:
+            # Cancellation & co: let every entered op clean up
+            while frames:
+                op, _in_state, manager = frames.pop()
+                if manager is not None:
+                    self._exit_op_sync(manager, ex)
+            raise
+
+    @staticmethod
+    async def _exit_op(op, manager, ex):
+        args = (type(ex), ex, ex.__traceback__)
+        if op[4]:
+            return await manager.__aexit__(*args)
+        return manager.__exit__(*args)
+
+    @staticmethod
+    def _exit_op_sync(manager, ex):
+        return manager.__exit__(type(ex), ex, ex.__traceback__)
+
+    @staticmethod
+    def _done_op(name, op, state, debug):
+        (jobname, _job, _err_handler, reuse, coroutine) = op
+        if debug:
+            print(f'#  {name}:{jobname} yielded {"async" if coroutine else "sync"}!')
+        if reuse:
+            state.done.append(jobname)
+
+    async def _recover_op(self, name, op, state, ex):
+        """
+        Decide whether a failed op can be retried:
+        returns if so, raises the error to pass on otherwise
+        """
+        (jobname, _job, err_handler, _reuse, _coroutine) = op
+        delay = self._retry_op(name, state, ex)
+        if delay is not None:
+            await asyncio.sleep(delay)
+            return
+        reraise = err_handler(ex, state)
+        if inspect.isawaitable(reraise):
+            reraise = await reraise
+        self._recovered_op(name, jobname, ex, reraise)
+
+    def _recover_op_sync(self, name, op, state, ex):
+        (jobname, _job, err_handler, _reuse, _coroutine) = op
+        delay = self._retry_op(name, state, ex)
+        if delay is not None:
+            time.sleep(delay)
+            return
+        reraise = err_handler(ex, state)
+        self._recovered_op(name, jobname, ex, reraise)
+
+    def _retry_op(self, name, state, ex):
+        """
+        Count a stage retry, raising if they are exhausted.
+        Returns the delay to wait for on timeouts, None when the
+        op's error handler has to decide what to do with the error
+        """
+        if isinstance(ex, asyncio.TimeoutError):
+            if state.retries['stage'] > MAX_STAGE_RETRIES:
+                raise RetriesExhausted(name) from ex
+            LOGGER.warning('Asyncio timeout error, recovering')
+            state.retries['stage'] += 1
+            self._incr('stage_retries_cntr')
+            return state.retries['stage'] * .2
+        if state.retries['stage'] > MAX_STAGE_RETRIES:
+            LOGGER.exception(ex)
+            raise RetriesExhausted(name) from ex
+        state.retries['stage'] += 1
+        return None
+
+    @staticmethod
+    def _recovered_op(name, jobname, ex, reraise):
+        LOGGER.warning('Stage exception: %s', ex)
+        if DD.OPS ^ DD.DEEP:
+            print(f'!! {name}:{jobname} FAILED! retrying')
+        if isinstance(reraise, Exception):
+            raise reraise
 
     # Iteration functionality
     # ########################################################################
     def __iter__(self):
-        if not self._state.result:
-            self.fetchall()
-        self._itercursor = 0
-        return self
-
-    def __next__(self):
-        if len(self._state.result) > self._itercursor:
-            self._itercursor += 1
-            return self._state.result[self._itercursor - 1]
-        else:
-            raise StopIteration
-
-    def __aiter__(self):
-        self._itercursor = 0
-        return self
+        """
+        Iterate over the result rows of the last query: those already
+        fetched, then (after an execute) those left on the cursor, fetched
+        & converted ITER_BATCH_SIZE at a time. Rows are handed over to the
+        iteration: they are no longer kept in the state.
+        """
+        state = self._state
+        client = self._setup.client
+        rows, state.result = state.result, None
+        executed = state.store.get('temp_exec')
+        if isinstance(rows, list) and rows:
+            yield from (self._convert_batch_sync(rows) if executed else rows)
+        rows = None
+        while executed:
+            batch = client.fetch_batch(state, ITER_BATCH_SIZE)
+            if inspect.isawaitable(batch):
+                batch = self._setup.loops.run(batch)
+            if not batch:
+                break
+            yield from self._convert_batch_sync(batch)
+            executed = len(batch) == ITER_BATCH_SIZE
+        state.store['temp_exec'] = False
 
-    async def __anext__(self):
-        if not self._state.result:
-            await self.fetchall()
-        if len(self._state.result) > self._itercursor:
-            self._itercursor += 1
-            return self._state.result[self._itercursor - 1]
-        else:
-            raise StopAsyncIteration
+    async def __aiter__(self):
+        state = self._state
+        client = self._setup.client
+        rows, state.result = state.result, None
+        executed = state.store.get('temp_exec')
+        if isinstance(rows, list) and rows:
+            for row in (await self._convert_batch(rows) if executed else rows):
+                yield row
+        rows = None
+        while executed:
+            batch = await self._call(client.fetch_batch, state, ITER_BATCH_SIZE)
+            if not batch:
+                break
+            for row in await self._convert_batch(batch):
+                yield row
+            executed = len(batch) == ITER_BATCH_SIZE
+        state.store['temp_exec'] = False
 
     # Exposed API
     # ########################################################################
     def status(self):
         print(f'PGWare setup is : {self._params}')
 
-    async def preheat(self):
+    async def preheat(self, prepare=None):
         """
-        Force open connections, instead of doing it lazily
+        Force open connections, instead of doing it lazily, and prepare the
+        given queries on the context's connection
+
+        async or sync
         """
-        oplist = copy.deepcopy(self._setup.op_list)
-        await self._exec_ops(oplist)
+        await self._exec_ops(self._plan())
+        if prepare:
+            await self._call(self._prepare_statements(), self._state, list(prepare))
         return self
 
-    def preheat_sync(self):
+    def preheat_sync(self, prepare=None):
         """
-        Force open connections, instead of doing it lazily
+        Force open connections, instead of doing it lazily, and prepare the
+        given queries on the context's connection
         """
-        oplist = copy.deepcopy(self._setup.op_list)
-        self._exec_ops_sync(oplist)
+        self._exec_ops_sync(self._plan())
+        if prepare:
+            prepared = self._prepare_statements()(self._state, list(prepare))
+            if inspect.isawaitable(prepared):
+                self._setup.loops.run(prepared)
         return self
 
+    def _prepare_statements(self):
+        client = self._setup.client
+        if not supports(client, Context.PREPARED) or not hasattr(client, 'prepare_statements'):
+            raise ProgrammingError('Selected client does not support prepared statements (yet)')
+        return client.prepare_statements
+
     def close_context_sync(self):
         """
-        Clean pgware's state and close all open connections.
+        Close the context (committing its transaction, if any) and clean pgware's state.
         """
-        try:
-            self.closed = True
-            return asyncio.run(self.close_context())
-        except RuntimeError:
-            LOGGER.critical('''Running sync PGWare within eventloop;
-            please refactor to async/await use''')
-            raise ProgrammingError(''''Running sync PGWare within eventloop;
-            please refactor to async/await use''')
+        client = self._setup.client
+        if self._streaming is not None:
+            self._streaming.close_sync()
+        if inspect.iscoroutinefunction(client.close_context):
+            return self._setup.loops.run(self.close_context())
+        LOGGER.debug('Closing pgware context')
+        self.closed = True
+        closed = client.close_context(self._state)
+        self._state.clean()
+        return closed
 
     async def close_context(self):
         """
-        Clean pgware's state and close all open connections.
+        Close the context (committing its transaction, if any) and clean pgware's state.
         """
         LOGGER.debug('Closing pgware context')
         client = self._setup.client
-        self._state.clean()
+        if self._streaming is not None:
+            await self._streaming.close()
         self.closed = True
-        await client.close_context(self._state)
+        await self._call(client.close_context, self._state)
+        self._state.clean()
 
     def add_doodad(self, stage, job, err_handler=lambda e, i: raise_(e)):
         """
@@ -301,18 +587,8 @@ class _Pgware():
             doodad = ('doodad', job, err_handler, False, True)
         else:
             doodad = ('doodad', job, err_handler, False, False)
-        if stage == 'connection':
-            self._setup.op_list['connection'].insert(0, doodad)
-        elif stage == 'parsing':
-            self._setup.op_list['parsing'].insert(0, doodad)
-        elif stage == 'execution':
-            self._setup.op_list['execution'].insert(0, doodad)
-        elif stage == 'result':
-            self._setup.op_list['result'].insert(0, doodad)
-        elif stage == 'errors':
-            self._setup.op_list['errors'].insert(0, doodad)
-        else:
-            raise AttributeError(f'Doodad for stage {stage} not supported')
+        pipeline = self._setup.pipeline.extend(stage, doodad, first=True)
+        self._setup = self._setup._replace(pipeline=pipeline)
 
     # Interface
     # ########################################################################
@@ -334,14 +610,7 @@ class _Pgware():
             self._state.values = retuple(q_p)
         else:
             self._state.query, self._state.values = q_p, retuple(par)
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        # FIXME: One option to do it, maybe better to let the client
-        # patch the execution pipeline
-        # oplist = cl.execute(oplist, self._state.context)
-        oplist['execution'] += [client.execute()]
-        oplist['result'] = []  # Execute statement ignores result parsing
-        await self._exec_ops(oplist)
+        await self._exec_ops(self._plan('execute'))
         return self
 
     def execute_sync(self, q_p, par=None):
@@ -353,41 +622,174 @@ class _Pgware():
             self._state.values = retuple(q_p)
         else:
             self._state.query, self._state.values = q_p, retuple(par)
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        # FIXME: One option to do it, maybe better to let the client
-        # patch the execution pipeline
-        # oplist = cl.execute(oplist, self._state.context)
-        oplist['execution'] += [client.execute()]
-        oplist['result'] = []  # Execute statement ignores result parsing
-        self._exec_ops_sync(oplist)
+        self._exec_ops_sync(self._plan('execute'))
         return self
 
-    async def executemany(self, query, params):
+    async def executemany(self, query, params, page_size=EXECUTEMANY_PAGE_SIZE, rewrite_values=False,  # pylint: disable=too-many-arguments
+                          chunk_size=None, on_progress=None, rowcount=False):
         """
         Execute a statement for each set of parameters
 
             [await] conn.executemany('SELECT $1, $2', [(1, 2), (2, 3), (3, 4)]);
             [await] conn.executemany('SELECT %s, %s', [(1, 2), (2, 3), (3, 4)]);
 
+        psycopg2 sends the statements page_size at a time, and with
+        rewrite_values rewrites INSERT ... VALUES (...) statements into one
+        multi-row INSERT per page. The number of rows affected is set as
+        rowcount, when known: -1 for asyncpg, and psycopg2 pages of other
+        statements unless rowcount is True. Exact rowcounts cost more: pages
+        of INSERT/UPDATE/DELETE statements are then sent as DO blocks adding
+        up their rowcounts, other statements one by one.
+
+        With a chunk_size, params (any iterable, ie: a generator) are
+        consumed and executed chunk_size sets at a time, each chunk being
+        retried on its own; on_progress(executed, rowcount) is called (or
+        awaited) after each chunk with the running totals.
+
         async or sync
         """
-        self._incr('operation_cntr')
-        self._state.query, self._state.valuelist = query, params
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        oplist['execution'] += [client.executemany()]
-        await self._exec_ops(oplist)
+        self.rowcount = 0
+        if chunk_size is None:
+            self._set_executemany(query, params, page_size, rewrite_values, rowcount)
+            self._add_rowcount(await self._exec_ops(self._plan('executemany')))
+            return self
+        executed = 0
+        params = iter(params)
+        chunk = list(itertools.islice(params, chunk_size))
+        while chunk:
+            self._set_executemany(query, chunk, page_size, rewrite_values, rowcount)
+            self._add_rowcount(await self._exec_ops(self._plan('executemany')))
+            executed += len(chunk)
+            if on_progress is not None:
+                progress = on_progress(executed, self.rowcount)
+                if inspect.isawaitable(progress):
+                    await progress
+            chunk = list(itertools.islice(params, chunk_size))
         return self
 
-    def executemany_sync(self, query, params):
+    def executemany_sync(self, query, params, page_size=EXECUTEMANY_PAGE_SIZE, rewrite_values=False,  # pylint: disable=too-many-arguments
+                         chunk_size=None, on_progress=None, rowcount=False):
+        self.rowcount = 0
+        if chunk_size is None:
+            self._set_executemany(query, params, page_size, rewrite_values, rowcount)
+            self._add_rowcount(self._exec_ops_sync(self._plan('executemany')))
+            return self
+        executed = 0
+        params = iter(params)
+        chunk = list(itertools.islice(params, chunk_size))
+        while chunk:
+            self._set_executemany(query, chunk, page_size, rewrite_values, rowcount)
+            self._add_rowcount(self._exec_ops_sync(self._plan('executemany')))
+            executed += len(chunk)
+            if on_progress is not None:
+                on_progress(executed, self.rowcount)
+            chunk = list(itertools.islice(params, chunk_size))
+        return self
+
+    def _set_executemany(self, query, params, page_size, rewrite_values, rowcount):  # pylint: disable=too-many-arguments
         self._incr('operation_cntr')
         self._state.query, self._state.valuelist = query, params
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        oplist['execution'] += [client.executemany()]
-        self._exec_ops_sync(oplist)
-        return self
+        self._state.store['executemany'] = (page_size, rewrite_values, rowcount)
+
+    def _add_rowcount(self, rowcount):
+        """ Add up rowcounts, unknown (-1) as soon as one of them is """
+        if rowcount is None or rowcount < 0 or self.rowcount < 0:
+            self.rowcount = -1
+        else:
+            self.rowcount += rowcount
+
+    async def copy_in(self, table, records, columns=None):
+        """
+        Bulk load records (tuples of values, in columns order) into a table
+        with COPY, returns the number of rows copied
+
+            [await] conn.copy_in('public.big', [(1, 'a'), (2, 'b')], columns=('id', 'name'));
+
+        records can be any iterable, or an async iterable in async mode:
+        they are streamed to the server, not loaded in memory at once.
+        psycopg2 can't stream async iterables, they are copied in chunks of
+        COPY_CHUNK_SIZE rows instead, each chunk in its own COPY.
+
+        async or sync
+        """
+        LOGGER.debug('copy_in table %s | %s', table, columns)
+        self._incr('operation_cntr')
+        self._state.store['copy_in'] = (table, None if columns is None else tuple(columns))
+        if hasattr(records, '__aiter__') and self._plan('copy_in').sync:
+            count = 0
+            chunk = []
+            async for record in records:
+                chunk.append(record)
+                if len(chunk) == COPY_CHUNK_SIZE:
+                    self._state.valuelist = chunk
+                    count += await self._exec_ops(self._plan('copy_in'))
+                    chunk = []
+            if chunk:
+                self._state.valuelist = chunk
+                count += await self._exec_ops(self._plan('copy_in'))
+            return count
+        if hasattr(records, '__aiter__'):
+            self._state.valuelist = _OnceAsyncIterable(records)
+        else:
+            self._state.valuelist = _OnceIterable.wrap(records)
+        return await self._exec_ops(self._plan('copy_in'))
+
+    def copy_in_sync(self, table, records, columns=None):
+        LOGGER.debug('copy_in table %s | %s', table, columns)
+        self._incr('operation_cntr')
+        if hasattr(records, '__aiter__'):
+            raise ProgrammingError('Async iterables can only be copied in async mode')
+        self._state.store['copy_in'] = (table, None if columns is None else tuple(columns))
+        self._state.valuelist = _OnceIterable.wrap(records)
+        return self._exec_ops_sync(self._plan('copy_in'))
+
+    async def copy_out(self, query, sink, par=None, format='csv'):  # pylint: disable=redefined-builtin
+        """
+        Export the result of a query with COPY, as it is sent by the server
+        (format: csv, text or binary), returns the number of rows copied
+
+            [await] conn.copy_out('SELECT * FROM big WHERE a = $1', '/tmp/big.csv', (1,));
+            [await] conn.copy_out('SELECT * FROM big', file_object, format='binary');
+            [await] conn.copy_out('SELECT * FROM big', callback);
+
+        The sink is a path, a binary file object or a callback receiving
+        memoryview chunks: a coroutine function in async mode, a function
+        in sync mode. psycopg2 can't await callbacks while copying: the data
+        is spooled in a temporary file (in memory up to COPY_SPOOL_SIZE
+        bytes), then handed over to the callback.
+
+        async or sync
+        """
+        LOGGER.debug('copy_out statement %s | %s', query, par)
+        if callable(sink) and not hasattr(sink, 'write') and self._plan('copy_out').sync:
+            with tempfile.SpooledTemporaryFile(max_size=COPY_SPOOL_SIZE) as spool:
+                count = await self.copy_out(query, spool, par, format)
+                spool.seek(0)
+                for chunk in iter(lambda: spool.read(2 ** 16), b''):
+                    written = sink(memoryview(chunk))
+                    if inspect.isawaitable(written):
+                        await written
+            return count
+        self._set_copy_out(query, sink, par, format)
+        return await self._exec_ops(self._plan('copy_out'))
+
+    def copy_out_sync(self, query, sink, par=None, format='csv'):  # pylint: disable=redefined-builtin
+        LOGGER.debug('copy_out statement %s | %s', query, par)
+        if inspect.iscoroutinefunction(sink):
+            raise ProgrammingError('Coroutine functions can only receive copies in async mode')
+        self._set_copy_out(query, sink, par, format)
+        return self._exec_ops_sync(self._plan('copy_out'))
+
+    def _set_copy_out(self, query, sink, par, format):  # pylint: disable=redefined-builtin
+        if format not in ('csv', 'text', 'binary'):
+            raise ProgrammingError(f'Unknown COPY format {format}: use csv, text or binary')
+        self._incr('operation_cntr')
+        if self._state.context & Context.PREPARED:
+            self._state.context = self._state.context ^ Context.PREPARED
+        self._state.query, self._state.values = query, retuple(par)
+        if not isinstance(sink, (str, os.PathLike)):
+            sink = _CopySink(sink)
+        self._state.store['copy_out'] = (sink, format)
 
     async def prepare(self, query):
         """
@@ -411,7 +813,9 @@ class _Pgware():
         client = self._setup.client
         if not supports(client, Context.PREPARED):
             raise ProgrammingError('Selected client does not support prepared statements (yet)')
-        self._setup.op_list['execution'] += [client.prepare()]
+        if not self._setup.pipeline.has('execution', 'prepare'):
+            pipeline = self._setup.pipeline.extend('execution', client.prepare())
+            self._setup = self._setup._replace(pipeline=pipeline)
         self._state.context |= self._state.context.PREPARED
         return self
 
@@ -432,10 +836,7 @@ class _Pgware():
             self._state.values = retuple(q_p)
         else:
             self._state.query, self._state.values = q_p, retuple(par)
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        oplist['execution'] += [client.fetchall()]
-        return await self._exec_ops(oplist)
+        return await self._exec_ops(self._plan('fetchall'))
 
     def fetchall_sync(self, q_p=None, par=None):
         LOGGER.debug('fetchall statement %s | %s', q_p, par)
@@ -446,10 +847,7 @@ class _Pgware():
             self._state.values = retuple(q_p)
         else:
             self._state.query, self._state.values = q_p, retuple(par)
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        oplist['execution'] += [client.fetchall()]
-        return self._exec_ops_sync(oplist)
+        return self._exec_ops_sync(self._plan('fetchall'))
 
     async def fetchone(self, q_p=None, par=None):
         """
@@ -468,10 +866,7 @@ class _Pgware():
             self._state.values = retuple(q_p)
         else:
             self._state.query, self._state.values = q_p, retuple(par)
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        oplist['execution'] += [client.fetchone()]
-        return await self._exec_ops(oplist)
+        return await self._exec_ops(self._plan('fetchone'))
 
     def fetchone_sync(self, q_p=None, par=None):
         LOGGER.debug('fetchone statement %s | %s', q_p, par)
@@ -482,10 +877,7 @@ class _Pgware():
             self._state.values = retuple(q_p)
         else:
             self._state.query, self._state.values = q_p, retuple(par)
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        oplist['execution'] += [client.fetchone()]
-        return self._exec_ops_sync(oplist)
+        return self._exec_ops_sync(self._plan('fetchone'))
 
     async def fetchval(self, q_p=None, par=None):
         """
@@ -504,10 +896,7 @@ class _Pgware():
             self._state.values = retuple(q_p)
         else:
             self._state.query, self._state.values = q_p, retuple(par)
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        oplist['execution'] += [client.fetchval()]
-        return await self._exec_ops(oplist)
+        return await self._exec_ops(self._plan('fetchval'))
 
     def fetchval_sync(self, q_p=None, par=None):
         LOGGER.debug('fetchval statement %s | %s', q_p, par)
@@ -518,7 +907,356 @@ class _Pgware():
             self._state.values = retuple(q_p)
         else:
             self._state.query, self._state.values = q_p, retuple(par)
-        client = self._setup.client
-        oplist = copy.deepcopy(self._setup.op_list)
-        oplist['execution'] += [client.fetchval()]
-        return self._exec_ops_sync(oplist)
+        return self._exec_ops_sync(self._plan('fetchval'))
+
+    async def fetchmany(self, size, q_p=None, par=None):
+        """
+        Fetch the next (at most) size result rows: of a SQL query, or
+        left on the cursor by the previous execute or fetchmany
+
+            [await] cur.fetchmany(100, 'SELECT * FROM big WHERE a = $1', (1,));
+            [await] cur.fetchmany(100);
+
+        asyncpg needs a cursor context
+
+        async or sync
+        """
+        LOGGER.debug('fetchmany(%s) statement %s | %s', size, q_p, par)
+        self._incr('operation_cntr')
+        self._set_query(q_p, par)
+        self._state.store['fetch_size'] = size
+        rows = await self._exec_ops(self._plan('fetchmany'))
+        self._state.result = None
+        return rows
+
+    def fetchmany_sync(self, size, q_p=None, par=None):
+        LOGGER.debug('fetchmany(%s) statement %s | %s', size, q_p, par)
+        self._incr('operation_cntr')
+        self._set_query(q_p, par)
+        self._state.store['fetch_size'] = size
+        rows = self._exec_ops_sync(self._plan('fetchmany'))
+        self._state.result = None
+        return rows
+
+    async def iter_batches(self, q_p=None, par=None, size=ITER_BATCH_SIZE):
+        """
+        Iterate over the result rows of a SQL query, in batches of (at most)
+        size rows fetched from the cursor one after the other (see fetchmany)
+
+            [async] for rows in cur.iter_batches('SELECT * FROM big WHERE a = $1', (1,), 500):
+                ...
+
+        async or sync
+        """
+        rows = await self.fetchmany(size, q_p, par)
+        count = self._batch_rows(rows)
+        while count:
+            yield rows
+            if count < size:
+                return
+            rows = await self.fetchmany(size)
+            count = self._batch_rows(rows)
+
+    def iter_batches_sync(self, q_p=None, par=None, size=ITER_BATCH_SIZE):
+        rows = self.fetchmany_sync(size, q_p, par)
+        count = self._batch_rows(rows)
+        while count:
+            yield rows
+            if count < size:
+                return
+            rows = self.fetchmany_sync(size)
+            count = self._batch_rows(rows)
+
+    def _batch_rows(self, rows):
+        # Columnar batches are dicts of column name => values
+        if self._state.context & Context.OUTPUT_COLUMNAR:
+            return len(next(iter(rows.values()))) if rows else 0
+        return len(rows) if rows else 0
+
+    def stream(self, q_p=None, par=None, batch_size=1000):
+        """
+        Stream the result rows of a SQL query from a server-side cursor
+        (asyncpg cursor, psycopg2 named cursor), fetching them batch_size at
+        a time. Needs a cursor context, whose transaction the cursor lives in:
+
+            [async] with pgw.get_connection().cursor() as cur:
+                rows = cur.stream('SELECT * FROM big WHERE a = $1', (1,), batch_size=5000)
+                [await] rows.fetchmany(10)
+                [async] for row in rows:
+                    ...
+
+        The cursor is opened on first use and closed once exhausted, or along
+        with the context. With asyncpg in async mode, the next batch is
+        fetched while the current one is consumed.
+
+        async or sync
+        """
+        LOGGER.debug('stream statement %s | %s', q_p, par)
+        if not hasattr(self._setup.client, 'stream_batch'):
+            raise ProgrammingError('Selected client does not support streaming (yet)')
+        if not self._state.context & Context.CURSOR:
+            raise ProgrammingError('Streaming needs a cursor context: use get_connection().cursor()')
+        self._incr('operation_cntr')
+        return _Stream(self, q_p, par, batch_size)
+
+    def _set_query(self, q_p, par):
+        if isinstance(q_p, str) and self._state.context & Context.PREPARED:
+            self._state.context = self._state.context ^ Context.PREPARED
+        if self._state.context & Context.PREPARED:
+            self._state.values = retuple(q_p)
+        else:
+            self._state.query, self._state.values = q_p, retuple(par)
+
+    async def _convert_batch(self, batch):
+        """
+        Run a batch of streamed rows through the result stage
+        (rows are output as dicts in columnar mode)
+        """
+        ops = self._setup.pipeline.ops['result']
+        if not ops or not batch:
+            return batch
+        context = self._state.context
+        if context & Context.OUTPUT_COLUMNAR:
+            self._state.context = context ^ Context.OUTPUT_COLUMNAR | Context.OUTPUT_DICT
+        self._state.result = batch
+        try:
+            state = await self._exec_stage('result', ops, self._state)
+        finally:
+            self._state.context = context
+        batch, state.result = state.result, None
+        return batch
+
+    def _convert_batch_sync(self, batch):
+        ops = self._setup.pipeline.ops['result']
+        if not ops or not batch:
+            return batch
+        context = self._state.context
+        if context & Context.OUTPUT_COLUMNAR:
+            self._state.context = context ^ Context.OUTPUT_COLUMNAR | Context.OUTPUT_DICT
+        self._state.result = batch
+        try:
+            if self._plan('fetchall').sync:
+                state = self._exec_stage_sync('result', ops, self._state)
+            else:
+                state = self._setup.loops.run(self._exec_stage('result', ops, self._state))
+        finally:
+            self._state.context = context
+        batch, state.result = state.result, None
+        return batch
+
+
+class _Stream():
+    """
+    Result rows of a streamed query (see _Pgware.stream), fetched batch by
+    batch from a server-side cursor. Rows can be iterated over, or fetched
+    n at a time with fetchmany.
+    """
+
+    def __init__(self, pgw, q_p, par, batch_size):
+        self._pgw = pgw
+        self._query = (q_p, par)
+        self._batch_size = batch_size
+        self._rows = []  # fetched rows, not consumed yet
+        self._pending = None  # prefetch of the next batch
+        self._opened = False
+        self._closing = None  # set once closed
+        self.closed = False
+        if pgw._sync:
+            self.fetchmany = self.fetchmany_sync
+            self.close = self.close_sync
+
+    def __iter__(self):
+        try:
+            while self._rows or self._fill_sync():
+                rows, self._rows = self._rows, []
+                yield from rows
+        finally:
+            self.close_sync()
+
+    async def __aiter__(self):
+        try:
+            while self._rows or await self._fill():
+                rows, self._rows = self._rows, []
+                for row in rows:
+                    yield row
+        finally:
+            await self.close()
+
+    async def fetchmany(self, size):
+        """
+        Fetch the next (at most) size rows
+
+        async or sync
+        """
+        while len(self._rows) < size and await self._fill():
+            pass
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchmany_sync(self, size):
+        while len(self._rows) < size and self._fill_sync():
+            pass
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    async def _fill(self):
+        """
+        Fetch the next batch, returns whether there was any row left
+        """
+        if self.closed:
+            return False
+        pgw = self._pgw
+        client = pgw._setup.client
+        if not self._opened:
+            if pgw._streaming is not None:
+                await pgw._streaming.close()
+            pgw._set_query(*self._query)
+            await pgw._exec_ops(pgw._plan('stream'))
+            pgw._streaming = self
+            self._opened = True
+        if self._pending is not None:
+            batch, self._pending = await self._pending, None
+        else:
+            batch = await pgw._call(client.stream_batch, pgw._state, self._batch_size)
+        if len(batch) < self._batch_size:
+            await self.close()
+        elif inspect.iscoroutinefunction(client.stream_batch):
+            self._pending = asyncio.ensure_future(client.stream_batch(pgw._state, self._batch_size))
+        self._rows += await pgw._convert_batch(batch)
+        return bool(batch)
+
+    def _fill_sync(self):
+        if self.closed:
+            return False
+        pgw = self._pgw
+        client = pgw._setup.client
+        if not self._opened:
+            if pgw._streaming is not None:
+                pgw._streaming.close_sync()
+            pgw._set_query(*self._query)
+            pgw._exec_ops_sync(pgw._plan('stream'))
+            pgw._streaming = self
+            self._opened = True
+        batch = client.stream_batch(pgw._state, self._batch_size)
+        if inspect.isawaitable(batch):
+            batch = pgw._setup.loops.run(batch)
+        if len(batch) < self._batch_size:
+            self.close_sync()
+        self._rows += pgw._convert_batch_sync(batch)
+        return bool(batch)
+
+    async def settle(self):
+        """
+        Wait for the prefetch of the next batch to be over: its failure is
+        raised when the batch is awaited, if it ever is
+        """
+        pending = self._pending
+        if pending is None:
+            return
+        if not pending.done():
+            await asyncio.wait([pending])
+        if not pending.cancelled():
+            # Retrieved, asyncio would log it once the abandoned stream is gone
+            pending.exception()
+
+    async def close(self):
+        """
+        Close the stream's cursor. Streams left by an async for are closed
+        in a task of their own, later on: the stream stays the context's
+        one until then, so that the next one waits for it
+
+        async or sync
+        """
+        if self._closing is not None:
+            await self._closing.wait()
+            return
+        self._closing = asyncio.Event()
+        self.closed = True
+        try:
+            if self._pending is not None:
+                await self.settle()
+                self._pending = None
+            if self._pgw._streaming is self:
+                hook = getattr(self._pgw._setup.client, 'close_stream', None)
+                if hook is not None:
+                    await self._pgw._call(hook, self._pgw._state)
+        finally:
+            if self._pgw._streaming is self:
+                self._pgw._streaming = None
+            self._closing.set()
+
+    def close_sync(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._pgw._streaming is self:
+            self._pgw._streaming = None
+            hook = getattr(self._pgw._setup.client, 'close_stream', None)
+            if hook is not None:
+                closing = hook(self._pgw._state)
+                if inspect.isawaitable(closing):
+                    self._pgw._setup.loops.run(closing)
+
+
+class _OnceIterable():
+    """
+    Guard around an iterator: records consumed by a failed copy can't be
+    replayed on retry, fail instead of silently copying what's left
+    """
+
+    def __init__(self, records):
+        self._records = records
+        self._used = False
+
+    @classmethod
+    def wrap(cls, records):
+        # Collections can be iterated again, only iterators need guarding
+        if iter(records) is records:
+            return cls(records)
+        return records
+
+    def __iter__(self):
+        if self._used:
+            raise UnrecoverableError('Copy failed after consuming records from an iterator, they can not be copied again')
+        self._used = True
+        return iter(self._records)
+
+
+class _OnceAsyncIterable(_OnceIterable):
+
+    def __aiter__(self):
+        if self._used:
+            raise UnrecoverableError('Copy failed after consuming records from an iterator, they can not be copied again')
+        self._used = True
+        return self._records.__aiter__()
+
+
+class _CopySink():
+    """
+    Writer to a copy_out file object or callback: on retry, file objects
+    are rewound when possible, data can't be taken back from others: fail
+    instead of writing it twice
+    """
+
+    def __init__(self, sink):
+        if hasattr(sink, 'write'):
+            self._write = sink.write
+            self._file = sink if getattr(sink, 'seekable', lambda: False)() else None
+        else:
+            self._write = lambda data: sink(memoryview(data))
+            self._file = None
+        self._start = self._file.tell() if self._file else None
+        self._written = False
+
+    def restart(self):
+        if not self._written:
+            return
+        if self._file is None:
+            raise UnrecoverableError('Copy failed after writing data to its sink, it can not be copied again')
+        self._file.seek(self._start)
+        self._file.truncate()
+        self._written = False
+
+    def __call__(self, data):
+        self._written = True
+        return self._write(data)
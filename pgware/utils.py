@@ -1,5 +1,20 @@
+import operator
+import re
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import repeat
+
 from .exceptions import QueryError
 
+try:
+    import numpy
+except ImportError:  # optional, for columnar output
+    numpy = None
+
+COLUMN_DTYPES = {bool: 'bool', int: 'int64', float: 'float64'}
+# Converted queries kept by ps2pg/pg2ps
+QUERY_CACHE_SIZE = 1024
+
 # Utility functions
 
 
@@ -9,83 +24,156 @@ def ps2pg(q_in, v_in):
     - supports named arguments
     - keeps order of values
     - multiple reference will result in multiple values, cost of uniqueness check not worth it
+    - %% escapes become %, placeholders within literals, quoted identifiers
+      and comments are left as is
     """
     if isinstance(v_in, dict):
         return ps2pg_dict(q_in, v_in)
     if not isinstance(v_in, tuple):
         v_in = [v_in]
-    q_out = []
-    v_out = []
-    arg_count = 0
-    skip = False
-    for i, elm in enumerate(q_in):
-        if skip and elm == 's':
-            skip = not skip
-        elif elm == '%' and q_in[i + 1] == 's':
-            arg_count += 1
-            skip = not skip
-            q_out.append(f'${arg_count}')
-            v_out.append(v_in[arg_count - 1])
-        else:
-            q_out.append(elm)
-    if skip:
-        raise QueryError('Query argument converter failed: check query')
-    return ''.join(q_out), tuple(v_out)
+    q_out, plan = _ps2pg_plan(q_in)
+    return q_out, _remap(plan, v_in)
 
 
 def ps2pg_dict(q_in, v_in):
-    q_out = []
-    v_out = []
-    skip = False
-    buff = []
-    for i, elm in enumerate(q_in):
-        if skip and elm in ['(', ')']:
-            pass
-        elif skip and q_in[i - 1:i + 1] == ')s':
-            v_out.append(v_in[''.join(buff)])
-            q_out.append(str(len(v_out)))
-            buff = []
-            skip = not skip
-        elif skip:
-            buff.append(elm)
-        elif elm == '%' and q_in[i + 1] == '(':
-            q_out.append('$')
-            skip = not skip
-        else:
-            q_out.append(elm)
-    if skip:
-        raise QueryError('Query argument converter failed: check query')
-    return ''.join(q_out), tuple(v_out)
+    q_out, plan = _ps2pg_dict_plan(q_in)
+    return q_out, _remap(plan, v_in)
 
 
 def pg2ps(q_in, v_in):
     """
     Convert postgresql query argument syntax to psycopg2 syntax
     - keeps order of values
-    - fails if using double-dollar quotes with a number as first character (don't ;p)
+    - % are escaped as %%, placeholders within literals, dollar quotes,
+      quoted identifiers and comments are left as is
     """
-    q_out = []
-    v_out = []
-    skip = False
-    buff = []
     if not isinstance(v_in, tuple):
         v_in = [v_in]
-    for i, elm in enumerate(q_in):
-        if skip and ord(elm) in range(48, 58):
-            buff.append(elm)
-        elif skip:
-            skip = not skip
-            v_out.append(v_in[int(''.join(buff)) - 1])
-            q_out.append(elm)
-            buff = []
-        elif elm == '$' and ord(q_in[i + 1]) in range(48, 58):
+    q_out, plan = _pg2ps_plan(q_in)
+    return q_out, _remap(plan, v_in)
+
+
+def ps2pg_query(q_in):
+    """
+    Convert a psycopg2 syntax query to postgresql syntax, without values
+    (ie: to prepare it ahead of its execution)
+    """
+    try:
+        return _ps2pg_plan(q_in)[0]
+    except QueryError:
+        # Named arguments
+        return _ps2pg_dict_plan(q_in)[0]
+
+
+def pg2ps_query(q_in):
+    """
+    Convert a postgresql syntax query to psycopg2 syntax, without values
+    """
+    return _pg2ps_plan(q_in)[0]
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def cast_params(q_in, types):
+    """
+    Cast the $n placeholders of a postgresql syntax query to the matching
+    type, if any: ie, ('integer', None) turns "$1 + $2" into "$1::integer + $2"
+    """
+    q_out = []
+    pos = 0
+    for match in SQL_TOKENS.finditer(q_in):
+        if match.lastgroup != 'number':
+            continue
+        type_ = types[int(match.group('number')) - 1]
+        if type_ is not None:
+            q_out.append(q_in[pos:match.end()])
+            q_out.append('::' + type_)
+            pos = match.end()
+    q_out.append(q_in[pos:])
+    return ''.join(q_out)
+
+
+# Queries are converted once: their converted text is cached along with a
+# plan of the values to pick (indexes or keys), in order
+
+# Every token a conversion cares about, in one pass: text in between is
+# copied as is. Unterminated literals aren't tokens, the server will
+# complain about them.
+SQL_TOKENS = re.compile(r"""
+    (?=[-'"$%/eE])                                          # quick check of the first character
+    (?:
+        (?P<quoted>
+            [eE](?<![\w$][eE])'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'   # escape string
+          | '[^']*(?:''[^']*)*'                             # string
+          | "[^"]*(?:""[^"]*)*"                             # quoted identifier
+          | \$(?<![\w$]\$)(?P<tag>(?:[^\W\d]\w*)?)\$.*?\$(?P=tag)\$   # dollar quote
+          | --[^\n]*                                        # line comment
+          | /\*.*?\*/                                       # block comment
+        )
+      | (?P<escape>%%)
+      | %\((?P<name>[^)]*)\)s
+      | (?P<positional>%s)
+      | \$(?<![\w$]\$)(?P<number>\d+)
+      | (?P<percent>%)
+    )
+""", re.VERBOSE | re.DOTALL)
+
+
+def _remap(plan, v_in):
+    return tuple([v_in[key] for key in plan])
+
+
+def _ps_plan(q_in, named):
+    q_out = []
+    plan = []
+    pos = 0
+    for match in SQL_TOKENS.finditer(q_in):
+        q_out.append(q_in[pos:match.start()])
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'quoted':
+            q_out.append(match.group().replace('%%', '%'))
+        elif kind == 'escape':
+            q_out.append('%')
+        elif kind == 'name' and named:
+            plan.append(match.group('name'))
+            q_out.append(f'${len(plan)}')
+        elif kind == 'positional' and not named:
+            plan.append(len(plan))
+            q_out.append(f'${len(plan)}')
+        elif kind in ('name', 'positional'):
+            raise QueryError('Query argument converter failed: named and positional arguments are mixed')
+        else:
+            q_out.append(match.group())
+    q_out.append(q_in[pos:])
+    return ''.join(q_out), tuple(plan)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _ps2pg_plan(q_in):
+    return _ps_plan(q_in, named=False)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _ps2pg_dict_plan(q_in):
+    return _ps_plan(q_in, named=True)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _pg2ps_plan(q_in):
+    q_out = []
+    plan = []
+    pos = 0
+    for match in SQL_TOKENS.finditer(q_in):
+        q_out.append(q_in[pos:match.start()])
+        pos = match.end()
+        if match.lastgroup == 'number':
+            plan.append(int(match.group('number')) - 1)
             q_out.append('%s')
-            skip = not skip
         else:
-            q_out.append(elm)
-    if skip:
-        raise QueryError('Query argument converter failed: check query')
-    return ''.join(q_out), tuple(v_out)
+            # psycopg2 interpolates the whole query, literals included
+            q_out.append(match.group().replace('%', '%%'))
+    q_out.append(q_in[pos:])
+    return ''.join(q_out), tuple(plan)
 
 
 def config_map(configmap, config):
@@ -119,3 +207,60 @@ def raise_(ex):
 
 def supports(client, flag):
     return client.__supports__ & flag
+
+
+def columnar(rows, names):
+    """
+    Pivot result rows into a dict of column name => numpy array: columns of
+    booleans, integers or floats without nulls get the matching numpy dtype,
+    others the object dtype
+    """
+    # list.__getitem__ bypasses the (slow) overload of list subclasses, ie: psycopg2 DictRow
+    getitem = list.__getitem__ if rows and isinstance(rows[0], list) else operator.getitem
+    return {name: _column_array(list(map(getitem, rows, repeat(i)))) for i, name in enumerate(names)}
+
+
+def _column_array(values):
+    dtype = COLUMN_DTYPES.get(type(values[0])) if values else None
+    if dtype is not None and None not in values:
+        try:
+            return numpy.fromiter(values, dtype=dtype, count=len(values))
+        except (TypeError, ValueError, OverflowError):
+            # Mixed types, out of range integers, ...
+            pass
+    return numpy.fromiter(values, dtype=object, count=len(values))
+
+
+class LRUCache():
+    """
+    Least recently used cache of at most size items: put returns the
+    (key, value) pair it evicted, if any, to be cleaned up by the caller
+    """
+    def __init__(self, size):
+        self._size = size
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self._size:
+            return self._items.popitem(last=False)
+        return None
+
+    def pop(self, key):
+        return self._items.pop(key, None)
+
+    def values(self):
+        return list(self._items.values())
+
+    def clear(self):
+        self._items.clear()
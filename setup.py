@@ -16,7 +16,7 @@ setup(
     long_description=long_description(),
     packages=find_packages(),
     install_requires=["py-dateutil", "asyncpg", "psycopg2-binary"],
-    extras_require={},
+    extras_require={"columnar": ["numpy"]},
     python_requires=">=3.7",
     setup_requires=["setuphelpers"],
     tests_require=["pytest", "pytest-asyncio", "pytest-cov", "coverage", "pylint", "flake8"],
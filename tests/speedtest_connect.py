@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# pylint: skip-file
+"""
+Benchmark of asyncpg connections set up with all of pgware's codec
+extensions, with the codec types introspected on every connection (plain
+asyncpg connections) or once per builder (pgware's connection class)
+"""
+
+import asyncio
+import logging
+import time
+
+import asyncpg
+
+from pgware.client.asyncpg_client import Extensions, TypeCachingConnection
+
+logging.disable(logging.CRITICAL)
+
+CONNECTIONS = 50
+REPEAT = 5
+EXTENSIONS = ['json', 'dec2float', 'str2dt', 'str2str']
+SETUP = {
+    'database': '[DB]',
+    'user': '[USER]',
+    'password': None,
+    'host': '[HOST]',
+    'port': None,
+}
+
+
+async def connect(connection_class, extensions):
+    start = time.perf_counter()
+    for _ in range(CONNECTIONS):
+        connection = await asyncpg.connect(connection_class=connection_class, **SETUP)
+        for ext in extensions:
+            await Extensions.apply(ext, connection)
+        await connection.close()
+    return (time.perf_counter() - start) / CONNECTIONS
+
+
+async def test(label, connection_class, extensions):
+    best = min([await connect(connection_class, extensions) for _ in range(REPEAT)])
+    print(f'{label}:\t{best * 1e3:.2f}ms/connection')
+    return best
+
+
+async def main():
+    print(f'## asyncpg {asyncpg.__version__} connections, best of {REPEAT} * {CONNECTIONS}')
+    base = await test('no extension', asyncpg.Connection, [])
+    plain = await test('extensions', asyncpg.Connection, EXTENSIONS)
+    cached_class = type('TypeCachingConnection', (TypeCachingConnection,), {'_type_records': {}})
+    cached = await test('extensions, cached types', cached_class, EXTENSIONS)
+    print(f'codec setup: {(plain - base) * 1e3:.2f}ms/connection, {(cached - base) * 1e3:.2f}ms with cached types')
+
+
+asyncio.run(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# pylint: skip-file
+"""
+Bulk loading benchmark: copy_in against executemany, for both clients,
+loading 10k, 100k and 1M rows. executemany is only timed up to
+EXECUTEMANY_MAX_ROWS rows, it takes minutes beyond.
+"""
+
+import asyncio
+import logging
+import time
+
+import pgware as pgware
+
+logging.basicConfig(level=logging.WARNING)
+
+config = {
+    'database': '[DB]',
+    'user': '[USER]',
+    'password': None,
+    'host': '[HOST]',
+    'port': None,
+    'connection_type': 'single',
+}
+
+SIZES = [10000, 100000, 1000000]
+EXECUTEMANY_MAX_ROWS = 100000
+TABLE = 'pgware_speedtest_copy'
+INSERT = {
+    'asyncpg': f'INSERT INTO {TABLE} VALUES ($1, $2, $3)',
+    'psycopg2': f'INSERT INTO {TABLE} VALUES (%s, %s, %s)',
+}
+
+
+def records(count):
+    return ((i, f'name {i}', i * .5) for i in range(count))
+
+
+def reset(conn):
+    conn.execute(f'DROP TABLE IF EXISTS {TABLE}')
+    conn.execute(f'CREATE UNLOGGED TABLE {TABLE} (id int, name text, value float)')
+
+
+def timed(fun):
+    start = time.perf_counter()
+    fun()
+    return time.perf_counter() - start
+
+
+async def async_copy(client, count):
+    pgw = pgware.build(client=client, output='list', **config)
+    async with pgw.get_connection() as conn:
+        await conn.copy_in(TABLE, records(count))
+    await pgw.close_all()
+
+
+print(f'## Bulk loading, seconds (rows/s)')
+for client in ['asyncpg', 'psycopg2']:
+    pgw = pgware.build(client=client, output='list', **config)
+    with pgw.get_connection() as conn:
+        for count in SIZES:
+            reset(conn)
+            copy = timed(lambda: conn.copy_in(TABLE, records(count)))
+            reset(conn)
+            copy_async = timed(lambda: asyncio.run(async_copy(client, count)))
+            line = f'{client}, {count} rows:\tcopy_in {copy:.2f}s ({count / copy:.0f}/s)'
+            line += f'\tasync copy_in {copy_async:.2f}s ({count / copy_async:.0f}/s)'
+            if count <= EXECUTEMANY_MAX_ROWS:
+                reset(conn)
+                many = timed(lambda: conn.executemany(INSERT[client], list(records(count))))
+                line += f'\texecutemany {many:.2f}s ({count / many:.0f}/s), x{many / copy:.1f}'
+            print(line)
+        conn.execute(f'DROP TABLE {TABLE}')
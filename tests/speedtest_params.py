@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# pylint: skip-file
+"""
+Micro-benchmark of query argument syntax conversion (ps2pg / pg2ps), for
+queries of about 200, 600 and 2000 characters: first conversion of a query
+(cache cleared every time), with the tokenizer's throughput, against
+conversions of a query already seen.
+"""
+
+import timeit
+
+from pgware import utils
+
+CALLS = 10000
+REPEAT = 5
+
+
+def query(conditions, style):
+    where = ' AND '.join(
+        f"t.column_{i} = {style(i)} AND t.label_{i} <> 'unused value {i}'" for i in range(conditions)
+    )
+    return f'SELECT t.id, t.name, t.created_at FROM some_schema.some_table t WHERE {where} ORDER BY t.id LIMIT 100'
+
+
+QUERIES = {
+    'ps2pg': (lambda i: '%s', lambda n: tuple(range(n))),
+    'ps2pg dict': (lambda i: f'%(value_{i})s', lambda n: {f'value_{i}': i for i in range(n)}),
+    'pg2ps': (lambda i: f'${i + 1}', lambda n: tuple(range(n))),
+}
+CONVERTERS = {'ps2pg': utils.ps2pg, 'ps2pg dict': utils.ps2pg, 'pg2ps': utils.pg2ps}
+
+
+def clear():
+    utils._ps2pg_plan.cache_clear()
+    utils._ps2pg_dict_plan.cache_clear()
+    utils._pg2ps_plan.cache_clear()
+
+
+def test(fun):
+    return min(timeit.repeat(fun, number=CALLS, repeat=REPEAT)) / CALLS * 1e6
+
+
+print(f'## Query argument conversion, best of {REPEAT} * {CALLS} calls')
+for name, (style, values) in QUERIES.items():
+    convert = CONVERTERS[name]
+    for conditions in [2, 8, 30]:
+        sql, args = query(conditions, style), values(conditions)
+        cold = test(lambda: (clear(), convert(sql, args)))
+        warm = test(lambda: convert(sql, args))
+        print(
+            f'{name}, {len(sql)} chars:\t{cold:.1f}µs/call uncached ({len(sql) / cold:.1f}MB/s)'
+            f'\t{warm:.2f}µs/call cached\tx{cold / warm:.0f}'
+        )
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# pylint: skip-file
+"""
+Micro-benchmark of pgware's own overhead: runs queries through the execution
+pipeline against a dummy client (no database involved), with 0, 5 and 20
+doodads in the execution stage.
+"""
+
+import asyncio
+import logging
+import timeit
+import types
+
+from pgware import doodad, provider
+from pgware.main import Context, EventLoops, Pipeline, Setup, State, _PgwareBuilder
+
+logging.disable(logging.CRITICAL)
+
+QUERIES = 1000
+REPEAT = 5
+
+
+def error_handler(ex, state):
+    return None
+
+
+async def close(state):
+    pass
+
+
+def dummy_provider(name, reuse=False):
+    @provider(reuse=reuse)
+    def job_provider():
+        def job(state):
+            state.result = [(1,)]
+            yield state
+
+        return job, error_handler
+    job_provider.__name__ = name
+    return job_provider
+
+
+def dummy_client():
+    client = types.SimpleNamespace(
+        __backend__='dummy',
+        __supports__=Context(False),
+        close_context=close,
+        close_connection=close,
+    )
+    for name in ['execute', 'executemany', 'fetchval', 'fetchone', 'fetchall']:
+        setattr(client, name, dummy_provider(name))
+    client.single_connect = dummy_provider('single_connect', reuse=True)
+    return client
+
+
+@doodad
+def nothing(state):
+    yield state
+
+
+def builder(doodads):
+    client = dummy_client()
+    pgw = _PgwareBuilder(
+        setup=Setup(
+            client=client,
+            pipeline=Pipeline(client, {'connection': [client.single_connect()]}),
+            loops=EventLoops(),
+            cmd_dict={}
+        ),
+        state=State(store={}, context=Context.SINGLE)
+    )
+    for _ in range(doodads):
+        pgw.add_doodad('execution', nothing)
+    return pgw
+
+
+def sync_run(pgw):
+    with pgw.get_connection() as conn:
+        for _ in range(QUERIES):
+            conn.fetchone('SELECT 1')
+
+
+async def async_run(pgw):
+    async with pgw.get_connection() as conn:
+        for _ in range(QUERIES):
+            await conn.fetchone('SELECT 1')
+
+
+def test(label, fun):
+    best = min(timeit.repeat(fun, number=1, repeat=REPEAT))
+    per_op = best / QUERIES * 1e6
+    print(f'{label}:\t{per_op:.1f}µs/query')
+    return per_op
+
+
+print(f'## pgware overhead, best of {REPEAT} * {QUERIES} queries')
+for mode in ['sync', 'async']:
+    base = None
+    for doodads in [0, 5, 20]:
+        pgw = builder(doodads)
+        if mode == 'sync':
+            fun = lambda: sync_run(pgw)  # noqa
+        else:
+            fun = lambda: asyncio.run(async_run(pgw))  # noqa
+        per_op = test(f'{mode}, {doodads} doodads', fun)
+        if base is None:
+            base = per_op
+        else:
+            print(f'\t\t\t{(per_op - base) / doodads:.2f}µs/doodad')
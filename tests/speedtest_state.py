@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# pylint: skip-file
+"""
+Micro-benchmark of the execution pipeline state: attribute access and
+instantiation cost of the plain slotted State, against a replica of the
+former State checking for debug tracing on every access.
+"""
+
+import timeit
+import uuid
+
+from pgware.main import DD, Context, State  # noqa: F401
+
+NUMBER = 1000000
+REPEAT = 5
+
+
+class CheckedState(State):
+    """ Former State: debug flags checked on every access, two uuids per instance """
+    __slots__ = ['_v']
+
+    def __init__(self, *args, **kwargs):
+        object.__setattr__(self, '_me', uuid.uuid4())
+        object.__setattr__(self, '_v', 0)
+        self._me = uuid.uuid4()
+        super().__init__(*args, **kwargs)
+
+    def __getattribute__(self, attr):
+        if DD.STATE ^ DD.DEEP:
+            print(attr)
+        return object.__getattribute__(self, attr)
+
+    def __setattr__(self, attr, value):
+        if DD.STATE ^ DD.DEEP:
+            print(attr)
+        object.__setattr__(self, attr, value)
+
+
+def test(label, stmt, setup, number=NUMBER):
+    best = min(timeit.repeat(stmt, setup, number=number, repeat=REPEAT, globals=globals()))
+    per_op = best / number * 1e9
+    print(f'{label}:\t{per_op:.0f}ns')
+    return per_op
+
+
+print(f'## State cost, best of {REPEAT}')
+for label, stmt, number in [
+    ('get', 'state.query', NUMBER),
+    ('set', 'state.query = "SELECT 1"', NUMBER),
+    ('get unset', 'state.unknown', NUMBER),
+    ('new', 'cls(store={}, context=Context.SINGLE)', NUMBER // 10),
+]:
+    before = test(f'{label}, before', stmt, 'cls = CheckedState; state = cls()', number)
+    after = test(f'{label}, after', stmt, 'cls = State; state = cls()', number)
+    print(f'\t\t\tx{before / after:.1f}')
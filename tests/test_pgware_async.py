@@ -8,7 +8,7 @@ pytestmark = pytest.mark.asyncio
 
 def pytest_generate_tests(metafunc):
     if 'db_cfg' in metafunc.fixturenames:
-        metafunc.parametrize('db_cfg', ['asyncpg', 'psycopg2'], indirect=True)
+        metafunc.parametrize('db_cfg', ['asyncpg', 'psycopg2', 'asyncpsycopg2'], indirect=True)
 
 
 @pytest.fixture
@@ -36,6 +36,70 @@ async def test_preheat(db_cfg, event_loop):
         pass
 
 
+async def test_preheat_pooled(db_cfg, event_loop):
+    db_cfg['connection_type'] = 'pooled'
+    pgw = pgware.build(output='list', param_format='psycopg2', max_size=3, **db_cfg)
+    await pgw.preheat_async(min_connections=3, prepare=['SELECT %(a)s::int + 1'])
+    if db_cfg['client'] == 'asyncpg':
+        # Pooled connections' statements only last for an acquisition
+        assert pgw._meta['statement_miss_cntr'] == 0
+        await pgw.close_all()
+        return
+    # Prepared once on each of the connections, held at once
+    assert pgw._meta['statement_miss_cntr'] == 3
+    async with pgw.get_connection() as conn:
+        await conn.prepare('SELECT %(a)s::int + 1')
+        assert await conn.fetchval({'a': 1}) == 2
+    assert pgw._meta['statement_miss_cntr'] == 3
+    assert pgw._meta['statement_hit_cntr'] == 1
+    await pgw.close_all()
+
+
+async def test_preheat_over_max_size(db_cfg, event_loop, monkeypatch):
+    import time
+    db_cfg['connection_type'] = 'pooled'
+    pgw = pgware.build(output='list', param_format='postgresql', max_size=2, **db_cfg)
+    # Only as many connections as the pool can open
+    await pgw.preheat_async(min_connections=5, prepare=['SELECT $1::int + 1'])
+    assert pgw._meta['statement_miss_cntr'] == (0 if db_cfg['client'] == 'asyncpg' else 2)
+    # One of them is in use: the preheated one is given back after a while
+    monkeypatch.setattr(pgware.main, 'PREHEAT_TIMEOUT', 0.2)
+    async with pgw.get_connection() as conn:
+        await conn.execute('SELECT 1')
+        start = time.monotonic()
+        await pgw.preheat_async(min_connections=2)
+        assert time.monotonic() - start < 2
+    await pgw.close_all()
+
+
+async def test_codec_types_cached(db_cfg, event_loop):
+    if db_cfg['client'] != 'asyncpg':
+        pytest.skip('asyncpg codecs')
+    from pgware.client import asyncpg_client
+    if not asyncpg_client.INTROSPECTS_BUILTIN_TYPES:
+        pytest.skip('builtin codec types are not introspected by this asyncpg version')
+    import asyncpg
+    introspected = []
+    introspect = asyncpg.Connection._introspect_type
+
+    async def counting(self, typename, schema):
+        introspected.append(typename)
+        return await introspect(self, typename, schema)
+
+    db_cfg['connection_type'] = 'pooled'
+    pgw = pgware.build(output='dict', extensions=['json', 'dec2float'], max_size=3, **db_cfg)
+    asyncpg.Connection._introspect_type = counting
+    try:
+        await pgw.preheat_async(min_connections=3)
+    finally:
+        asyncpg.Connection._introspect_type = introspect
+    # Once per builder, not per connection
+    assert sorted(introspected) == ['json', 'jsonb', 'numeric']
+    async with pgw.get_connection() as conn:
+        assert await conn.fetchone('SELECT $1::jsonb AS a, 1.5::numeric AS b', ({'c': 1},)) == {'a': {'c': 1}, 'b': 1.5}
+    await pgw.close_all()
+
+
 async def test_cursor(db_cfg, event_loop):
     pgw = pgware.build(output='dict', **db_cfg)
     async with pgw.get_connection().cursor():
@@ -154,6 +218,24 @@ async def test_prepared_query_params_psycopg2(db_cfg, event_loop):
         assert('ketchup' == result['two'])
 
 
+async def test_prepared_statements_lost(db_cfg, event_loop):
+    if db_cfg['client'] == 'asyncpg':
+        pytest.skip('psycopg2 statement registry')
+    pgw = pgware.build(output='list', param_format='postgresql', **db_cfg)
+    statements = "SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'pgware_%'"
+    async with pgw.get_connection() as conn:
+        await conn.prepare('SELECT $1::int + 1')
+        assert await conn.fetchval((1,)) == 2
+        await conn.execute('PREPARE mine AS SELECT 1')
+        await conn.execute('DEALLOCATE ' + await conn.fetchval("SELECT name FROM pg_prepared_statements WHERE name LIKE 'pgware_%'"))
+        await conn.prepare('SELECT $1::int + 1')
+        assert await conn.fetchval((2,)) == 3
+        # Only pgware statements are deallocated to recover
+        assert await conn.fetchval("SELECT count(*) FROM pg_prepared_statements WHERE name = 'mine'") == 1
+        assert await conn.fetchval(statements) == 1
+        await conn.execute('DEALLOCATE mine')
+
+
 async def test_public_methods(db_cfg, event_loop):
     pgw = pgware.build(output='dict', param_format='postgresql', **db_cfg)
     # Test all methods in all possible combinations
@@ -381,3 +463,249 @@ async def test_iterator(db_cfg, event_loop):
         assert out[0]['one'] == 'pgware'
         assert out[1]['one'] == 'pgloop'
         assert out[2]['one'] == 'pglimp'
+
+
+async def test_concurrent_pooled_contexts(db_cfg, event_loop):
+    import asyncio
+    pgw = pgware.build(output='list', param_format='postgresql', **{**db_cfg, 'connection_type': 'pooled', 'max_size': 10})
+
+    async def query(i):
+        async with pgw.get_connection() as conn:
+            await asyncio.sleep(0)
+            val = await conn.fetchval('SELECT $1::int', (i,))
+            await asyncio.sleep(0)
+            row = await conn.fetchone('SELECT $1::int, pg_backend_pid()', (i,))
+            return val, row[0], row[1]
+
+    results = await asyncio.gather(*[query(i) for i in range(100)])
+    assert [val for val, _, _ in results] == list(range(100))
+    assert [one for _, one, _ in results] == list(range(100))
+    # all contexts went through the one pool
+    assert len({pid for _, _, pid in results}) <= 10
+    await pgw.close_all()
+
+
+async def test_concurrent_queries_overlap(db_cfg, event_loop):
+    import asyncio
+    import time
+    pgw = pgware.build(output='list', **{**db_cfg, 'connection_type': 'pooled', 'min_size': 5, 'max_size': 5})
+
+    async def sleep():
+        async with pgw.get_connection() as conn:
+            await conn.execute('SELECT pg_sleep(0.2)')
+
+    await pgw.preheat_async()
+    start = time.monotonic()
+    await asyncio.gather(*[sleep() for _ in range(5)])
+    assert time.monotonic() - start < 0.6
+    await pgw.close_all()
+
+
+async def test_event_loop_not_blocked(db_cfg, event_loop):
+    import asyncio
+    pgw = pgware.build(output='list', **db_cfg)
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.ensure_future(tick())
+    async with pgw.get_connection() as conn:
+        await conn.execute('SELECT pg_sleep(0.2)')
+    ticker.cancel()
+    # psycopg2 queries run in a worker thread
+    assert len(ticks) > 5
+    pgw = pgware.build(output='list', **{**db_cfg, 'special': {'async_workers': 0}})
+    assert pgw._setup.workers is None
+
+
+async def test_cancelled_query(db_cfg, event_loop):
+    import asyncio
+    import time
+    pgw = pgware.build(output='list', **{**db_cfg, 'connection_type': 'pooled', 'max_size': 1, 'pool_timeout': 2})
+
+    @pgware.doodad
+    def slow(state):
+        # Blocking, without holding the connection
+        time.sleep(0.3)
+        yield state
+
+    if db_cfg['client'] == 'psycopg2':
+        pgw.add_doodad('execution', slow)
+
+    async def query():
+        async with pgw.get_connection() as conn:
+            await conn.execute('SELECT pg_sleep(0.1)')
+
+    task = asyncio.ensure_future(query())
+    await asyncio.sleep(0.1)
+    start = time.monotonic()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    if db_cfg['client'] == 'psycopg2':
+        # The connection was given back once the worker thread was done with it
+        assert time.monotonic() - start > 0.25
+    async with pgw.get_connection() as conn:
+        assert await conn.fetchval('SELECT 1') == 1
+    await pgw.close_all()
+
+
+async def test_stream(db_cfg, event_loop):
+    pgw = pgware.build(param_format='postgresql', output='dict', **db_cfg)
+    async with pgw.get_connection().cursor() as cur:
+        rows = [row async for row in cur.stream('SELECT generate_series(1, $1) AS i', (2500,), batch_size=1000)]
+        assert rows == [{'i': i} for i in range(1, 2501)]
+        rows = cur.stream('SELECT generate_series(1, 100) AS i', batch_size=30)
+        assert await rows.fetchmany(2) == [{'i': 1}, {'i': 2}]
+        assert len(await rows.fetchmany(40)) == 40
+        # leaving a stream early
+        async for row in rows:
+            if row['i'] == 50:
+                break
+        assert await cur.fetchval('SELECT 1') == 1
+        rows = cur.stream('SELECT generate_series(1, 100) AS i', batch_size=30)
+        assert len(await rows.fetchmany(60)) == 60
+        assert await rows.fetchmany(100) == [{'i': i} for i in range(61, 101)]
+        assert await rows.fetchmany(100) == []
+        # left open, closed along with the context
+        rows = cur.stream('SELECT generate_series(1, 100) AS i', batch_size=10)
+        assert await rows.fetchmany(1) == [{'i': 1}]
+    async with pgw.get_connection() as conn:
+        try:
+            conn.stream('SELECT 1')
+        except pgware.ProgrammingError:
+            pass
+        else:
+            assert False, "Exception failed to be raised"
+
+
+async def test_stream_prefetch_error(db_cfg, event_loop):
+    import asyncio
+    import gc
+    errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda _loop, context: errors.append(context))
+    pgw = pgware.build(param_format='postgresql', output='list', **db_cfg)
+    async with pgw.get_connection().cursor() as cur:
+        rows = cur.stream('SELECT 1 / (i - 150) FROM generate_series(1, 300) i', batch_size=100)
+        assert len(await rows.fetchmany(10)) == 10
+        # The prefetch of the next batch fails: the stream is abandoned
+        await rows.close()
+    del rows
+    gc.collect()
+    assert errors == []
+
+
+async def test_iterator_batches(db_cfg, event_loop):
+    pgw = pgware.build(output='list', param_format='postgresql', **db_cfg)
+    async with pgw.get_connection().cursor() as cur:
+        await cur.execute('SELECT generate_series(1, $1)', (2500,))
+        assert [row async for row in cur] == [[i] for i in range(1, 2501)]
+        assert cur._state.result is None
+        await cur.fetchall('SELECT generate_series(1, 3)')
+        assert [row async for row in cur] == [[1], [2], [3]]
+        assert [row async for row in cur] == []
+
+
+async def test_fetchmany(db_cfg, event_loop):
+    pgw = pgware.build(output='dict', param_format='postgresql', **db_cfg)
+    async with pgw.get_connection().cursor() as cur:
+        assert await cur.fetchmany(2, 'SELECT generate_series(1, $1) AS i', (5,)) == [{'i': 1}, {'i': 2}]
+        assert await cur.fetchmany(4) == [{'i': 3}, {'i': 4}, {'i': 5}]
+        await cur.execute('SELECT generate_series(1, 2500) AS i')
+        assert await cur.fetchmany(3) == [{'i': 1}, {'i': 2}, {'i': 3}]
+        assert len([row async for row in cur]) == 2497
+        batches = [rows async for rows in cur.iter_batches('SELECT generate_series(1, $1) AS i', (2500,), 1000)]
+        assert [len(rows) for rows in batches] == [1000, 1000, 500]
+        assert batches[2][-1] == {'i': 2500}
+
+
+async def test_copy_in(db_cfg, event_loop):
+    if db_cfg['client'] == 'asyncpsycopg2':
+        pytest.skip('asynchronous psycopg2 connections can not COPY')
+
+    async def records(count):
+        for i in range(count):
+            yield (i, str(i))
+
+    pgw = pgware.build(output='list', **db_cfg)
+    async with pgw.get_connection() as conn:
+        await conn.execute('DROP TABLE IF EXISTS pgware_copy_async')
+        await conn.execute('CREATE TABLE pgware_copy_async (id int, name text)')
+        assert await conn.copy_in('pgware_copy_async', records(25000), columns=('id', 'name')) == 25000
+        assert await conn.copy_in('pgware_copy_async', [(None, None)]) == 1
+        assert await conn.fetchone('SELECT count(*), count(name), max(id) FROM pgware_copy_async') == [25001, 25000, 24999]
+        await conn.execute('DROP TABLE pgware_copy_async')
+
+
+async def test_copy_out(db_cfg, event_loop, tmp_path):
+    if db_cfg['client'] == 'asyncpsycopg2':
+        pytest.skip('asynchronous psycopg2 connections can not COPY')
+    chunks = []
+
+    async def receive(chunk):
+        chunks.append(bytes(chunk))
+
+    pgw = pgware.build(output='list', param_format='psycopg2', **db_cfg)
+    async with pgw.get_connection() as conn:
+        assert await conn.copy_out('SELECT i, i::text FROM generate_series(1, %s) i', receive, (50000,)) == 50000
+        assert b''.join(chunks).splitlines()[-1] == b'50000,50000'
+        assert await conn.copy_out('SELECT 1', tmp_path / 'out.csv') == 1
+        assert (tmp_path / 'out.csv').read_bytes() == b'1\n'
+
+
+async def test_executemany_chunks(db_cfg, event_loop):
+    progress = []
+
+    async def report(executed, rowcount):
+        progress.append(executed)
+
+    pgw = pgware.build(output='list', param_format='psycopg2', **db_cfg)
+    async with pgw.get_connection() as conn:
+        await conn.execute('CREATE TEMP TABLE pgware_chunks (id int)')
+        await conn.executemany('INSERT INTO pgware_chunks VALUES (%s)', ((i,) for i in range(250)), chunk_size=100, on_progress=report)
+        assert progress == [100, 200, 250]
+        assert await conn.fetchval('SELECT count(*) FROM pgware_chunks') == 250
+        await conn.executemany('DELETE FROM pgware_chunks WHERE id < %s', [(5,), (10,)])
+        assert conn.rowcount == -1
+        await conn.executemany('DELETE FROM pgware_chunks WHERE id < %s', [(10,), (20,)], rowcount=True)
+        assert conn.rowcount == (-1 if db_cfg['client'] == 'asyncpg' else 10)
+        await conn.executemany('SELECT %s::int', [(1,), (2,)], rowcount=True)
+        assert conn.rowcount == (-1 if db_cfg['client'] == 'asyncpg' else 2)
+
+
+async def test_statement_cache(db_cfg, event_loop):
+    if db_cfg['client'] != 'asyncpg':
+        pytest.skip('statement cache only implemented for asyncpg')
+    pgw = pgware.build(output='list', **{**db_cfg, 'connection_type': 'pooled', 'max_size': 1, 'special': {'statement_cache_size': 2}})
+    for i in range(3):
+        async with pgw.get_connection() as conn:
+            for _ in range(2):
+                await conn.prepare('SELECT $1::int + 1')
+                assert await conn.fetchval((i,)) == i + 1
+    # Pooled connections' statements are cached for an acquisition
+    assert (pgw._meta['statement_hit_cntr'], pgw._meta['statement_miss_cntr']) == (3, 3)
+    async with pgw.get_connection() as conn:
+        await conn.execute('CREATE TEMP TABLE pgware_statements (a int)')
+        for query in ['SELECT 2', 'SELECT * FROM pgware_statements', 'SELECT 2', 'SELECT 3', 'SELECT * FROM pgware_statements']:
+            await conn.prepare(query)
+            await conn.fetchall(())
+        # 'SELECT * FROM pgware_statements' evicted by 'SELECT 3'
+        assert (pgw._meta['statement_hit_cntr'], pgw._meta['statement_miss_cntr']) == (4, 7)
+        await conn.execute('ALTER TABLE pgware_statements ADD COLUMN b int')
+        await conn.execute('INSERT INTO pgware_statements VALUES (1, 2)')
+        await conn.prepare('SELECT * FROM pgware_statements')
+        assert await conn.fetchall(()) == [[1, 2]]
+    await pgw.close_all()
+    # A single connection's statements are reused by later contexts
+    pgw = pgware.build(output='list', **{**db_cfg, 'connection_type': 'single'})
+    for i in range(2):
+        async with pgw.get_connection() as conn:
+            await conn.prepare('SELECT $1::int + 1')
+            assert await conn.fetchval((i,)) == i + 1
+    assert (pgw._meta['statement_hit_cntr'], pgw._meta['statement_miss_cntr']) == (1, 1)
+    await pgw.close_all()
@@ -33,6 +33,49 @@ def test_preheat(db_cfg):
     assert(pgw.backend == db_cfg['client'])
 
 
+def test_preheat_pooled(db_cfg):
+    db_cfg['connection_type'] = 'pooled'
+    pgw = pgware.build(output='list', param_format='postgresql', max_size=3, **db_cfg)
+    pgw.preheat(min_connections=3, prepare=['SELECT $1::int + 1'])
+    if db_cfg['client'] == 'asyncpg':
+        # Pooled connections' statements only last for an acquisition
+        assert pgw._meta['statement_miss_cntr'] == 0
+        pgw.close_all_sync()
+        return
+    # Prepared once on each of the connections, held at once
+    assert pgw._meta['statement_miss_cntr'] == 3
+    with pgw.get_connection() as conn:
+        conn.prepare('SELECT $1::int + 1')
+        assert conn.fetchval((1,)) == 2
+    assert pgw._meta['statement_miss_cntr'] == 3
+    assert pgw._meta['statement_hit_cntr'] == 1
+    if db_cfg['client'] == 'psycopg2':
+        # Hot queries are prepared on their first execution, for the types of their values
+        with pgw.get_connection() as conn:
+            assert conn.fetchval('SELECT $1::int + 1', (1,)) == 2
+            assert conn.fetchval('SELECT $1::int + 1', (2,)) == 3
+        assert pgw._meta['statement_miss_cntr'] == 4
+        assert pgw._meta['statement_hit_cntr'] == 2
+    pgw.close_all_sync()
+
+
+def test_preheat_over_max_size(db_cfg, monkeypatch):
+    import time
+    db_cfg['connection_type'] = 'pooled'
+    pgw = pgware.build(output='list', param_format='postgresql', max_size=2, **db_cfg)
+    # Only as many connections as the pool can open
+    pgw.preheat(min_connections=5, prepare=['SELECT $1::int + 1'])
+    assert pgw._meta['statement_miss_cntr'] == (0 if db_cfg['client'] == 'asyncpg' else 2)
+    # One of them is in use: the preheated one is given back after a while
+    monkeypatch.setattr(pgware.main, 'PREHEAT_TIMEOUT', 0.2)
+    with pgw.get_connection() as conn:
+        conn.execute('SELECT 1')
+        start = time.monotonic()
+        pgw.preheat(min_connections=2)
+        assert time.monotonic() - start < 2
+    pgw.close_all_sync()
+
+
 def test_cursor(db_cfg):
     pgw = pgware.build(output='dict', **db_cfg)
     with pgw.get_connection().cursor():
@@ -45,6 +88,15 @@ def test_close(db_cfg):
         conn.close()
 
 
+def test_close_all(db_cfg):
+    pgw = pgware.build(output='dict', **db_cfg)
+    with pgw.get_connection() as conn:
+        assert conn.fetchval('select 1') == 1
+    with pgw.get_connection() as conn:
+        assert conn.fetchval('select 2') == 2
+    pgw.close_all_sync()
+
+
 def test_cursor_query(db_cfg):
     pgw = pgware.build(output='dict', **db_cfg)
     with pgw.get_connection().cursor() as cur:
@@ -369,3 +421,305 @@ def test_iterator(db_cfg):
         assert out[0]['one'] == 'pgware'
         assert out[1]['one'] == 'pgloop'
         assert out[2]['one'] == 'pglimp'
+
+
+def test_stream(db_cfg):
+    pgw = pgware.build(param_format='postgresql', output='list', **db_cfg)
+    with pgw.get_connection().cursor() as cur:
+        rows = list(cur.stream('SELECT generate_series(1, $1)', (2500,), batch_size=1000))
+        assert rows == [[i] for i in range(1, 2501)]
+        rows = cur.stream('SELECT generate_series(1, 100)', batch_size=30)
+        assert rows.fetchmany(2) == [[1], [2]]
+        for row in rows:
+            if row == [50]:
+                break
+        assert cur.fetchval('SELECT 1') == 1
+        rows = cur.stream('SELECT generate_series(1, 100)', batch_size=10)
+        assert rows.fetchmany(1) == [[1]]
+    with pgw.get_connection() as conn:
+        assert conn.fetchval('SELECT 2') == 2
+
+
+def test_iterator_batches(db_cfg):
+    pgw = pgware.build(output='list', param_format='postgresql', **db_cfg)
+    with pgw.get_connection().cursor() as cur:
+        cur.execute('SELECT generate_series(1, $1)', (2500,))
+        assert [row for row in cur] == [[i] for i in range(1, 2501)]
+        assert cur._state.result is None
+        cur.fetchall('SELECT generate_series(1, 3)')
+        assert [row for row in cur] == [[1], [2], [3]]
+        assert [row for row in cur] == []
+
+
+def test_fetchmany(db_cfg):
+    pgw = pgware.build(output='list', param_format='postgresql', **db_cfg)
+    with pgw.get_connection().cursor() as cur:
+        assert cur.fetchmany(2, 'SELECT generate_series(1, $1)', (5,)) == [[1], [2]]
+        assert cur.fetchmany(2) == [[3], [4]]
+        assert cur.fetchmany(2) == [[5]]
+        assert cur.fetchmany(2) == []
+        cur.execute('SELECT generate_series(1, 2500)')
+        assert cur.fetchmany(3) == [[1], [2], [3]]
+        assert [row for row in cur][0] == [4]
+        batches = list(cur.iter_batches('SELECT generate_series(1, $1)', (2500,), 1000))
+        assert [len(rows) for rows in batches] == [1000, 1000, 500]
+        assert batches[2][-1] == [2500]
+        assert list(cur.iter_batches('SELECT generate_series(1, 10)', size=5)) == [[[i] for i in range(1, 6)], [[i] for i in range(6, 11)]]
+
+
+def test_columnar_outputs(db_cfg):
+    import numpy
+    pgw = pgware.build(output='columnar', **db_cfg)
+    with pgw.get_connection().cursor() as cur:
+        result = cur.fetchall("""
+            SELECT i, i * 1.5::float AS f, i::text AS t, NULLIF(i, 2) AS n, i % 2 = 0 AS b
+            FROM generate_series(1, 3) i
+        """)
+        assert list(result) == ['i', 'f', 't', 'n', 'b']
+        assert result['i'].dtype == numpy.int64
+        assert result['i'].tolist() == [1, 2, 3]
+        assert result['f'].dtype == numpy.float64
+        assert result['t'].dtype == object and result['t'].tolist() == ['1', '2', '3']
+        assert result['n'].dtype == object and result['n'].tolist() == [1, None, 3]
+        assert result['b'].dtype == bool
+        assert cur.fetchone('SELECT 1 AS one, 2 AS two') == {'one': 1, 'two': 2}
+        assert cur.fetchval('SELECT 1') == 1
+        batch = cur.fetchmany(2, 'SELECT generate_series(1, 3) AS i')
+        assert batch['i'].tolist() == [1, 2]
+        batches = list(cur.iter_batches('SELECT i, -i AS j, 0 AS k FROM generate_series(1, 5) i', size=2))
+        assert [batch['i'].tolist() for batch in batches] == [[1, 2], [3, 4], [5]]
+        assert list(cur.iter_batches('SELECT 1 AS i WHERE false', size=2)) == []
+        # iterations yield rows
+        assert [row for row in cur.stream('SELECT generate_series(1, 2) AS i')] == [{'i': 1}, {'i': 2}]
+
+
+def test_copy_in(db_cfg):
+    pgw = pgware.build(output='list', **db_cfg)
+    with pgw.get_connection() as conn:
+        conn.execute('DROP TABLE IF EXISTS pgware_copy')
+        conn.execute('CREATE TABLE pgware_copy (id int, name text, doc jsonb, raw bytea, x float)')
+        records = [(1, 'a,"b"\nc', {'k': [1]}, b'\x00\x01', 1.5), (2, None, None, None, None), (3, '', None, b'', None)]
+        assert conn.copy_in('public.pgware_copy', records) == 3
+        assert conn.copy_in('pgware_copy', ((i, str(i)) for i in range(4, 1004)), columns=['id', 'name']) == 1000
+        conn.execute('DROP TABLE IF EXISTS pgware_copy_arrays')
+        conn.execute('CREATE TABLE pgware_copy_arrays (ids int[], tags text[], grid int[][])')
+        tags = ['a', '', 'NULL', None, 'b,"c"}', 'd\\e', ' f ']
+        assert conn.copy_in('pgware_copy_arrays', [([1, 2], tags, [[1, None], [3, 4]]), ([], [], None)]) == 2
+        assert conn.fetchall('SELECT ids, tags, grid FROM pgware_copy_arrays') == [
+            [[1, 2], tags, [[1, None], [3, 4]]], [[], [], None]
+        ]
+        conn.execute('DROP TABLE pgware_copy_arrays')
+        rows = conn.fetchall('SELECT id, name, doc, raw, x FROM pgware_copy ORDER BY id LIMIT 3')
+        assert [row[:2] for row in rows] == [[1, 'a,"b"\nc'], [2, None], [3, '']]
+        assert [bytes(row[3]) if row[3] is not None else None for row in rows] == [b'\x00\x01', None, b'']
+        assert rows[0][4] == 1.5 and rows[1][4] is None
+        assert conn.fetchval('SELECT doc FROM pgware_copy WHERE id = 1') in ({'k': [1]}, '{"k": [1]}')
+        assert conn.fetchval('SELECT count(*) FROM pgware_copy') == 1003
+        conn.execute('DROP TABLE pgware_copy')
+
+
+def test_copy_buffer():
+    from pgware.client.psycopg2_client import CopyBuffer
+    records = [(i, f'n{i}', None) for i in range(250)]
+    buffer = CopyBuffer(iter(records))
+    head = buffer.read(10)
+    assert head.startswith('0,"n0",\n')
+    # No size: all that's left
+    rest = buffer.read()
+    assert (head + rest).splitlines() == [f'{i},"n{i}",' for i in range(250)]
+    assert buffer.read() == '' and buffer.read(10) == ''
+
+
+def test_copy_out(db_cfg, tmp_path):
+    import io
+    pgw = pgware.build(output='list', param_format='postgresql', **db_cfg)
+    query = "SELECT i, 'a,' || i, NULL FROM generate_series(1, $1) i"
+    with pgw.get_connection() as conn:
+        assert conn.copy_out(query, str(tmp_path / 'out.csv'), (3,)) == 3
+        assert (tmp_path / 'out.csv').read_bytes() == b'1,"a,1",\n2,"a,2",\n3,"a,3",\n'
+        buffer = io.BytesIO(b'head\n')
+        buffer.seek(5)
+        assert conn.copy_out(query, buffer, (2,), format='text') == 2
+        assert buffer.getvalue() == b'head\n1\ta,1\t\\N\n2\ta,2\t\\N\n'
+        chunks = []
+        assert conn.copy_out('SELECT generate_series(1, 100000)', chunks.append, format='binary') == 100000
+        assert all(isinstance(chunk, memoryview) for chunk in chunks)
+        assert b''.join(chunks).startswith(b'PGCOPY\n\xff\r\n\x00')
+        try:
+            conn.copy_out('SELECT 1', buffer, format='json')
+        except pgware.ProgrammingError:
+            pass
+        else:
+            assert False, "Exception failed to be raised"
+
+
+def test_executemany_pages(db_cfg):
+    pgw = pgware.build(output='list', param_format='psycopg2', **db_cfg)
+    insert = 'INSERT INTO pgware_many (id, name) VALUES (%s, lower(%s)) ON CONFLICT DO NOTHING'
+    rows = [(i, f'N{i}') for i in range(250)]
+    with pgw.get_connection() as conn:
+        conn.execute('DROP TABLE IF EXISTS pgware_many')
+        conn.execute('CREATE TABLE pgware_many (id int PRIMARY KEY, name text)')
+        conn.executemany(insert, rows, rewrite_values=True)
+        assert conn.rowcount == (250 if db_cfg['client'] == 'psycopg2' else -1)
+        conn.executemany(insert, rows[200:] + [(250, 'N250')], page_size=20, rewrite_values=True)
+        assert conn.rowcount == (1 if db_cfg['client'] == 'psycopg2' else -1)
+        conn.executemany('UPDATE pgware_many SET name = %s WHERE id = %s', [('x', 1), ('y', 2), ('z', 3)], page_size=2)
+        assert conn.rowcount == -1
+        # Exact rowcounts on request: they add up, whatever the values or comments
+        conn.executemany('UPDATE pgware_many SET name = %s WHERE id >= %s -- comment', [('$pgware$', 249), ('N249', 248)],
+                         rowcount=True)
+        assert conn.rowcount == (5 if db_cfg['client'] == 'psycopg2' else -1)
+        conn.executemany(insert, rows[240:] + [(251, 'N251'), (252, 'N252')], rowcount=True)
+        assert conn.rowcount == (2 if db_cfg['client'] == 'psycopg2' else -1)
+        conn.executemany('SELECT %s::int', [(1,), (2,)], rowcount=True)
+        assert conn.rowcount == (2 if db_cfg['client'] == 'psycopg2' else -1)
+        conn.executemany('SELECT %s::int', [(1,), (2,)])
+        assert conn.rowcount == -1
+        conn.executemany('DELETE FROM pgware_many WHERE id < %s', [(3,), (10,)], page_size=1)
+        assert conn.rowcount == (10 if db_cfg['client'] == 'psycopg2' else -1)
+        assert conn.fetchall('SELECT * FROM pgware_many ORDER BY id LIMIT 2') == [[10, 'n10'], [11, 'n11']]
+        assert conn.fetchval('SELECT count(*) FROM pgware_many') == 243
+        assert conn.fetchall('SELECT * FROM pgware_many WHERE id >= 248 ORDER BY id') == [
+            [248, 'N249'], [249, 'N249'], [250, 'N249'], [251, 'n251'], [252, 'n252']
+        ]
+        conn.execute('DROP TABLE pgware_many')
+
+
+def test_executemany_chunks(db_cfg):
+    pgw = pgware.build(output='list', param_format='psycopg2', **db_cfg)
+    progress = []
+    with pgw.get_connection() as conn:
+        conn.execute('DROP TABLE IF EXISTS pgware_chunks')
+        conn.execute('CREATE TABLE pgware_chunks (id int PRIMARY KEY)')
+        conn.executemany(
+            'INSERT INTO pgware_chunks VALUES (%s)', ((i,) for i in range(2500)),
+            rewrite_values=True, chunk_size=1000, on_progress=lambda *counts: progress.append(counts)
+        )
+        if db_cfg['client'] == 'psycopg2':
+            assert progress == [(1000, 1000), (2000, 2000), (2500, 2500)]
+            assert conn.rowcount == 2500
+        else:
+            assert progress == [(1000, -1), (2000, -1), (2500, -1)]
+        assert conn.fetchval('SELECT count(*) FROM pgware_chunks') == 2500
+        conn.execute('DROP TABLE pgware_chunks')
+
+
+def test_prepared_statements(db_cfg):
+    if db_cfg['client'] != 'psycopg2':
+        pytest.skip('asyncpg statements are deallocated when garbage collected')
+    pgw = pgware.build(output='list', param_format='postgresql', **{**db_cfg, 'special': {'statement_cache_size': 2}})
+    statements = "SELECT statement FROM pg_prepared_statements WHERE name LIKE 'pgware_%' ORDER BY statement"
+    with pgw.get_connection() as conn:
+        for i in range(3):
+            conn.prepare('SELECT $1::int + 1')
+            assert conn.fetchval((i,)) == i + 1
+        conn.prepare('SELECT $1::int + 2')
+        assert conn.fetchval((1,)) == 3
+        assert pgw._meta['statement_hit_cntr'] == 2 and pgw._meta['statement_miss_cntr'] == 2
+        conn.prepare('SELECT $1::int + 3')
+        assert conn.fetchval((1,)) == 4
+        # least recently used statement deallocated
+        assert [row[0][-5:] for row in conn.fetchall(statements)] == ['t + 2', 't + 3']
+        conn.execute('DISCARD ALL')
+        conn.prepare('SELECT $1::int + 3')
+        assert conn.fetchval((2,)) == 5
+        # Only pgware statements are deallocated to recover
+        conn.execute('PREPARE mine AS SELECT 1')
+        conn.execute('DEALLOCATE ' + conn.fetchval("SELECT name FROM pg_prepared_statements WHERE name LIKE 'pgware_%'"))
+        conn.prepare('SELECT $1::int + 3')
+        assert conn.fetchval((3,)) == 6
+        assert conn.fetchval("SELECT count(*) FROM pg_prepared_statements WHERE name = 'mine'") == 1
+        conn.execute('DEALLOCATE mine')
+    with pgw.get_connection() as conn:
+        conn.prepare('SELECT $1::int + 3')
+        assert conn.fetchval((3,)) == 6
+        assert len(conn.fetchall(statements)) == 1
+
+
+def test_hot_queries_prepared(db_cfg):
+    pgw = pgware.build(output='list', param_format='psycopg2', **{**db_cfg, 'special': {'prepare_threshold': 2}})
+    statements = "SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'pgware_%'"
+    with pgw.get_connection() as conn:
+        for i in range(5):
+            assert conn.fetchone('SELECT %s::int + 1', (i,)) == [i + 1]
+            assert conn.fetchval('SELECT %(a)s::int * %(b)s::int', {'a': i, 'b': 2}) == i * 2
+            if db_cfg['client'] == 'psycopg2':
+                # parameter typed as its inlined value would be
+                assert conn.fetchval('SELECT %s', (i,)) == i
+        if db_cfg['client'] == 'psycopg2':
+            assert conn.fetchval(statements) == 3
+            assert pgw._meta['statement_miss_cntr'] == 3
+            assert pgw._meta['statement_hit_cntr'] == 6
+
+
+def test_hot_queries_types(db_cfg):
+    if db_cfg['client'] != 'psycopg2':
+        pytest.skip('psycopg2 query adaptation')
+    import datetime
+    pgw = pgware.build(output='list', param_format='psycopg2', **{**db_cfg, 'special': {'prepare_threshold': 1}})
+    statements = "SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'pgware_%'"
+    dates = "SELECT count(*) FROM (VALUES ('2020-01-02'::date)) t(d) WHERE d < %s"
+    with pgw.get_connection() as conn:
+        # Results don't change once queries are prepared, whatever the types of their values
+        for _ in range(3):
+            assert [conn.fetchval('SELECT %s * 2', (value,)) for value in (1, 1.5, 2 ** 40)] == [2, 3, 2 ** 41]
+            assert [conn.fetchval('SELECT count(*) FROM generate_series(1, 10) i WHERE i > %s', (value,))
+                    for value in (8, 9.5)] == [2, 1]
+            assert [conn.fetchval(dates, (value,))
+                    for value in (datetime.date(2020, 1, 2), datetime.datetime(2020, 1, 2, 12))] == [0, 1]
+        assert conn.fetchval(statements) == 7
+
+
+def test_hot_queries_not_preparable(db_cfg):
+    if db_cfg['client'] != 'psycopg2':
+        pytest.skip('psycopg2 query adaptation')
+    import psycopg2.extensions
+    import psycopg2.sql
+
+    class Ids(object):
+        def __init__(self, ids):
+            self.ids = ids
+
+    # Adapted into SQL, unknown to pgware: the server refuses to prepare it
+    psycopg2.extensions.register_adapter(Ids, lambda value: psycopg2.extensions.AsIs(repr(tuple(value.ids))))
+    pgw = pgware.build(output='list', param_format='psycopg2', **{**db_cfg, 'special': {'prepare_threshold': 2}})
+    composed = psycopg2.sql.SQL('SELECT {} + 1').format(psycopg2.sql.Literal(1))
+    with pgw.get_connection() as conn:
+        for i in range(5):
+            assert conn.fetchval(composed) == 2
+            assert conn.fetchval('SELECT count(*) FROM generate_series(1, 9) i WHERE i IN %s', ((1, 2, i + 3),)) == 3
+            assert conn.fetchval('SELECT count(*) FROM generate_series(1, 9) i WHERE i IN %s', (Ids([1, i + 2]),)) == 2
+        # Within a transaction, the failed PREPARE doesn't abort it
+        conn.execute('BEGIN')
+        for i in range(5):
+            assert conn.fetchval('SELECT count(*) FROM generate_series(1, 9) i WHERE i IN %s', (Ids([1, 9]),)) == 2
+        conn.execute('COMMIT')
+        assert conn.fetchval("SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'pgware_%'") == 0
+
+
+def test_pooled_threads(db_cfg):
+    if db_cfg['client'] != 'psycopg2':
+        pytest.skip('asyncpg pools are bound to the event loop they were created in')
+    from concurrent.futures import ThreadPoolExecutor
+    pgw = pgware.build(output='list', param_format='psycopg2', **{**db_cfg, 'connection_type': 'pooled', 'max_size': 3})
+
+    def query(i):
+        with pgw.get_connection() as conn:
+            return conn.fetchone('SELECT %s::int, pg_backend_pid()', (i,))
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(query, range(50)))
+    assert [row[0] for row in results] == list(range(50))
+    assert len({row[1] for row in results}) <= 3
+    # connections are given back without their transaction
+    with pgw.get_connection() as conn:
+        conn.execute('BEGIN')
+        conn.execute('SELECT pg_sleep(0.01)')
+    for _ in range(3):
+        with pgw.get_connection() as conn:
+            assert conn.fetchval('SELECT now() = statement_timestamp()')
+    pgw.close_all_sync()
+    with pytest.raises(pgware.ProgrammingError):
+        with pgw.get_connection() as conn:
+            conn.fetchval('SELECT 1')
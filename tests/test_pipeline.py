@@ -0,0 +1,258 @@
+# pylint: skip-file
+import asyncio
+
+import pytest
+
+import pgware as pgware
+from pgware import Context, doodad
+
+
+config = {
+    'client': 'psycopg2',
+    'database': '[DB]',
+    'user': '[USER]',
+    'password': None,
+    'host': '[HOST]',
+    'port': None,
+    'connection_type': 'single'
+}
+
+
+@doodad
+def nothing(state):
+    yield state
+
+
+def test_plan_cached():
+    pgw = pgware.build(output='dict', **config)
+    pipeline = pgw._setup.pipeline
+    context = Context.SINGLE | Context.OUTPUT_DICT
+    plan = pipeline.plan('fetchone', context)
+    assert plan is pipeline.plan('fetchone', context)
+    assert plan is not pipeline.plan('fetchall', context)
+    assert isinstance(plan.stages, tuple)
+    assert [stage for stage, _ops in plan.stages] == ['connection', 'parsing', 'execution', 'result']
+    assert plan.stages[2][1][-1][0] == 'fetchone'
+
+
+def test_plan_sync():
+    pgw = pgware.build(output='dict', **config)
+    assert pgw._setup.pipeline.plan('fetchone', Context.SINGLE).sync
+    pgw = pgware.build(output='dict', **{**config, 'client': 'asyncpg'})
+    assert not pgw._setup.pipeline.plan('fetchone', Context.SINGLE).sync
+
+
+def test_plan_execute_skips_result():
+    pgw = pgware.build(output='dict', **config)
+    plan = pgw._setup.pipeline.plan('execute', Context.SINGLE)
+    assert 'result' not in [stage for stage, _ops in plan.stages]
+
+
+def test_plan_rebuilt_on_doodad():
+    pgw = pgware.build(output='dict', **config)
+    before = pgw._setup.pipeline
+    plan = before.plan('fetchone', Context.SINGLE)
+    pgw.add_doodad('execution', nothing)
+    after = pgw._setup.pipeline
+    assert after.version == before.version + 1
+    new_plan = after.plan('fetchone', Context.SINGLE)
+    assert new_plan is not plan
+    assert new_plan.stages[2][1][0][0] == 'doodad'
+    # older pipelines are left untouched
+    assert before.plan('fetchone', Context.SINGLE) is plan
+
+
+def _op(log, name, fail_enter=0, fail_exit=0, reuse=False, handler=None):
+    """ Build a pipeline op logging its enter/exit, optionnaly failing a few times """
+    fails = {'enter': fail_enter, 'exit': fail_exit}
+
+    @doodad
+    def job(state):
+        if fails['enter']:
+            fails['enter'] -= 1
+            log.append(f'{name}!')
+            raise ValueError(name)
+        log.append(f'{name}>')
+        yield state
+        if fails['exit']:
+            fails['exit'] -= 1
+            log.append(f'{name}!<')
+            raise ValueError(name)
+        log.append(f'<{name}')
+
+    def recover(ex, state):
+        log.append(f'{name}?{ex}')
+        return handler
+
+    return (name, job, recover, reuse, False)
+
+
+@pytest.fixture(params=['async', 'sync'])
+def _stage(request):
+    def run(ops):
+        pgw = pgware.build(**config).raw_connection()
+        if request.param == 'sync':
+            return pgw._exec_stage_sync('execution', tuple(ops), pgw._state)
+        return asyncio.run(pgw._exec_stage('execution', tuple(ops), pgw._state))
+    return run
+
+
+def test_stage_ordering(_stage):
+    log = []
+    _stage([_op(log, 'a'), _op(log, 'b'), _op(log, 'c')])
+    assert log == ['a>', 'b>', 'c>', '<c', '<b', '<a']
+
+
+def test_stage_retry(_stage):
+    log = []
+    state = _stage([_op(log, 'a'), _op(log, 'b', fail_enter=1), _op(log, 'c', fail_exit=1)])
+    assert log == [
+        'a>', 'b!', 'b?b',
+        'b>', 'c>', 'c!<', 'c?c',
+        'c>', '<c', '<b', '<a'
+    ]
+    assert state.retries['stage'] == 2
+
+
+def test_stage_reuse(_stage):
+    log = []
+    ops = [_op(log, 'a', reuse=True), _op(log, 'b')]
+    state = _stage(ops)
+    assert 'a' in state.done
+    assert log == ['a>', 'b>', '<b', '<a']
+
+
+def test_stage_error_bubbles_up(_stage):
+    log = []
+    try:
+        _stage([_op(log, 'a', handler=pgware.QueryError('a')), _op(log, 'b', fail_enter=1, handler=pgware.QueryError('b'))])
+    except pgware.QueryError as ex:
+        assert str(ex) == 'a'
+    else:
+        assert False, "Exception failed to be raised"
+    assert log == ['a>', 'b!', 'b?b', 'a?b']
+
+
+def test_event_loops():
+    import threading
+    from pgware.main import EventLoops
+
+    loops = EventLoops()
+    loop = loops.get()
+    assert loops.get() is loop
+    other = []
+    thread = threading.Thread(target=lambda: other.append(loops.get()))
+    thread.start()
+    thread.join()
+    assert other[0] is not loop
+
+    async def answer():
+        return 42
+
+    assert loops.run(answer()) == 42
+    loops.close()
+    assert loop.is_closed() and other[0].is_closed()
+    assert loops.get() is not loop
+
+
+def test_event_loops_within_loop():
+    from pgware.main import EventLoops
+
+    async def answer():
+        return 42
+
+    async def main():
+        EventLoops().run(answer())
+
+    try:
+        asyncio.run(main())
+    except pgware.ProgrammingError:
+        pass
+    else:
+        assert False, "Exception failed to be raised"
+
+
+def test_state():
+    from pgware.main import State
+
+    state = State(context=Context.SINGLE)
+    assert type(state) is State
+    assert state.unknown is None
+    uid = state.uid
+    assert state.uid == uid
+    assert State().uid != uid
+    state.query = 'SELECT 1'
+    state.done.append('fetchone')
+    state.context |= Context.CURSOR
+    state.clean()
+    assert state.query is None
+    assert state.done == []
+    assert state.context == Context.SINGLE
+
+
+def test_state_child():
+    from pgware.main import State
+
+    pool = object()
+    parent = State(store={'setup': {}}, pool=pool, context=Context.POOLED)
+    child = parent.child()
+    assert child.parent is parent
+    assert child.pool is pool
+    assert child.store == parent.store and child.store is not parent.store
+    child.context |= Context.CURSOR
+    child.query = 'SELECT 1'
+    child.connection = 'connection'
+    child.done.append('acquire')
+    assert parent.context == Context.POOLED
+    assert parent.query is None and parent.connection is None and parent.done == []
+    child.share('connection', 'single_connect')
+    assert parent.connection == 'connection'
+    assert parent.done == ['single_connect']
+    assert 'single_connect' in parent.child().done
+
+
+def test_workers_loops():
+    import time
+    from pgware.main import Workers
+
+    workers = Workers(2)
+
+    def answer():
+        time.sleep(0.01)
+        return 42
+
+    async def main():
+        # Connecting calls wait for each other (a thread is left to the others)
+        return await asyncio.gather(*[workers.run(answer, connecting=True) for _ in range(3)])
+
+    # Each event loop gets its own semaphore
+    assert asyncio.run(main()) == [42] * 3
+    assert asyncio.run(main()) == [42] * 3
+    workers.close()
+
+
+def test_workers_close_async():
+    import time
+    from pgware.main import Workers
+
+    workers = Workers(2)
+    done = []
+
+    def slow():
+        time.sleep(0.3)
+        done.append(True)
+
+    async def main():
+        ticks = 0
+        running = asyncio.ensure_future(workers.run(slow))
+        await asyncio.sleep(0.01)
+        closing = asyncio.ensure_future(workers.close_async())
+        # The event loop goes on while the threads are waited for
+        while not closing.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        await running
+        return ticks
+
+    assert asyncio.run(main()) > 5
+    assert done == [True]
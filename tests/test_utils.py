@@ -72,3 +72,97 @@ def test_config_mapper():
         'd': 10
     }
     assert expected == pgware.config_map(given_map, given_config)
+
+
+def test_lru_cache():
+    from pgware.utils import LRUCache
+    cache = LRUCache(2)
+    assert cache.put('a', 1) is None
+    assert cache.put('b', 2) is None
+    assert cache.get('a') == 1
+    assert cache.put('c', 3) == ('b', 2)
+    assert cache.get('b') is None
+    assert cache.pop('a') == 1
+    assert len(cache) == 1
+    assert cache.values() == [3]
+
+
+def test_cast_params():
+    from pgware.utils import cast_params
+    query = "SELECT $1 + $2, '$1', $1 -- $2"
+    assert cast_params(query, ('integer', None)) == "SELECT $1::integer + $2, '$1', $1::integer -- $2"
+    assert cast_params(query, (None, None)) == query
+
+
+def test_conversion_cache():
+    from pgware import utils
+    query = 'select %(b)s, %(a)s, %(b)s'
+    assert pgware.ps2pg(query, {'a': 1, 'b': 2}) == ('select $1, $2, $3', (2, 1, 2))
+    hits = utils._ps2pg_dict_plan.cache_info().hits
+    assert pgware.ps2pg(query, {'a': 3, 'b': 4}) == ('select $1, $2, $3', (4, 3, 4))
+    assert utils._ps2pg_dict_plan.cache_info().hits == hits + 1
+    assert pgware.pg2ps('select $2, $1 as x', (1, 2)) == ('select %s, %s as x', (2, 1))
+    assert pgware.pg2ps('select $2, $1 as x', ('a', 'b')) == ('select %s, %s as x', ('b', 'a'))
+
+
+def test_conversion_literals():
+    query = "select '%%s' || %s, $$ %%s $$, E'it\\'s %s', \"%%(x)s\" -- %s\n, %s::int % 2"
+    expected = "select '%s' || $1, $$ %s $$, E'it\\'s %s', \"%(x)s\" -- %s\n, $2::int % 2"
+    assert pgware.ps2pg(query, (1, 2)) == (expected, (1, 2))
+    query = "select '$1' || $2, $f$ $1 $f$, x$1, /* $1 */ $1::text LIKE 'a%' || $2"
+    expected = "select '$1' || %s, $f$ $1 $f$, x$1, /* $1 */ %s::text LIKE 'a%%' || %s"
+    assert pgware.pg2ps(query, (1, 2)) == (expected, (2, 1, 2))
+    assert pgware.pg2ps('select $1', 1) == ('select %s', (1,))
+    try:
+        pgware.ps2pg('select %s, %(a)s', (1,))
+    except pgware.QueryError:
+        pass
+    else:
+        assert False, "Exception failed to be raised"
+
+
+# Property tests: random queries mixing placeholders and the literals that
+# must be left alone
+
+LITERALS = [
+    "'%s'", "'$1'", "'it''s $2 %s'", "E'\\'%s'", '"%(x)s"', '"$1"', '$$ $1 %s $$',
+    '$body$ $$ $1 $body$', '-- $1 %s\n', '/* $1 %s */', 'x$1', ',', '::int', '+', '(', ')',
+]
+
+
+def _random_query(rnd, placeholder, names, escape=False):
+    parts, keys = ['select'], []
+    for _ in range(rnd.randrange(20)):
+        if rnd.random() < 0.4:
+            key = rnd.choice(names)
+            parts.append(placeholder(key))
+            keys.append(key)
+        else:
+            literal = rnd.choice(LITERALS)
+            parts.append(literal.replace('%', '%%') if escape else literal)
+    return ' '.join(parts), keys
+
+
+def test_conversion_properties():
+    import random
+    rnd = random.Random(1664)
+    for _ in range(500):
+        # psycopg2 => postgresql => psycopg2 gets the same query and values back
+        query, keys = _random_query(rnd, lambda key: '%s', [None], escape=True)
+        values = tuple(rnd.randrange(1000) for _ in keys)
+        pg_query, pg_values = pgware.ps2pg(query, values)
+        assert pg_values == values
+        assert '%%' not in pg_query
+        assert pgware.pg2ps(pg_query, pg_values) == (query, values)
+        # named arguments are picked in order
+        query, keys = _random_query(rnd, lambda key: f'%({key})s', ['a', 'b', 'c'])
+        values = {'a': 1, 'b': 2, 'c': 3}
+        pg_query, pg_values = pgware.ps2pg(query, values)
+        assert pg_values == tuple(values[key] for key in keys)
+        assert pg_query.count('$') - query.count('$') == len(keys)
+        # numbered arguments are picked in order, repeated if need be
+        query, keys = _random_query(rnd, lambda key: f'${key}', [1, 2, 3, 10])
+        values = tuple(range(100, 110))
+        ps_query, ps_values = pgware.pg2ps(query, values)
+        assert ps_values == tuple(values[key - 1] for key in keys)
+        assert ps_query.replace('%%', '').count('%s') == len(keys)